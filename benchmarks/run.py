@@ -0,0 +1,225 @@
+"""
+Performance benchmarks for the hot paths of magis.
+
+    python benchmarks/run.py                          # run, print, write bench.json
+    python benchmarks/run.py --output new.json --baseline bench.json
+    python benchmarks/run.py --only lux --full         # batch sizes up to 1e6
+
+Everything runs offline against the shipped assets and corpus.  Each
+benchmark reports the best of several repeats in seconds.  With --baseline,
+every result is compared to the stored run and anything slower than
+--tolerance is reported as a regression.  The exit status is 1 when a group
+fails, when a baseline result is missing from the run, or on a regression.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import itertools
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+BENCHMARKS = []
+
+
+def benchmark(group):
+    def register(func):
+        BENCHMARKS.append((group, func))
+        return func
+    return register
+
+
+def measure(func, repeat=5, number=1):
+    ''' best wall time of one call, over repeat rounds of number calls '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return {'seconds': min(times), 'mean': sum(times) / len(times), 'repeat': repeat}
+
+
+def hsv_batch(n, seed=0):
+    rng = np.random.RandomState(seed)
+    return np.stack([rng.uniform(0, 360, n), rng.uniform(0, 100, n), rng.uniform(0, 100, n)], axis=1)
+
+
+############ boundaries
+
+@benchmark('boundaries')
+def boundaries(options):
+    from magis.models.abstract import DualBoundaries, CircularBoundaries
+    dual = DualBoundaries.from_parameters(3.0, 2.0, 20.0, 5.0, 1.5, 40.0)
+    circular = CircularBoundaries.from_parameters(3.0, 2.0, -20.0, 5.0, 1.5, 10.0, True)
+    out = {}
+    for label, bound in (('dual', dual), ('circular', circular)):
+        x = hsv_batch(1000)[:, 0]
+        out['{}.scalar_x1000'.format(label)] = measure(lambda: [bound(x_i) for x_i in x.tolist()])
+        for n in (1000, 100000):
+            x = hsv_batch(n)[:, 0]
+            out['{}.array_{}'.format(label, n)] = measure(lambda: bound(x))
+    return out
+
+
+############ models
+
+def _chunked(func, X, chunk=10000):
+    for start in range(0, len(X), chunk):
+        func(X[start:start+chunk])
+
+
+@benchmark('lux')
+def lux(options):
+    from magis.models import Lux
+    model = Lux.pretrained()
+    sizes = [1, 10, 100, 1000, 10000]
+    if options.full:
+        sizes += [100000, 1000000]
+    out = {}
+    for n in sizes:
+        X = hsv_batch(n)
+        repeat = 5 if n <= 10000 else 1
+        if n == 1:
+            datum = tuple(X[0])
+            out['predict_1'] = measure(lambda: model.predict(datum), number=20)
+            out['posterior_1'] = measure(lambda: model.posterior(datum), number=20)
+            out['likelihood_1'] = measure(lambda: model.likelihood(datum, 'blue'), number=20)
+            continue
+        out['predict_{}'.format(n)] = measure(lambda: _chunked(model.predict, X), repeat)
+        out['posterior_{}'.format(n)] = measure(lambda: _chunked(model.posterior, X), repeat)
+        out['likelihood_{}'.format(n)] = measure(
+            lambda: _chunked(lambda x: model.likelihood(x, 'blue'), X), repeat)
+    return out
+
+
+@benchmark('loading')
+def loading(options):
+    from magis.models import Lux
+    from magis.models.color import lux as lux_module
+    source = os.path.join(os.path.dirname(lux_module.__file__), 'assets', 'lux.json')
+
+    def cold():
+        lux_module._pretrained.clear()
+        Lux.pretrained()
+
+    return {'pretrained_cold': measure(cold),
+            'pretrained_warm': measure(Lux.pretrained, number=100),
+            'from_json': measure(lambda: Lux.from_json(source))}
+
+
+############ data
+
+@benchmark('data')
+def data(options):
+    from magis.data.interface.xkcdcolor import xkcdcolor
+    out = {}
+
+    def load():
+        dataset = xkcdcolor.Dataset()
+        dataset.load('scaled', names=options.colors)
+        return dataset
+
+    def first_access():
+        ## load() only selects; the data is read when a split is first used
+        dataset = load()
+        dataset.training_size
+        return dataset
+
+    out['load'] = measure(first_access, repeat=3)
+    dataset = load()
+    out['make_datasets'] = measure(lambda: (dataset._datasets.clear(),
+                                            dataset.make_datasets('scaled'),
+                                            dataset._active_df), repeat=3)
+    rows = 100000
+    once = measure(lambda: list(itertools.islice(dataset.generate_once('train'), rows)), repeat=3)
+    once['rows_per_second'] = rows / once['seconds']
+    out['generate_once'] = once
+    batches = measure(lambda: list(dataset.generate_batches('train', 256)), repeat=3)
+    batches['rows_per_second'] = dataset.training_size / batches['seconds']
+    out['generate_batches'] = batches
+    return out
+
+
+############ running and comparing
+
+def run(options):
+    results, failures = {}, {}
+    for group, func in BENCHMARKS:
+        if options.only and group not in options.only:
+            continue
+        print('[bench] {}'.format(group))
+        try:
+            for name, result in func(options).items():
+                results['{}.{}'.format(group, name)] = result
+                print('    {:<40}{:>12.6f}s'.format(name, result['seconds']))
+        except Exception as e:
+            failures[group] = repr(e)
+            print('    FAILED: {!r}'.format(e))
+    return {'meta': {'python': platform.python_version(), 'numpy': np.__version__,
+                     'machine': platform.machine(), 'node': platform.node(),
+                     'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'results': results, 'failures': failures}
+
+
+def compare(current, baseline, tolerance, groups=None):
+    '''
+    (regressions, missing): results that got slower than baseline by more 
+    than tolerance, and baseline results the current run did not produce.
+    groups limits the check to the groups that were run (--only)
+    '''
+    regressions, missing = [], []
+    for name, expected in sorted(baseline['results'].items()):
+        if groups and name.split('.', 1)[0] not in groups:
+            continue
+        if name not in current['results']:
+            missing.append(name)
+            print('    {:<50}{:>9}  <-- missing'.format(name, '-'))
+            continue
+        ratio = current['results'][name]['seconds'] / max(expected['seconds'], 1e-12)
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  <-- regression'
+            regressions.append(name)
+        print('    {:<50}{:>8.2f}x{}'.format(name, ratio, flag))
+    return regressions, missing
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against the baseline (0.2 = 20%%)')
+    parser.add_argument('--only', nargs='*', default=None,
+                        help='groups to run: ' + ', '.join(g for g, _ in BENCHMARKS))
+    parser.add_argument('--full', action='store_true', help='include the largest batch sizes')
+    parser.add_argument('--colors', nargs='*', default=None,
+                        help='restrict the data benchmarks to these color names')
+    options = parser.parse_args(argv)
+
+    current = run(options)
+    with open(options.output, 'w') as fp:
+        json.dump(current, fp, indent=2, sort_keys=True)
+    print('[bench] wrote {}'.format(options.output))
+
+    regressions, missing = [], []
+    if options.baseline:
+        with open(options.baseline) as fp:
+            baseline = json.load(fp)
+        print('[bench] against {}'.format(options.baseline))
+        regressions, missing = compare(current, baseline, options.tolerance, options.only)
+    if current['failures'] or regressions or missing:
+        print('[bench] FAILED: {} failed group(s), {} missing result(s), {} regression(s)'.format(
+            len(current['failures']), len(missing), len(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,170 @@
+"""
+K-fold cross-validation over a Dataset split without copying the split.
+
+A fold is a list of pieces per side (test and train), where each piece is
+either a slice of the split or a slice of one shared permutation array:
+
+    unshuffled:   test = [a:b],          train = [0:a], [b:N]
+    shuffled:     test = perm[a:b],      train = perm[0:a], perm[b:N]
+    stratified:   like shuffled, with perm ordered so that every fold holds
+                  each color's rows in proportion (within one row)
+
+Slices give views of the split's matrix.  Permutation pieces are gathered a
+batch at a time by Fold.batches, so at most one batch is ever copied.
+
+    folds = KFold(dataset, k=10, split='train', stratify=True)
+    for fold in folds:
+        for X, y in fold.batches('train'):
+            ...
+    scores = folds.map(score_fold, workers=4)
+
+make_kth_slice in magis.utils is the original copying version and is kept
+as the reference.
+"""
+import multiprocessing
+
+import numpy as np
+
+
+class Fold(object):
+    '''
+    number:         which fold this is
+    X, y:           the whole split (rows and label indices)
+    test, train:    lists of pieces, each a slice or an index array
+    '''
+    def __init__(self, number, X, y, test, train):
+        self.number = number
+        self.X = X
+        self.y = y
+        self.pieces = {'test': test, 'train': train}
+
+    def size(self, part='test'):
+        return sum(len(range(*p.indices(len(self.y)))) if isinstance(p, slice) else len(p)
+                   for p in self.pieces[part])
+
+    def indices(self, part='test'):
+        ''' the row numbers of one side, as one array '''
+        pieces = [np.arange(*p.indices(len(self.y))) if isinstance(p, slice) else p
+                  for p in self.pieces[part]]
+        return np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.intp)
+
+    def data(self, part='test'):
+        '''
+        (X, y) of one side: views when it is a single slice (an unshuffled
+        test fold), otherwise gathered copies
+        '''
+        pieces = self.pieces[part]
+        if len(pieces) == 1 and isinstance(pieces[0], slice):
+            return self.X[pieces[0]], self.y[pieces[0]]
+        index = self.indices(part)
+        return self.X[index], self.y[index]
+
+    def batches(self, part='train', batch_size=4096):
+        ''' (X, y) batches of one side; slices are yielded as views, index pieces gathered per batch '''
+        for piece in self.pieces[part]:
+            if isinstance(piece, slice):
+                start, stop, _ = piece.indices(len(self.y))
+                for i in range(start, stop, batch_size):
+                    j = min(i + batch_size, stop)
+                    yield self.X[i:j], self.y[i:j]
+            else:
+                for i in range(0, len(piece), batch_size):
+                    index = piece[i:i+batch_size]
+                    yield self.X[index], self.y[index]
+
+
+def _pieces(order, bounds, n, i):
+    ''' (test pieces, train pieces) of fold i '''
+    a, b = int(bounds[i]), int(bounds[i+1])
+    if order is None:
+        return [slice(a, b)], [s for s in (slice(0, a), slice(b, n)) if s.stop > s.start]
+    return [order[a:b]], [p for p in (order[:a], order[b:]) if len(p)]
+
+
+_worker_state = {}
+
+def _init_worker(func, X, y, order, bounds):
+    _worker_state.update(func=func, X=X, y=y, order=order, bounds=bounds)
+
+def _run_in_worker(i):
+    state = _worker_state
+    fold = Fold(i, state['X'], state['y'], *_pieces(state['order'], state['bounds'], len(state['y']), i))
+    return state['func'](fold)
+
+
+class KFold(object):
+    '''
+    dataset:    a loaded Dataset with an active form (make_datasets)
+    k:          number of folds
+    split:      which split to fold
+    shuffle:    fold a random permutation instead of contiguous ranges
+    stratify:   give every fold the same share of each color (implies shuffle
+                within each color unless shuffle=False, then rows keep their order)
+    '''
+    def __init__(self, dataset, k=5, split='train', shuffle=False, stratify=False, seed=None):
+        df = dataset._active_df
+        self.k = k
+        self.split = split
+        self.X = df.mats[split]
+        self.y = df.labels[split]
+        n = len(self.y)
+        if k < 2 or k > n:
+            raise ValueError("k must be between 2 and the number of rows ({})".format(n))
+        rng = np.random.RandomState(seed)
+
+        if stratify:
+            self.order, self.bounds = self._stratified(df.offsets[split], k, shuffle, rng)
+        else:
+            self.order = rng.permutation(n) if shuffle else None
+            self.bounds = np.linspace(0, n, k + 1).astype(np.int64)
+
+    @staticmethod
+    def _stratified(offsets, k, shuffle, rng):
+        '''
+        a permutation in which fold i is order[bounds[i]:bounds[i+1]] and holds
+        rows r*k//c == i of every color (r its position among the color's c rows)
+        '''
+        offsets = np.asarray(offsets, dtype=np.int64)
+        counts = np.diff(offsets)
+        n = int(offsets[-1])
+        color = np.repeat(np.arange(len(counts)), counts)
+        ## rows of a color are contiguous, so a within-color shuffle is a permutation of each block
+        order = np.arange(n)
+        if shuffle:
+            order = order[np.lexsort((rng.random_sample(n), color))]
+        position = np.arange(n) - offsets[color]
+        fold = position * k // np.maximum(counts[color], 1)
+        by_fold = np.argsort(fold, kind='stable')
+        bounds = np.zeros(k + 1, dtype=np.int64)
+        np.cumsum(np.bincount(fold, minlength=k), out=bounds[1:])
+        return order[by_fold], bounds
+
+    def __len__(self):
+        return self.k
+
+    def pieces(self, i):
+        ''' (test pieces, train pieces) of fold i '''
+        return _pieces(self.order, self.bounds, len(self.y), i)
+
+    def fold(self, i):
+        return Fold(i, self.X, self.y, *self.pieces(i))
+
+    def __iter__(self):
+        for i in range(self.k):
+            yield self.fold(i)
+
+    def map(self, func, workers=1):
+        '''
+        func(fold) for every fold, in fold order. with workers > 1 (None for
+        one per core) the folds run in a process pool; each worker gets the
+        split and the fold layout once, when it starts (for free under fork),
+        and each task is only a fold number. func must be picklable.
+        '''
+        if workers == 1:
+            return [func(fold) for fold in self]
+        pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                    initargs=(func, self.X, self.y, self.order, self.bounds))
+        try:
+            return pool.map(_run_in_worker, range(self.k))
+        finally:
+            pool.terminate()
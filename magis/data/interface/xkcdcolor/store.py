@@ -0,0 +1,127 @@
+"""
+Columnar on-disk cache of the XKCD corpus.
+
+Parsing the ~2500 per-color json files is the slow part of Dataset.load.  After
+one load, CorpusStore.write keeps the converted data as one contiguous float32
+matrix per (form, split).  Each matrix has every color's rows back to back in
+index order.  Next to it go an int32 label array per split and a per-split
+offset table, so color i of a split is rows offsets[i]:offsets[i+1].
+
+A store lives in a directory named after a fingerprint of corpusindex.json and
+the size/mtime of every source file it lists. Any edit to the corpus therefore
+points at a new directory and the old store is simply never opened again.
+"""
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from ....utils import cache_path
+
+FORMAT_VERSION = 1
+
+
+def fingerprint(index, root):
+    ''' hash of the corpus index and the size/mtime of every file it references '''
+    digest = hashlib.sha256()
+    digest.update(str(FORMAT_VERSION).encode('utf8'))
+    ## Dataset.load_all drops the 'name' entries, so leave them out either way
+    index = {name: {split: filename for split, filename in splits.items() if split != 'name'}
+             for name, splits in index.items()}
+    digest.update(json.dumps(index, sort_keys=True).encode('utf8'))
+    for name in sorted(index):
+        for split, filename in sorted(index[name].items()):
+            info = os.stat(os.path.join(root, filename))
+            digest.update('{}:{}:{}'.format(filename, info.st_size, info.st_mtime_ns).encode('utf8'))
+    return digest.hexdigest()
+
+
+class CorpusStore(object):
+    '''
+    names:      color names, in the order their rows are laid out
+    offsets:    {split: (K+1,) int64}
+    labels:     {split: (N,) int32 position in names}
+    matrices:   {(form, split): (N, 3) float32}
+    '''
+    def __init__(self, path, names, offsets, labels, matrices):
+        self.path = path
+        self.names = names
+        self.offsets = offsets
+        self.labels = labels
+        self.matrices = matrices
+
+    @property
+    def splits(self):
+        return sorted(self.offsets)
+
+    @property
+    def forms(self):
+        return sorted(set(form for form, _ in self.matrices))
+
+    @staticmethod
+    def location(index, root):
+        return cache_path('xkcd', fingerprint(index, root)[:16], 'manifest.json')
+
+    @classmethod
+    def open(cls, index, root):
+        ''' memory-map the store for this exact corpus, or None if it was never written '''
+        try:
+            manifest_file = cls.location(index, root)
+        except (IOError, OSError):
+            return None
+        if not os.path.exists(manifest_file):
+            return None
+        path = os.path.dirname(manifest_file)
+        with open(manifest_file) as fp:
+            manifest = json.load(fp)
+
+        def mapped(fname):
+            return np.load(os.path.join(path, fname), mmap_mode='r')
+
+        offsets = {split: mapped('{}.offsets.npy'.format(split)) for split in manifest['splits']}
+        labels = {split: mapped('{}.labels.npy'.format(split)) for split in manifest['splits']}
+        matrices = {(form, split): mapped('{}.{}.npy'.format(split, form))
+                    for form in manifest['forms'] for split in manifest['splits']}
+        return cls(path, manifest['names'], offsets, labels, matrices)
+
+    @classmethod
+    def write(cls, loaded, index, root):
+        ''' lay out Dataset.loaded ({name: {(form, split): array}}) as a store '''
+        path = os.path.dirname(cls.location(index, root))
+        names = [name for name in index if name in loaded]
+        keys = set(key for name in names for key in loaded[name])
+        forms = sorted(set(form for form, _ in keys))
+        splits = sorted(set(split for _, split in keys))
+
+        for split in splits:
+            counts = np.array([len(loaded[name][forms[0], split]) for name in names])
+            offsets = np.zeros(len(names) + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+            np.save(os.path.join(path, '{}.offsets.npy'.format(split)), offsets)
+            np.save(os.path.join(path, '{}.labels.npy'.format(split)),
+                    np.repeat(np.arange(len(names), dtype=np.int32), counts))
+            for form in forms:
+                out = np.lib.format.open_memmap(os.path.join(path, '{}.{}.npy'.format(split, form)),
+                                                mode='w+', dtype=np.float32, shape=(int(offsets[-1]), 3))
+                for i, name in enumerate(names):
+                    out[offsets[i]:offsets[i+1]] = loaded[name][form, split]
+                out.flush()
+                del out
+
+        ## the manifest goes last; a store without one is treated as absent
+        with open(os.path.join(path, 'manifest.json.tmp'), 'w') as fp:
+            json.dump({'names': names, 'forms': forms, 'splits': splits,
+                       'format': FORMAT_VERSION}, fp)
+        os.rename(os.path.join(path, 'manifest.json.tmp'), os.path.join(path, 'manifest.json'))
+        return cls.open(index, root)
+
+    def rows(self, name_index, form, split):
+        ''' zero-copy view of one color's rows '''
+        offsets = self.offsets[split]
+        return self.matrices[form, split][offsets[name_index]:offsets[name_index+1]]
+
+    def item(self, name_index):
+        ''' the {(form, split): rows} dict Dataset.loaded keeps per color '''
+        return {(form, split): self.rows(name_index, form, split)
+                for (form, split) in self.matrices}
@@ -8,6 +8,11 @@ Dataset abstract interface defined in eidos, so it is required.
 """
 
 import os
+import multiprocessing
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 HERE = os.path.dirname(os.path.abspath(__file__))
 
 try:
@@ -20,6 +25,151 @@ import numpy as np
 import eidos
 from eidos import GenericIndex as Gendex
 
+from ....utils import prefetched, instrumented
+from .store import CorpusStore
+
+
+def _load_one(job):
+    name, splits = job
+    item = {}
+    for split, filename in splits.items():
+        with open(os.path.join(HERE,filename)) as fp:
+             datum = json.load(fp)
+             item['raw', split] = np.array([d['raw'] for d in datum])
+             item['scaled', split] = np.array([d['scaled'] for d in datum])
+    return name, item
+
+
+def _convert_one(job):
+    def convert_one(datum):
+        datum_rads = datum * np.pi / 180.0
+        datum_conv = 180.0 / np.pi * np.arctan2(np.sin(datum_rads), 
+                                                 np.cos(datum_rads))
+        return datum_conv
+
+    name, datums = job
+    litmus = datums['scaled', 'dev'][:,0]
+    litmus_conv = convert_one(litmus)
+    
+    if litmus.std() > litmus_conv.std():
+        for (form,split), datum in datums.items():
+            scale = 1.
+            if form == 'raw':
+                scale = 360.
+            datum[:,0] = convert_one(datum[:,0]*scale) / scale
+    return name, datums
+
+
+def _load_converted(job):
+    return _convert_one(_load_one(job))
+
+
+def _load_selected(job):
+    ''' parse and convert one color, keeping only the requested splits and forms '''
+    name, splits, keep_splits, keep_forms = job
+    ## the dev split decides the hue conversion, so it is always read
+    read = {split: filename for split, filename in splits.items() 
+            if split in keep_splits or split == 'dev'}
+    name, item = _load_converted((name, read))
+    return name, {(form, split): datum for (form, split), datum in item.items()
+                  if form in keep_forms and split in keep_splits}
+
+
+def _map(func, jobs, workers=1, desc=None):
+    ''' 
+    func over jobs, in order; with workers != 1 the jobs go to a process pool
+    and the arrays come back pickled
+    '''
+    if workers == 1:
+        for job in tqdm(jobs, desc=desc):
+            yield func(job)
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in tqdm(pool.imap(func, jobs, chunksize=8), total=len(jobs), desc=desc):
+            yield result
+    finally:
+        pool.terminate()
+
+
+class LazyCorpus(MutableMapping):
+    '''
+    The Dataset.loaded mapping, {name: {(form, split): rows}}, restricted to a
+    selection of names, splits and forms.  A color is parsed (or sliced out of
+    the CorpusStore) the first time it is accessed; release() drops colors
+    again and they are re-read if they are needed later.
+    '''
+    def __init__(self, index, names, splits, forms, store=None, workers=1):
+        self.index = index
+        self.names = list(names)
+        self.splits = tuple(splits)
+        self.forms = tuple(forms)
+        self.store = store
+        self.workers = workers
+        self._position = {name:i for i, name in enumerate(store.names)} if store else {}
+        self._items = {}
+
+    def _job(self, name):
+        splits = {k:v for k, v in self.index[name].items() if k != 'name'}
+        return (name, splits, self.splits, self.forms)
+
+    def __getitem__(self, name):
+        ## partly released items are read again in full
+        if len(self._items.get(name, ())) < len(self.forms) * len(self.splits):
+            if name not in self.index:
+                raise KeyError(name)
+            if self.store is not None:
+                i = self._position[name]
+                self._items[name] = {(form, split): self.store.rows(i, form, split)
+                                     for form in self.forms for split in self.splits}
+            else:
+                self._items[name] = _load_selected(self._job(name))[1]
+        return self._items[name]
+
+    def __setitem__(self, name, item):
+        if name not in self.names:
+            self.names.append(name)
+        self._items[name] = item
+
+    def __delitem__(self, name):
+        self.names.remove(name)
+        self._items.pop(name, None)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def materialize(self):
+        ''' read every selected color that is not loaded yet, with self.workers '''
+        missing = [name for name in self.names if name not in self._items]
+        if self.store is not None or not missing:
+            for name in missing:
+                self[name]
+            return
+        jobs = [self._job(name) for name in missing]
+        for name, item in _map(_load_selected, jobs, self.workers, desc='loading data'):
+            self._items[name] = item
+
+    def release(self, names=None, splits=None, forms=None):
+        ''' free loaded rows; names/splits/forms narrow what is dropped '''
+        for name in list(self._items):
+            if names is not None and name not in names:
+                continue
+            if splits is None and forms is None:
+                del self._items[name]
+                continue
+            item = self._items[name]
+            for form, split in list(item):
+                if (splits is None or split in splits) and (forms is None or form in forms):
+                    del item[form, split]
+            if not item:
+                del self._items[name]
+
 
 class Dataset(eidos.Dataset):
     def __init__(self, coordinator=None):
@@ -39,27 +189,31 @@ class Dataset(eidos.Dataset):
         
         self._name2index = {k:i for i,k in enumerate(self.index.keys())}
         self._index2name = {i:k for k,i in self._name2index.items()}
-        self._active_df = None
+        self.current_form = None
+        self._splits = ('train', 'dev', 'test')
+        self._datasets = {}
+        self._store = None
 
     ############ properties 
 
     @property
     def training_size(self):
-        if self._active_df is None:
-            return 0
-        return self._active_df.n.train
+        return self.size('train')
 
     @property
     def development_size(self):
-        if self._active_df is None:
-            return 0
-        return self._active_df.n.train
+        return self.size('dev')
 
     @property
     def testing_size(self):
+        return self.size('test')
+
+    @property
+    def names(self):
+        ''' the color names of the active form, in the order of their rows '''
         if self._active_df is None:
-            return 0
-        return self._active_df.n.train
+            return []
+        return self._active_df.names
 
     @property
     def number_words(self):
@@ -82,28 +236,65 @@ class Dataset(eidos.Dataset):
         return self._index2name[index]
 
 
-    def load(self, form='raw'):
+    @instrumented('dataset.load')
+    def load(self, form='raw', use_store=True, workers=1, splits=None, forms=None, names=None):
+        '''
+        select what to load; nothing is read until it is first used.
+
+        splits, forms and names restrict the corpus (default: everything).
+        with use_store, the parsed and converted corpus is kept in a columnar
+        CorpusStore after the first full load and memory-mapped from then on.
+        workers is used when the json has to be parsed.
+        '''
+        splits = tuple(splits or ('train', 'dev', 'test'))
+        forms = tuple(forms or ('raw', 'scaled'))
+        if form not in forms:
+            forms = forms + (form,)
+        self._splits = splits
+        self._datasets = {}
         if not hasattr(self, 'mgr'):
-            self.load_all()
-            self.convert_all()
+            everything = (names is None and set(splits) >= {'train', 'dev', 'test'} and 
+                          set(forms) >= {'raw', 'scaled'})
+            self._store = CorpusStore.open(self.index, HERE) if use_store else None
+            parsed = False
+            if self._store is None and use_store and everything:
+                ## the store needs the whole corpus once
+                self.loaded = {}
+                self.load_all(workers, convert=True)
+                parsed = True
+                try:
+                    self._store = CorpusStore.write(self.loaded, self.index, HERE)
+                except (IOError, OSError):
+                    self._store = None
+            if self._store is not None or not parsed:
+                names = [name for name in self.index if names is None or name in names]
+                self.loaded = LazyCorpus(self.index, names, splits, forms, 
+                                         store=self._store, workers=workers)
         self.make_datasets(form)
         self.forevers = eidos.GenericIndex({split:self.generate_forever(split) 
-                                            for split in ('train', 'dev', 'test')})
+                                            for split in splits})
+
+    def release(self, splits=None, forms=None, names=None):
+        '''
+        free loaded and assembled data; anything still selected is read
+        again the next time it is used
+        '''
+        if isinstance(self.loaded, LazyCorpus):
+            self.loaded.release(names, splits, forms)
+        for form in list(self._datasets):
+            if forms is None or form in forms:
+                del self._datasets[form]
 
     def generate_once(self, split='train'):
         ''' randomly iterate over all data points once '''
-        ## get indices from names
-        n2i = self._name2index
         ## total count for split
         n = self._active_df.n[split]
         ## the actual data
         matrix = self._active_df.mats[split]
-        ## compute the true label orderings to match the rows in the matrix
-        name_info = sorted(self._active_df.sparsemap[split].items(), key=lambda x: x[1][0])
-        name_idx = np.array([n2i[r_name] for name, (_, m) in name_info 
-                                         for r_name in [name]*m])
+        ## the true label of every row in the matrix
+        name_idx = self._active_df.labels[split]
         ## get some random numbers
-        indices = np.random.choice(np.arange(n), size=n, replace=False)
+        indices = np.random.permutation(n)
         ## now iterate over them and yield it out
         for idx in indices:
             yield matrix[idx], name_idx[idx]
@@ -114,58 +305,136 @@ class Dataset(eidos.Dataset):
             for x, y in self.generate_once(split):
                 yield x, y
 
+    def generate_batches(self, split='train', batch_size=256, shuffle=True, 
+                               forever=False, prefetch=0):
+        '''
+        iterate over the split in ((B, 3) data, (B,) labels) batches.
+
+        one permutation per epoch and each batch is a single fancy-index 
+        gather; without shuffle the batches are views of the matrix. 
+        the last batch of an epoch may be short.
+        prefetch > 0 gathers that many batches ahead on a background thread.
+        '''
+        batches = self._batches(split, batch_size, shuffle, forever)
+        if prefetch:
+            batches = prefetched(batches, prefetch)
+        return batches
+
+    def _batches(self, split, batch_size, shuffle, forever):
+        n = self._active_df.n[split]
+        matrix = self._active_df.mats[split]
+        name_idx = self._active_df.labels[split]
+        while True:
+            if shuffle:
+                order = np.random.permutation(n)
+                for start in range(0, n, batch_size):
+                    idx = order[start:start+batch_size]
+                    yield matrix[idx], name_idx[idx]
+            else:
+                for start in range(0, n, batch_size):
+                    yield matrix[start:start+batch_size], name_idx[start:start+batch_size]
+            if not forever:
+                return
+
+    def kfold(self, k=5, split='train', shuffle=False, stratify=False, seed=None):
+        ''' k folds over the active split, as views and index slices (see magis.data.folds) '''
+        from ...folds import KFold
+        return KFold(self, k, split, shuffle=shuffle, stratify=stratify, seed=seed)
 
     #######################  not in interface
 
 
-    def load_all(self):
-        for name, splits in tqdm(self.index.items(), desc='loading data'):
+    @instrumented('dataset.load_all')
+    def load_all(self, workers=1, convert=False):
+        '''
+        parse every color's json files. 
+        workers > 1 (or None for one per core) spreads the parsing over a process pool
+        convert applies convert_all to each color where it is parsed, so the 
+        data crosses between processes once
+        '''
+        jobs = []
+        for name, splits in self.index.items():
             splits.pop('name', '') # should have taken this out anyway =D
-            item = {}
-            for split, filename in splits.items():
-                with open(os.path.join(HERE,filename)) as fp:
-                     datum = json.load(fp)
-                     item['raw', split] = np.array([d['raw'] for d in datum])
-                     item['scaled', split] = np.array([d['scaled'] for d in datum])
-
+            jobs.append((name, splits))
+        func = _load_converted if convert else _load_one
+        for name, item in _map(func, jobs, workers, desc='loading data'):
             self.loaded[name] = item
 
     def convert_all(self):
-        def convert_one(datum):
-            datum_rads = datum * np.pi / 180.0
-            datum_conv = 180.0 / np.pi * np.arctan2(np.sin(datum_rads), 
-                                                     np.cos(datum_rads))
-            return datum_conv
-
-        for name, datums in tqdm(self.loaded.items(), 'converting data'):
-            litmus = datums['scaled', 'dev'][:,0]
-            litmus_conv = convert_one(litmus)
-            
-            if litmus.std() > litmus_conv.std():
-                for (form,split), datum in datums.items():
-                    scale = 1.
-                    if form == 'raw':
-                        scale = 360.
-                    datum[:,0] = convert_one(datum[:,0]*scale) / scale
-
+        '''
+        move hues onto (-180, 180] for the colors where that lowers the variance.
+        this is a cheap vectorized pass, so it stays in this process; shipping 
+        the corpus to a pool and back costs more than it does.
+        '''
+        for name, item in tqdm(list(self.loaded.items()), desc='converting data'):
+            self.loaded[name] = _convert_one((name, item))[1]
 
     def make_datasets(self, form='raw'):
-        splits = ('train', 'dev', 'test')
+        '''
+        activate one contiguous matrix per split for the given form.
+        the matrices are assembled when first used and then kept, 
+        so switching back to a form is free.
+        '''
         self.current_form = form
 
-        mats = Gendex({k:np.empty((0,3)) for k in splits})
-        sparsemap = Gendex({k:{} for k in splits})
-        n = Gendex({k:0 for k in splits})
-
-        for name, datums in self.loaded.items():
+    @property
+    def _active_df(self):
+        form = self.current_form
+        if form is None:
+            return None
+        if form not in self._datasets:
+            self._datasets[form] = self._assemble(form, self._splits)
+        return self._datasets[form]
+
+    @instrumented('dataset.assemble')
+    def _assemble(self, form, splits):
+        '''
+        one pass per split: size everything up front and fill a single buffer.
+        rows of color names[i] are mats[split][offsets[split][i]:offsets[split][i+1]]
+        '''
+        n2i = self._name2index
+        store = self._store
+        if store is not None and isinstance(self.loaded, LazyCorpus):
+            ## a subset of the names has to be gathered
+            store = store if self.loaded.names == list(store.names) else None
+        if store is not None and form in store.forms:
+            names = list(store.names)
+            to_index = np.array([n2i[name] for name in names], dtype=np.int32)
+            mats = Gendex({k:store.matrices[form, k] for k in splits})
+            offsets = Gendex({k:store.offsets[k] for k in splits})
+            labels = Gendex({k:to_index[store.labels[k]] for k in splits})
+        else:
+            if isinstance(self.loaded, LazyCorpus):
+                self.loaded.materialize()
+            names = [name for name in self.index if name in self.loaded]
+            to_index = np.array([n2i[name] for name in names], dtype=np.int32)
+            mats, offsets, labels = Gendex(), Gendex(), Gendex()
             for split in splits:
-                D = datums[form, split]
-                sparsemap[split][name] = (n[split], len(D))
-                n[split] += len(D)
-                mats[split] = np.concatenate((mats[split], D), axis=0)
-        self._active_df = Gendex({'n': n, 'sparsemap': sparsemap, 'mats': mats})
-
+                parts = [self.loaded[name][form, split] for name in names]
+                counts = np.array([len(D) for D in parts], dtype=np.int64)
+                offsets[split] = np.zeros(len(names) + 1, dtype=np.int64)
+                np.cumsum(counts, out=offsets[split][1:])
+                dtype = parts[0].dtype if parts else np.float64
+                mats[split] = np.empty((int(offsets[split][-1]), 3), dtype=dtype)
+                for i, D in enumerate(parts):
+                    mats[split][offsets[split][i]:offsets[split][i+1]] = D
+                labels[split] = np.repeat(to_index, counts)
+        n = Gendex({k:len(mats[k]) for k in splits})
+        position = {name:i for i, name in enumerate(names)}
+        return Gendex({'n': n, 'names': names, 'position': position, 'offsets': offsets, 
+                       'labels': labels, 'mats': mats})
+
+    def size(self, split='train'):
+        ''' number of rows of the split in the active dataset (0 before load) '''
+        if self._active_df is None:
+            return 0
+        return self._active_df.n.get(split, 0)
 
+    def rows(self, name, split='train'):
+        ''' zero-copy view of one color's rows in the active dataset '''
+        df = self._active_df
+        i = df.position[name]
+        return df.mats[split][df.offsets[split][i]:df.offsets[split][i+1]]
 
     def cache(self, filer):
         name = "xkcd"
@@ -1,2 +1,3 @@
 from .boundaries import LeftBound, RightBound, DualBoundaries, CircularBoundaries
-from .model import Model, Component
\ No newline at end of file
+from .boundaries import dual_survival, log_dual_survival, log_gdtrc, wrap_degrees
+from .model import Model, Component, Distribution, BatchDistribution
\ No newline at end of file
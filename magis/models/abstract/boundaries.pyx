@@ -1,12 +1,108 @@
-from scipy.special import gdtrc 
+from scipy.special import gdtrc, gammaln
 from math import atan2, sin, cos, pi
+import numbers
 import numpy as np
 cimport numpy as np
 
+
+def dual_survival(x, left_rate, left_shape, left_origin, 
+                     right_rate, right_shape, right_origin):
+    '''
+    Two-sided gamma survival function evaluated over a whole array at once.
+
+    Everything to the left of left_origin gets the left tail, everything to the
+    right of right_origin gets the right tail, and the plateau in between is 1.0.
+    The tails are computed with a single gdtrc ufunc call each, so there is no 
+    python call per element. 
+
+    All arguments broadcast against each other, so the parameters can be 
+    scalars (one boundary) or arrays (one boundary per column).
+    x can be float32/float64 of any shape or contiguity; output is float64.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    x, l_rate, l_shape, l_origin, r_rate, r_shape, r_origin = np.broadcast_arrays(
+        x, left_rate, left_shape, left_origin, right_rate, right_shape, right_origin)
+    out = np.ones(x.shape, dtype=np.float64)
+
+    left = x < l_origin
+    if left.any():
+        out[left] = gdtrc(l_rate[left], l_shape[left], l_origin[left] - x[left])
+    right = x > r_origin
+    if right.any():
+        out[right] = gdtrc(r_rate[right], r_shape[right], x[right] - r_origin[right])
+    return out
+
+
+def log_gdtrc(rate, shape, t):
+    '''
+    log of gdtrc(rate, shape, t) that stays finite where gdtrc underflows.
+
+    Where gdtrc is below 1e-280 the upper incomplete gamma function is 
+    evaluated in log space with its continued fraction, which converges 
+    quickly there (rate*t is far above shape whenever the tail is that small).
+    '''
+    rate, shape, t = np.broadcast_arrays(*(np.asarray(v, dtype=np.float64) for v in (rate, shape, t)))
+    q = gdtrc(rate, shape, t)
+    with np.errstate(divide='ignore'):
+        out = np.log(q)
+    small = q < 1e-280
+    if small.any():
+        out[small] = _log_upper_gamma(shape[small], rate[small] * t[small])
+    return out
+
+
+def _log_upper_gamma(a, z, int iterations=200):
+    ''' log Q(a, z) by the modified Lentz continued fraction, vectorized '''
+    cdef double tiny = 1e-300
+    b = z + 1.0 - a
+    c = np.full(z.shape, 1.0/tiny)
+    d = 1.0 / b
+    h = d.copy()
+    for i in range(1, iterations):
+        an = -i * (i - a)
+        b = b + 2.0
+        d = an * d + b
+        d[np.abs(d) < tiny] = tiny
+        c = b + an / c
+        c[np.abs(c) < tiny] = tiny
+        d = 1.0 / d
+        delta = d * c
+        h *= delta
+        if np.all(np.abs(delta - 1.0) < 1e-15):
+            break
+    return -z + a * np.log(z) - gammaln(a) + np.log(h)
+
+
+def log_dual_survival(x, left_rate, left_shape, left_origin, 
+                         right_rate, right_shape, right_origin):
+    '''
+    log of dual_survival, finite arbitrarily far out in the tails (see log_gdtrc).
+    same broadcasting as dual_survival; output is float64.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    x, l_rate, l_shape, l_origin, r_rate, r_shape, r_origin = np.broadcast_arrays(
+        x, left_rate, left_shape, left_origin, right_rate, right_shape, right_origin)
+    out = np.zeros(x.shape, dtype=np.float64)
+
+    left = x < l_origin
+    if left.any():
+        out[left] = log_gdtrc(l_rate[left], l_shape[left], l_origin[left] - x[left])
+    right = x > r_origin
+    if right.any():
+        out[right] = log_gdtrc(r_rate[right], r_shape[right], x[right] - r_origin[right])
+    return out
+
+
+def wrap_degrees(x):
+    ''' map degrees onto (-180, 180] the same way the scalar path does '''
+    x = np.asarray(x, dtype=np.float64)
+    return np.arctan2(np.sin(x*np.pi/180.0), np.cos(x*np.pi/180.0))*180.0/np.pi
+
+
 cdef class Bound:
-    cdef double rate
-    cdef double shape
-    cdef double origin
+    cdef readonly double rate
+    cdef readonly double shape
+    cdef readonly double origin
     
     def __init__(self, double rate, double shape, double origin):
         self.shape = shape
@@ -16,6 +112,9 @@ cdef class Bound:
     @classmethod
     def from_scale(cls, double scale, double shape, double origin):
         return cls(rate=1.0/scale, shape=shape, origin=origin)
+
+    def __reduce__(self):
+        return (type(self), (self.rate, self.shape, self.origin))
                 
     cpdef phi(self, double x):
         return gdtrc(self.rate, self.shape, x)
@@ -71,14 +170,12 @@ cdef class DualBoundaries:
     cdef Bound left
     cdef Bound right
     cdef double left_origin, right_origin
-    cdef bint vectorized
 
     def __init__(self, LeftBound left, RightBound right): 
         self.left = left
         self.left_origin = left.origin
         self.right = right
         self.right_origin = right.origin
-        self.vectorized = 1
         
     @classmethod
     def from_parameters(cls, double left_scale, double left_shape, double left_origin, 
@@ -86,26 +183,19 @@ cdef class DualBoundaries:
         return cls(LeftBound.from_scale(left_scale, left_shape, left_origin), 
                    RightBound.from_scale(right_scale, right_shape, right_origin))
     
-    def __call__(self, *args):
-        try:
-            if self.vectorized:
-                return self.__ndarray_call__(*args)
-            else:
-                return self.__scalar_call__(*args)
-        except TypeError:
-            self.toggle()
-            if self.vectorized:
-                self.toggle()
-                return self.__ndarray_call__(*args)
-            else:
-                self.toggle()
-                return self.__scalar_call__(*args)
-            
-    def toggle(self):
-        if self.vectorized:
-            self.vectorized = 0
-        else:
-            self.vectorized = 1
+    def __reduce__(self):
+        return (type(self), (self.left, self.right))
+
+    @property
+    def parameters(self):
+        ''' (left rate, left shape, left origin, right rate, right shape, right origin) '''
+        return (self.left.rate, self.left.shape, self.left_origin, 
+                self.right.rate, self.right.shape, self.right_origin)
+
+    def __call__(self, x):
+        if isinstance(x, numbers.Number) or (isinstance(x, np.ndarray) and x.ndim == 0):
+            return self.__scalar_call__(x)
+        return self.__ndarray_call__(x)
     
     def __scalar_call__(self, double x):
         if x < self.left_origin:
@@ -115,26 +205,12 @@ cdef class DualBoundaries:
         else:
             return 1.0
     
-    def __ndarray_call__(self, np.ndarray[double, ndim=1] x):
-        cdef: 
-            Py_ssize_t i = 0
-            Py_ssize_t n = x.shape[0]
-            double x_i = 0
-            double l_origin = self.left_origin
-            double r_origin = self.right_origin
-            np.ndarray[double, ndim=1] out = np.empty(n, dtype=np.float64)
-        for i in range(n):
-            x_i = x[i]
-            if x_i < l_origin:
-                out[i] = self.left.phi(l_origin - x_i)
-            elif x_i > r_origin:
-                out[i] = self.right.phi(x_i - r_origin)
-            else:
-                out[i] = 1.0
-        return out 
+    def __ndarray_call__(self, x):
+        return dual_survival(x, self.left.rate, self.left.shape, self.left_origin, 
+                                self.right.rate, self.right.shape, self.right_origin)
     
 cdef class CircularBoundaries(DualBoundaries):
-    cdef bint adjust_coords
+    cdef readonly bint adjust_coords
     
     def __init__(self, *args, adjust_coords=0): 
         super(CircularBoundaries, self).__init__(*args)
@@ -147,6 +223,9 @@ cdef class CircularBoundaries(DualBoundaries):
         return cls(LeftBound(left_scale, left_shape, left_origin), 
                    RightBound(right_scale, right_shape, right_origin), adjust_coords=adjust_coords)
 
+    def __reduce__(self):
+        return (_circular_boundaries, (self.left, self.right, self.adjust_coords))
+
     def __scalar_call__(self, double x):
         if self.adjust_coords:
             x = atan2(sin(x*pi/180), cos(x*pi/180))*180/pi
@@ -157,24 +236,13 @@ cdef class CircularBoundaries(DualBoundaries):
         else:
             return 1.0
     
-    def __ndarray_call__(self, np.ndarray[double, ndim=1] x):
-        cdef: 
-            Py_ssize_t i = 0
-            Py_ssize_t n = x.shape[0]
-            double x_i = 0
-            double l_origin = self.left_origin
-            double r_origin = self.right_origin
-            np.ndarray[double, ndim=1] out = np.empty(n, dtype=np.float64)
-    
+    def __ndarray_call__(self, x):
         if self.adjust_coords:
-            x = np.arctan2(np.sin(x*np.pi/180.0), np.cos(x*np.pi/180.0))*180.0/np.pi
-            
-        for i in range(n):
-            x_i = x[i]
-            if x_i < l_origin:
-                out[i] = self.left.phi(l_origin - x_i)
-            elif x_i > r_origin:
-                out[i] = self.right.phi(x_i - r_origin)
-            else:
-                out[i] = 1.0
-        return out 
+            x = wrap_degrees(x)
+        return dual_survival(x, self.left.rate, self.left.shape, self.left_origin, 
+                                self.right.rate, self.right.shape, self.right_origin)
+
+
+def _circular_boundaries(left, right, adjust_coords):
+    ''' unpickling helper; the constructor takes adjust_coords by keyword only '''
+    return CircularBoundaries(left, right, adjust_coords=adjust_coords)
@@ -2,13 +2,15 @@
 Defines the standard functions and properties of
 
 """
-import logging, os, operator
+import logging, os, operator, threading
 
 from math import sin, cos, atan2, pi
 from collections import OrderedDict
 import json
 import numpy as np
 
+from ...utils import instrumented, instruments
+
 class Model(object):
     '''The abstract class for a grounded semantics model
     
@@ -21,10 +23,97 @@ class Model(object):
     def __init__(self, name, components=[], graceful_failure=False):
         ''' instantiate this model with the specified name and components '''
         self.name = name
+        self._cache = None
+        self._log_space = False
+        self._dtype = np.dtype(np.float64)
+        self._parent = None
+        self.parent_indices = None
         self.components = components
-        self._lookup = {c.name:c for c in components}
         self.graceful_failure = graceful_failure
 
+    @property
+    def components(self):
+        return self._components
+
+    @components.setter
+    def components(self, components):
+        ''' replacing the components rebuilds the name lookups and drops cached results '''
+        self._components = components
+        self._parent = None
+        self.parent_indices = None
+        self.invalidate()
+
+    def subset(self, names):
+        '''
+        a view of this model restricted to some components, given by name or
+        by index. the view shares the component objects (nothing is parsed or
+        copied), normalizes over its own components only, and keeps the
+        model's modes (log space, caching, and for Lux the compiled engine and
+        candidate index, rebuilt over the subset). 
+        view.parent_indices maps the view's components back to this model.
+        '''
+        indices = np.atleast_1d(self.indices(names))
+        view = object.__new__(type(self))
+        ## the model's settings are shared; everything derived from the 
+        ## components is rebuilt for the view when its components are set
+        view.__dict__.update(self.__dict__)
+        if self._cache is not None:
+            view._cache = PosteriorCache(self._cache.maxsize, self._cache.resolution)
+        view.components = [self.components[i] for i in indices]
+        view._parent = self
+        view.parent_indices = indices
+        return view
+
+    def invalidate(self):
+        '''
+        drop everything derived from the components. call this after
+        changing the components (or their parameters) in place.
+        '''
+        self._lookup = {c.name:c for c in self.components}
+        self._names = [c.name for c in self.components]
+        self._name_index = {n:i for i, n in enumerate(self._names)}
+        if self._cache is not None:
+            self._cache.clear()
+
+    def use_cache(self, maxsize=2048, resolution=0.1):
+        '''
+        memoize predict, posterior and likelihood on the input rounded to
+        multiples of resolution, keeping the maxsize most recently used inputs.
+        every entry is one (K,) column, 8*K bytes; the default holds ~14MB 
+        for the shipped Lux. cached answers are the model's answer at the 
+        rounded input. use_cache(None) turns caching off.
+        '''
+        self._cache = PosteriorCache(maxsize, resolution) if maxsize else None
+
+    @property
+    def log_space(self):
+        ''' whether the model evaluates in log space (see use_log_space) '''
+        return self._log_space
+
+    def use_log_space(self, enabled=True, dtype=np.float64):
+        '''
+        evaluate in log space and normalize with log-sum-exp, so posteriors
+        stay finite (no 0/0 NaNs) for colors far out in every component's tails.
+        dtype=np.float32 keeps the (K, N) log-likelihoods of batched inputs in
+        single precision; single inputs stay float64.
+
+        error against the float64 linear path, wherever that path is finite
+        (measured on the shipped Lux over 20000 random colors):
+            float64:  |dp| < 1e-14, and relative error < 1e-12. the tails
+                      switch to a continued fraction only where the linear
+                      path has already underflowed
+            float32:  |dp| < 1e-6, and relative error < 2e-6 wherever p > 1e-6.
+                      this is the rounding of log-likelihoods in the hundreds
+        '''
+        self._log_space = enabled
+        self._dtype = np.dtype(dtype)
+        if self._cache is not None:
+            self._cache.clear()
+
+    def cache_stats(self):
+        ''' hits, misses, evictions, size and hit_rate; None without a cache '''
+        return self._cache.stats() if self._cache is not None else None
+
     @classmethod
     def from_json(cls, filename, ComponentClass):
         ''' accept filename and component class for insantiating 
@@ -37,13 +126,19 @@ class Model(object):
                               'parameters': parameters
                               }
                 }
+
+            older exports (e.g. lux_v0.json) map component names straight
+            to their parameters; those are accepted too.
         '''
         with open(filename) as fp:
             info = json.load(fp)
-            components = list(map(ComponentClass.from_dict, info['components']))
-            for i, c in enumerate(components):
-                c.index = i
-            return cls(info['name'], components)
+        if 'components' not in info:
+            info = {'name': os.path.splitext(os.path.basename(filename))[0],
+                    'components': [{'name': k, 'parameters': v} for k, v in info.items()]}
+        components = list(map(ComponentClass.from_dict, info['components']))
+        for i, c in enumerate(components):
+            c.index = i
+        return cls(info['name'], components)
     
     def __contains__(self, k):
         ''' test for membership '''
@@ -70,14 +165,13 @@ class Model(object):
             err_string = ""
         return "<Model>{}; {} components; {}".format(self.name, len(self), err_string)
 
+    @instrumented('model.predict')
     def predict(self, *datum):
         '''
         return component with highest probability
             e.g. argmax_component P(component, datum)
         '''
-        if len(datum) == 1 and isinstance(datum[0], (list,tuple)):
-            datum = datum[0]
-        p_vec = np.array([component(datum) for component in self.components])
+        p_vec = self._evaluate(self._datum(datum))
         try:
             return [self.components[i] for i in p_vec.argmax(axis=0)]
         except TypeError as e:  
@@ -87,25 +181,211 @@ class Model(object):
         '''
         return probability of the component given the datum 
             e.g. P(component | datum)
+        computed by likelihoods(), so the two always agree
         '''
         assert self[component_name]
-        p_vec = self.posterior(datum)
-        return p_vec[self._lookup[component_name].index]
+        p = self.likelihoods(datum, component_name)
+        return p if np.ndim(datum) == 2 else p[0]
 
+    def likelihoods(self, data, names):
+        '''
+        P(name | datum) for many (datum, name) pairs at once
+            data is (N, 3) (or one datum), names is (N,) names or component 
+            indices (or one of them); the two broadcast against each other.
+        
+        every distinct datum is evaluated and normalized once, however many
+        names it is paired with, and no Distribution is built. returns (N,)
+        '''
+        X = np.asarray(data, dtype=np.float64)
+        if X.ndim < 2:
+            ## one datum, passed on in whatever form evaluate takes it
+            indices = np.atleast_1d(self.indices(names))
+            inverse = np.zeros(len(indices), dtype=np.intp)
+            columns = np.asarray(self._evaluate(data))[:, None]
+        else:
+            X, rows, indices = self._pairs(X, names)
+            unique, inverse = np.unique(X, axis=0, return_inverse=True)
+            inverse = np.asarray(inverse).ravel()[rows]
+            columns = self._evaluate(unique)
+        numerators = columns[indices, inverse]
+        if self._log_space:
+            peak = columns.max(axis=0)
+            log_normalizers = peak + np.log(np.exp(columns - peak).sum(axis=0))
+            return np.exp(numerators - log_normalizers[inverse])
+        return numerators / columns.sum(axis=0)[inverse]
+
+    def joint(self, data, names):
+        '''
+        unnormalized P(name, datum) for (datum, name) pairs, broadcast like
+        likelihoods(). only the named components are evaluated, so this is 
+        the cheap way to compare names for a color when the normalizer 
+        is not needed. returns (N,)
+        '''
+        X, rows, indices = self._pairs(data, names)
+        return self.evaluate_pairs(X[rows], indices)
+
+    def evaluate_pairs(self, X, indices):
+        '''
+        unnormalized P(component indices[i], X[i]) for each i
+        subclasses with a compiled path override this
+        '''
+        return np.array([self.components[i](tuple(x)) for x, i in zip(X, indices)], dtype=np.float64)
+
+    def indices(self, names):
+        ''' component indices of names (ints are passed through) '''
+        names = np.asarray(names)
+        if names.dtype.kind in 'iu':
+            return names.astype(np.intp)
+        try:
+            return np.array([self._name_index[n] for n in names.ravel().tolist()], 
+                            dtype=np.intp).reshape(names.shape)
+        except KeyError:
+            raise OutOfVocabularyException
+
+    def _pairs(self, data, names):
+        X = np.asarray(data, dtype=np.float64)
+        if X.ndim == 1:
+            X = X[None, :]
+        rows, indices = np.broadcast_arrays(np.arange(len(X)), np.atleast_1d(self.indices(names)))
+        return X, rows, indices
+
+    @instrumented('model.posterior')
     def posterior(self, *datum): 
-        if len(datum) == 1 and isinstance(datum[0], (list,tuple)):
-            datum = datum[0]
-        p_vec = np.array([component(datum) for component in self.components])
+        p_vec = self._evaluate(self._datum(datum))
+        if self._log_space:
+            return self._distribution(_exp_normalize(p_vec))
         try:
             p_vec /= p_vec.sum(axis=0, keepdims=True)
         except TypeError as e:
             p_vec /= p_vec.sum()
-        return Distribution([c.name for c in self.components], p_vec)
+        return self._distribution(p_vec)
         # if neat:
         #     return {c.name:p for c,p in zip(self.components, p_vec)}
         # else:
         #     return p_vec
+
+    def evaluate(self, datum):
+        '''
+        unnormalized P(component, datum) for every component
+            shape (K,) for a single datum, (K, N) for a batch of N
+        subclasses with a compiled path override this
+        '''
+        return np.array([component(datum) for component in self.components])
+
+    def log_evaluate(self, datum, dtype=np.float64):
+        '''
+        log of evaluate(datum)
+        subclasses override this to stay finite where evaluate underflows
+        '''
+        with np.errstate(divide='ignore'):
+            return np.log(self.evaluate(datum)).astype(dtype, copy=False)
+
+    def _evaluate(self, datum):
+        '''
+        evaluate (or log_evaluate in log space) through the cache when there
+        is one; the result is always a fresh array
+        '''
+        instruments.count('model.rows', len(datum) if np.ndim(datum) == 2 else 1)
+        evaluate = self.evaluate
+        if self._log_space:
+            def evaluate(datum):
+                return self.log_evaluate(datum, self._dtype if np.ndim(datum) == 2 else np.float64)
+        if self._cache is None:
+            return evaluate(datum)
+        return self._cache.evaluate(evaluate, datum)
+
+    def _distribution(self, p_vec):
+        ''' wrap a (K,) or (K, N) posterior without copying it '''
+        if np.ndim(p_vec) == 2:
+            return BatchDistribution(self._names, p_vec, self._name_index)
+        return Distribution(self._names, p_vec, self._name_index)
+
+    @staticmethod
+    def _datum(datum):
+        ''' accept f(h, s, v), f((h, s, v)) and f(matrix) '''
+        if len(datum) == 1 and isinstance(datum[0], (list, tuple, np.ndarray)):
+            datum = datum[0]
+        return datum
     
+def _exp_normalize(log_p):
+    ''' in-place softmax down the component axis of a (K,) or (K, N) array '''
+    log_p -= log_p.max(axis=0, keepdims=True)
+    np.exp(log_p, out=log_p)
+    log_p /= log_p.sum(axis=0, keepdims=True)
+    return log_p
+
+class PosteriorCache(object):
+    '''
+    bounded LRU of evaluate() columns keyed on the input rounded to resolution.
+    a batch is deduplicated, and only its uncached rows are evaluated, in one call.
+    '''
+    def __init__(self, maxsize=2048, resolution=0.1):
+        self.maxsize = maxsize
+        self.resolution = resolution
+        self._columns = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def clear(self):
+        with self._lock:
+            self._columns.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'size': len(self._columns), 'maxsize': self.maxsize,
+                    'nbytes': sum(column.nbytes for column in self._columns.values()),
+                    'hit_rate': self.hits / float(total) if total else 0.}
+
+    def _get(self, keys):
+        ''' the cached column of every key (None where missing), counting hits and misses '''
+        with self._lock:
+            columns = [self._columns.get(key) for key in keys]
+            for key, column in zip(keys, columns):
+                if column is not None:
+                    self._columns.move_to_end(key)
+            found = sum(column is not None for column in columns)
+            self.hits += found
+            self.misses += len(keys) - found
+        instruments.count('cache.hits', found)
+        instruments.count('cache.misses', len(keys) - found)
+        return columns
+
+    def _put(self, key, column):
+        with self._lock:
+            self._columns[key] = column
+            self._columns.move_to_end(key)
+            while len(self._columns) > self.maxsize:
+                self._columns.popitem(last=False)
+                self.evictions += 1
+
+    def evaluate(self, evaluate, datum):
+        steps = np.round(np.asarray(datum, dtype=np.float64) / self.resolution)
+        if steps.ndim < 2:
+            key = tuple(steps.ravel().tolist())
+            column, = self._get([key])
+            if column is None:
+                rounded = steps * self.resolution
+                column = np.asarray(evaluate(tuple(rounded) if rounded.ndim else float(rounded)))
+                self._put(key, column)
+            return column.copy()
+
+        unique, inverse = np.unique(steps, axis=0, return_inverse=True)
+        keys = [tuple(row) for row in unique.tolist()]
+        columns = self._get(keys)
+        missing = [i for i, column in enumerate(columns) if column is None]
+        if missing:
+            fresh = np.asarray(evaluate(unique[missing] * self.resolution))
+            for j, i in enumerate(missing):
+                columns[i] = fresh[:, j].copy()
+                self._put(keys[i], columns[i])
+        ## repeats within the batch are answered by its own first occurrence
+        with self._lock:
+            self.hits += len(steps) - len(unique)
+        instruments.count('cache.hits', len(steps) - len(unique))
+        return np.stack(columns, axis=1)[:, np.asarray(inverse).ravel()]
+
 class Component(object):
     def __init__(self, name, *args, **kwargs):
         self.name = name
@@ -136,25 +416,111 @@ class Component(object):
         raise NotImplementedError
         
 class Distribution(object):
-    def __init__(self, names, numbers):
-        self.names = set(names)
+    '''
+    P(component | datum) for a single datum.
+
+    Wraps the probability vector and the model's name index as they are; the
+    name->probability dict (lookup) and the sorted list (sortd) are only built
+    when they are asked for.  top5, top10, ... use a partial selection.
+    '''
+    def __init__(self, names, numbers, index=None):
+        self.names = names
         self.numbers = numbers
-        self.lookup = dict(zip(names, numbers))
-        self.sortd = sorted(self.lookup.items(), key=lambda x: x[1], reverse=True)
-        
+        self.index = index if index is not None else {n:i for i, n in enumerate(names)}
+
+    @property
+    def lookup(self):
+        if '_lookup' not in self.__dict__:
+            self._lookup = dict(zip(self.names, self.numbers))
+        return self._lookup
+
+    @property
+    def sortd(self):
+        if '_sortd' not in self.__dict__:
+            order = np.argsort(-self.numbers, kind='mergesort')
+            self._sortd = [(self.names[i], self.numbers[i]) for i in order]
+        return self._sortd
+
+    def top_indices(self, n):
+        ''' indices of the n most probable components, most probable first '''
+        n = min(n, len(self.numbers))
+        if n == len(self.numbers):
+            return np.argsort(-self.numbers, kind='mergesort')
+        top = np.argpartition(-self.numbers, n-1)[:n]
+        return top[np.argsort(-self.numbers[top], kind='mergesort')]
+
+    def top(self, n):
+        return OrderedDict((self.names[i], self.numbers[i]) for i in self.top_indices(n))
+
     def __getattr__(self, key):
-        if key in self.__dict__:
-            return self.__dict__[key]
-        elif key in self.names:
-            return self.lookup[key]
+        index = self.__dict__.get('index', {})
+        if key[:1] != '_' and key in index:
+            return self.numbers[index[key]]
         elif 'top' == key[:3] and key[3:].isdigit():
-            return dict(self.sortd[:int(key[3:])])
-        else:
-            return self.lookup
-                
+            return self.top(int(key[3:]))
+        raise AttributeError(key)
                 
     def __getitem__(self, key):
-        return self.lookup[key]
+        if isinstance(key, str):
+            return self.numbers[self.index[key]]
+        return self.numbers[key]
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.numbers, dtype=dtype)
+
+
+class BatchDistribution(object):
+    '''
+    P(component | datum) for N data; numbers is the (K, N) posterior matrix.
+
+    batch[i] is the Distribution of the i-th datum (a view of column i) and
+    batch[name] or batch.name is that component's row across the batch.
+    '''
+    def __init__(self, names, numbers, index=None):
+        self.names = names
+        self.numbers = numbers
+        self.index = index if index is not None else {n:i for i, n in enumerate(names)}
+
+    def top_indices(self, n):
+        ''' (n, N) indices of the n most probable components per datum '''
+        n = min(n, self.numbers.shape[0])
+        columns = np.arange(self.numbers.shape[1])[None, :]
+        top = np.argpartition(-self.numbers, n-1, axis=0)[:n]
+        order = np.argsort(-self.numbers[top, columns], axis=0, kind='mergesort')
+        return top[order, columns]
+
+    def top(self, n):
+        return [OrderedDict((self.names[i], self.numbers[i, j]) for i in top)
+                for j, top in enumerate(self.top_indices(n).T)]
+
+    def argmax(self):
+        return self.numbers.argmax(axis=0)
+
+    def __getattr__(self, key):
+        index = self.__dict__.get('index', {})
+        if key[:1] != '_' and key in index:
+            return self.numbers[index[key]]
+        elif 'top' == key[:3] and key[3:].isdigit():
+            return self.top(int(key[3:]))
+        raise AttributeError(key)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.numbers[self.index[key]]
+        return Distribution(self.names, self.numbers[:, key], self.index)
+
+    def __len__(self):
+        return self.numbers.shape[1]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.numbers, dtype=dtype)
 
 class OutOfVocabularyException(Exception):
     pass
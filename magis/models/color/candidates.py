@@ -0,0 +1,163 @@
+"""
+Candidate index for Lux.
+
+At any one color most of the ~830 labels are far out in at least one of their
+gamma tails and contribute next to nothing.  The index divides HSV space into
+a coarse grid of boxes.  Because every label's density is a product of three
+one-dimensional plateau-and-tails functions, its largest and smallest value
+over a box is the product of the per-dimension extremes, and each of those
+sits either on the plateau or at an edge of the box.
+
+For each box the index keeps the labels whose largest value in the box is at
+least epsilon times the largest smallest-value of any label in that box; the
+others are never evaluated there and get probability 0.  What was dropped is
+bounded per box by
+
+    dropped mass <= U / (L + U)
+
+where U is the summed upper bounds of the dropped labels and L the summed
+lower bounds of the kept labels, so the bound holds for every point in the box
+(the dropped share D / (K + D) grows with D and shrinks with K, and K >= L,
+D <= U; the dropped labels' own lower bounds can not go into L).
+Rows outside the indexed range are evaluated against every label.
+"""
+import numpy as np
+
+from .. import dual_survival
+
+## relative density below which a label is dropped from a box
+DEFAULT_EPSILON = 1e-6
+
+
+def _extremes(params, a, b):
+    '''
+    largest and smallest value of each component's dual_survival on each
+    interval [a, b]; params is (6, K), a and b are (C,). returns two (C, K)
+    '''
+    params = [p[None, :] for p in params]
+    a, b = a[:, None], b[:, None]
+    ## the function is 1 on [left origin, right origin] and monotone outside it,
+    ## so the largest value is at the point of the interval closest to the plateau
+    upper = dual_survival(np.clip(params[2], a, b), *params)
+    lower = np.minimum(dual_survival(a, *params), dual_survival(b, *params))
+    return upper, lower
+
+
+class CandidateIndex(object):
+    '''
+    engine:     the LuxEngine to index
+    epsilon:    relative density below which a label is dropped from a box
+    hue_step, sv_step:  box widths; hue is indexed on [-180, 360], s and v on [0, 100]
+    '''
+    HUE_RANGE = (-180., 360.)
+    SV_RANGE = (0., 100.)
+
+    def __init__(self, engine, epsilon=DEFAULT_EPSILON, hue_step=10., sv_step=10.):
+        self.engine = engine
+        self.epsilon = epsilon
+        self.edges = [np.arange(self.HUE_RANGE[0], self.HUE_RANGE[1] + hue_step/2, hue_step),
+                      np.arange(self.SV_RANGE[0], self.SV_RANGE[1] + sv_step/2, sv_step),
+                      np.arange(self.SV_RANGE[0], self.SV_RANGE[1] + sv_step/2, sv_step)]
+        self.shape = tuple(len(e) - 1 for e in self.edges)
+        self._build()
+
+    def _hue_extremes(self):
+        ''' per-box hue extremes, following the engine's wrap for adjusted components '''
+        engine = self.engine
+        a, b = self.edges[0][:-1], self.edges[0][1:]
+        upper, lower = _extremes(engine.hue, a, b)
+        if engine.hue_adjust.any():
+            adjusted = engine.hue[:, engine.hue_adjust]
+            ## boxes never straddle +-180, so wrapping is a shift of the whole box
+            shift = np.where(a >= 180., -360., 0.)
+            w_upper, w_lower = _extremes(adjusted, a + shift, b + shift)
+            ## a box edge on the seam can wrap to either side of it
+            seam = np.isclose(np.abs(a + shift), 180.) | np.isclose(np.abs(b + shift), 180.)
+            if seam.any():
+                at_seam = dual_survival(np.array([[-180.], [180.]]), *(p[None, :] for p in adjusted))
+                w_upper[seam] = np.maximum(w_upper[seam], at_seam.max(axis=0))
+                w_lower[seam] = np.minimum(w_lower[seam], at_seam.min(axis=0))
+            upper[:, engine.hue_adjust] = w_upper
+            lower[:, engine.hue_adjust] = w_lower
+        return upper, lower
+
+    def _build(self):
+        engine = self.engine
+        hue_upper, hue_lower = self._hue_extremes()
+        sat_upper, sat_lower = _extremes(engine.sat, self.edges[1][:-1], self.edges[1][1:])
+        val_upper, val_lower = _extremes(engine.val, self.edges[2][:-1], self.edges[2][1:])
+        sv_upper = (sat_upper[:, None, :] * val_upper[None, :, :]).reshape(-1, len(engine))
+        sv_lower = (sat_lower[:, None, :] * val_lower[None, :, :]).reshape(-1, len(engine))
+
+        indices, counts, bounds = [], [], []
+        for i in range(self.shape[0]):
+            ## one hue slice of boxes at a time keeps the (boxes, K) temporaries small
+            upper = sv_upper * (hue_upper[i] * engine.availability)
+            lower = sv_lower * (hue_lower[i] * engine.availability)
+            keep = (upper >= self.epsilon * lower.max(axis=1, keepdims=True)) & (upper > 0)
+            dropped = np.where(keep, 0., upper).sum(axis=1)
+            total = np.where(keep, lower, 0.).sum(axis=1) + dropped
+            with np.errstate(invalid='ignore', divide='ignore'):
+                bounds.append(np.where(dropped > 0, dropped / total, 0.))
+            rows, cols = np.nonzero(keep)
+            indices.append(cols.astype(np.int32))
+            counts.append(np.bincount(rows, minlength=len(keep)))
+
+        self.indices = np.concatenate(indices)
+        self.indptr = np.zeros(np.prod(self.shape) + 1, dtype=np.int64)
+        np.cumsum(np.concatenate(counts), out=self.indptr[1:])
+        self.bounds = np.nan_to_num(np.concatenate(bounds), nan=1.0)
+
+    @property
+    def mean_candidates(self):
+        ''' average number of labels evaluated per box '''
+        return len(self.indices) / float(len(self.indptr) - 1)
+
+    @property
+    def max_dropped_mass(self):
+        return float(self.bounds.max())
+
+    def cells(self, X):
+        ''' flat box number of every row, -1 for rows outside the indexed range '''
+        X = np.asarray(X, dtype=np.float64)
+        cell = np.zeros(len(X), dtype=np.int64)
+        inside = np.ones(len(X), dtype=bool)
+        for d, edges in enumerate(self.edges):
+            x = X[:, d]
+            inside &= (x >= edges[0]) & (x <= edges[-1])
+            i = np.clip(np.floor((x - edges[0]) / (edges[1] - edges[0])), 0, self.shape[d] - 1)
+            cell = cell * self.shape[d] + np.nan_to_num(i).astype(np.int64)
+        cell[~inside] = -1
+        return cell
+
+    def candidates(self, cell):
+        return self.indices[self.indptr[cell]:self.indptr[cell+1]]
+
+    def likelihoods(self, X):
+        ''' LuxEngine.likelihoods with the dropped labels left at 0; (N, 3) -> (K, N) '''
+        return self._evaluate(self.engine.likelihoods, X, 0., np.float64)
+
+    def log_likelihoods(self, X, dtype=np.float64):
+        ''' LuxEngine.log_likelihoods with the dropped labels left at -inf '''
+        def log_likelihoods(X, components=None):
+            return self.engine.log_likelihoods(X, components, dtype)
+        return self._evaluate(log_likelihoods, X, -np.inf, dtype)
+
+    def _evaluate(self, likelihoods, X, fill, dtype):
+        X = np.asarray(X, dtype=np.float64)
+        out = np.full((len(self.engine), len(X)), fill, dtype=dtype)
+        cells = self.cells(X)
+        order = np.argsort(cells, kind='stable')
+        boxes, starts = np.unique(cells[order], return_index=True)
+        for cell, rows in zip(boxes, np.split(order, starts[1:])):
+            if cell < 0:
+                out[:, rows] = likelihoods(X[rows])
+            else:
+                components = self.candidates(cell)
+                out[np.ix_(components, rows)] = likelihoods(X[rows], components)
+        return out
+
+    def dropped_mass(self, X):
+        ''' (N,) upper bound on the posterior mass left out for each row '''
+        cells = self.cells(X)
+        return np.where(cells >= 0, self.bounds[np.maximum(cells, 0)], 0.)
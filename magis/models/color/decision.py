@@ -0,0 +1,134 @@
+"""
+Decision maps: which label wins, and how confidently, over a grid of colors.
+
+A grid is given per HSV axis as a fixed value, a (start, stop, num) linspace
+or an explicit array of values.  DecisionMaps.build walks the grid in flat
+chunks sized so that the (K, chunk) posterior stays under max_memory.  Each
+chunk's results go straight into the outputs, so a high-resolution map never
+holds more than one chunk of posteriors.
+
+Layout of a maps directory (the same arrays are kept in memory without one):
+    meta.json       model name, component names and the three axes
+    argmax.npy      (H, S, V) int16, index of the most probable component
+    max_prob.npy    (H, S, V) float32, its posterior probability
+    entropy.npy     (H, S, V) float32, posterior entropy in nats
+
+    maps = DecisionMaps.build(lux, hue=(0, 360, 721), saturation=(0, 100, 201),
+                              value=[30, 50, 70], path='maps/')
+    maps.slice(value=50.)['argmax']          # (721, 201)
+    magis.visualize.color_predictions.Plot.decision_map(maps, value=50.)
+"""
+import os
+import json
+
+import numpy as np
+from tqdm import tqdm
+
+AXES = ('hue', 'saturation', 'value')
+## (K, chunk) float64 arrays alive at once while a chunk is evaluated: the
+## likelihood pass makes several per dimension (masks, gathered parameters,
+## gdtrc results), then come the posterior and the entropy terms
+TEMPORARIES = 12
+OUTPUTS = (('argmax', np.int16), ('max_prob', np.float32), ('entropy', np.float32))
+
+
+def grid_axis(spec):
+    ''' a fixed value, (start, stop, num) or a sequence of values -> 1-d float64 array '''
+    if np.ndim(spec) == 0:
+        return np.array([spec], dtype=np.float64)
+    if isinstance(spec, tuple) and len(spec) == 3:
+        start, stop, num = spec
+        return np.linspace(start, stop, int(num))
+    return np.asarray(spec, dtype=np.float64)
+
+
+class DecisionMaps(object):
+    def __init__(self, names, axes, argmax, max_prob, entropy, model_name=None):
+        self.names = list(names)
+        self.axes = [np.asarray(a, dtype=np.float64) for a in axes]
+        self.argmax = argmax
+        self.max_prob = max_prob
+        self.entropy = entropy
+        self.model_name = model_name
+
+    @property
+    def shape(self):
+        return tuple(len(a) for a in self.axes)
+
+    @classmethod
+    def build(cls, model, hue, saturation, value, path=None, max_memory=64 << 20, progress=True):
+        '''
+        evaluate model.posterior over the grid, chunk by chunk.
+
+        path:        directory for memory-mapped outputs; None keeps them in memory
+        max_memory:  bytes of working memory for one chunk; chunks are sized for
+                     TEMPORARIES (K, chunk) float64 arrays, which covers the Lux
+                     posterior path. the outputs are not counted
+        the posterior goes through the model's current modes (cache, log
+        space, candidate index, subsets)
+        '''
+        axes = [grid_axis(spec) for spec in (hue, saturation, value)]
+        shape = tuple(len(a) for a in axes)
+        total = int(np.prod(shape))
+        if path is not None and not os.path.exists(path):
+            os.makedirs(path)
+
+        outputs = {}
+        for name, dtype in OUTPUTS:
+            if path is None:
+                outputs[name] = np.empty(shape, dtype=dtype)
+            else:
+                outputs[name] = np.lib.format.open_memmap(os.path.join(path, name + '.npy'),
+                                                          mode='w+', dtype=dtype, shape=shape)
+        flat = dict((name, out.reshape(-1)) for name, out in outputs.items())
+
+        chunk = max(1, int(max_memory // (TEMPORARIES * 8 * max(len(model), 1))))
+        starts = range(0, total, chunk)
+        for start in tqdm(starts, desc='decision maps', disable=not progress):
+            stop = min(start + chunk, total)
+            h, s, v = np.unravel_index(np.arange(start, stop), shape)
+            X = np.stack([axes[0][h], axes[1][s], axes[2][v]], axis=1)
+            p_vec = np.asarray(model.posterior(X))
+            best = p_vec.argmax(axis=0)
+            flat['argmax'][start:stop] = best
+            flat['max_prob'][start:stop] = p_vec[best, np.arange(stop - start)]
+            plogp = np.log(p_vec, out=np.zeros_like(p_vec), where=p_vec > 0)
+            plogp *= p_vec
+            flat['entropy'][start:stop] = -plogp.sum(axis=0)
+
+        if path is not None:
+            for out in outputs.values():
+                out.flush()
+            with open(os.path.join(path, 'meta.json'), 'w') as fp:
+                json.dump({'name': model.name, 'names': [c.name for c in model.components],
+                           'axes': [a.tolist() for a in axes]}, fp)
+        return cls([c.name for c in model.components], axes,
+                   outputs['argmax'], outputs['max_prob'], outputs['entropy'], model.name)
+
+    @classmethod
+    def load(cls, path):
+        ''' memory-map built maps read-only '''
+        with open(os.path.join(path, 'meta.json')) as fp:
+            meta = json.load(fp)
+        arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name, _ in OUTPUTS]
+        return cls(meta['names'], meta['axes'], *arrays, model_name=meta['name'])
+
+    def slice(self, hue=None, saturation=None, value=None):
+        '''
+        the maps with some axes fixed at their grid point nearest to the given
+        value; e.g. slice(value=50.) gives (H, S) maps. returns a dict of the
+        three maps, the remaining 'axes' and their names ('dims')
+        '''
+        index = []
+        remaining = []
+        dims = []
+        for name, axis, fixed in zip(AXES, self.axes, (hue, saturation, value)):
+            if fixed is None:
+                index.append(slice(None))
+                remaining.append(axis)
+                dims.append(name)
+            else:
+                index.append(int(np.abs(axis - fixed).argmin()))
+        index = tuple(index)
+        return {'argmax': np.asarray(self.argmax[index]), 'max_prob': np.asarray(self.max_prob[index]),
+                'entropy': np.asarray(self.entropy[index]), 'axes': remaining, 'dims': dims}
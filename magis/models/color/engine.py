@@ -0,0 +1,142 @@
+"""
+Compiled evaluation for Lux.
+
+The per-component path calls three boundary objects and a prior multiply for
+each of the ~830 color labels.  The engine packs every component's boundary
+parameters into contiguous (6, K) arrays once, and then computes the whole
+(K, N) likelihood matrix for a batch with one dual_survival pass per dimension.
+"""
+import numpy as np
+
+from .. import dual_survival, log_dual_survival, wrap_degrees
+
+
+class LuxEngine(object):
+    '''
+    Struct-of-arrays form of a Lux model.
+
+    hue, sat, val:  (6, K) float64 arrays; the rows are the boundary parameters
+                    (left rate, left shape, left origin, right rate, right shape, right origin)
+    hue_adjust:     (K,) bool, which components wrap the hue onto (-180, 180]
+    availability:   (K,) float64, the prior of each component
+    '''
+    def __init__(self, names, hue, sat, val, hue_adjust, availability):
+        self.names = list(names)
+        self.hue = np.ascontiguousarray(hue, dtype=np.float64)
+        self.sat = np.ascontiguousarray(sat, dtype=np.float64)
+        self.val = np.ascontiguousarray(val, dtype=np.float64)
+        self.hue_adjust = np.ascontiguousarray(hue_adjust, dtype=bool)
+        self.availability = np.ascontiguousarray(availability, dtype=np.float64)
+
+    @classmethod
+    def from_model(cls, model):
+        ''' pack the parameters of already loaded components '''
+        components = model.components
+        return cls(names=[c.name for c in components],
+                   hue=np.array([c.hue_model.parameters for c in components]).T,
+                   sat=np.array([c.sat_model.parameters for c in components]).T,
+                   val=np.array([c.val_model.parameters for c in components]).T,
+                   hue_adjust=np.array([c.hue_model.adjust_coords for c in components]),
+                   availability=np.array([c.availability for c in components]))
+
+    @classmethod
+    def from_parameters(cls, names, parameters, hue_adjust, availability):
+        '''
+        pack parameters as they are written (storage.compile_model): a (K, 3, 6) 
+        array in storage.PARAMETER_ORDER, where the hue tails are rates and the
+        saturation and value tails scales
+        '''
+        parameters = np.asarray(parameters, dtype=np.float64)
+        hue, sat, val = (parameters[:, i, :].T.copy() for i in range(3))
+        for dim in (sat, val):
+            dim[[0, 3]] = 1.0 / dim[[0, 3]]
+        return cls(names, hue, sat, val, hue_adjust, availability)
+
+    def __len__(self):
+        return len(self.names)
+
+    def subset(self, indices):
+        ''' the engine of just these components, in this order '''
+        return LuxEngine(names=[self.names[i] for i in indices],
+                         hue=self.hue[:, indices], sat=self.sat[:, indices], val=self.val[:, indices],
+                         hue_adjust=self.hue_adjust[indices], availability=self.availability[indices])
+
+    @staticmethod
+    def _dimension(x, params):
+        ''' x is (N,) or (K, N); params are broadcast down the component axis '''
+        return dual_survival(x, *(p[:, None] for p in params))
+
+    def likelihoods(self, X, components=None):
+        '''
+        unnormalized P(component, datum) for a batch
+            X is (N, 3) with columns (h, s, v); returns (K, N)
+            with components (an index array), only those rows are computed
+        '''
+        X = np.asarray(X, dtype=np.float64)
+        hue, sat, val, hue_adjust, availability = self._select(components)
+        h, s, v = self._columns(X, hue_adjust)
+        out = self._dimension(h, hue)
+        out *= self._dimension(s, sat)
+        out *= self._dimension(v, val)
+        out *= availability[:, None]
+        return out
+
+    def pair_likelihoods(self, X, components):
+        ''' likelihoods of component components[i] at X[i] only; (N, 3), (N,) -> (N,) '''
+        X = np.asarray(X, dtype=np.float64)
+        hue, sat, val, hue_adjust, availability = self._select(components)
+        h = np.where(hue_adjust, wrap_degrees(X[:, 0]), X[:, 0])
+        out = dual_survival(h, *hue)
+        out *= dual_survival(X[:, 1], *sat)
+        out *= dual_survival(X[:, 2], *val)
+        out *= availability
+        return out
+
+    def log_likelihoods(self, X, components=None, dtype=np.float64, chunk=4096):
+        '''
+        log of likelihoods(X), computed per dimension in log space so that it 
+        stays finite far out in the tails. the (K, N) result is dtype (float32 
+        halves it); rows are processed chunk at a time, so the float64 
+        temporaries never exceed (K, chunk).
+        '''
+        X = np.asarray(X, dtype=np.float64)
+        hue, sat, val, hue_adjust, availability = self._select(components)
+        log_availability = np.log(availability)[:, None]
+        out = np.empty((hue.shape[1], len(X)), dtype=dtype)
+        for start in range(0, len(X), chunk):
+            h, s, v = self._columns(X[start:start+chunk], hue_adjust)
+            block = log_dual_survival(h, *(p[:, None] for p in hue))
+            block += log_dual_survival(s, *(p[:, None] for p in sat))
+            block += log_dual_survival(v, *(p[:, None] for p in val))
+            block += log_availability
+            out[:, start:start+chunk] = block
+        return out
+
+    def _select(self, components):
+        if components is None:
+            return self.hue, self.sat, self.val, self.hue_adjust, self.availability
+        return (self.hue[:, components], self.sat[:, components], self.val[:, components],
+                self.hue_adjust[components], self.availability[components])
+
+    @staticmethod
+    def _columns(X, hue_adjust):
+        h, s, v = X[:, 0], X[:, 1], X[:, 2]
+        ## the wrap is the same for every adjusted component, so do it once
+        if hue_adjust.any():
+            h = np.where(hue_adjust[:, None], wrap_degrees(h)[None, :], h[None, :])
+        return h, s, v
+
+    def evaluate(self, datum):
+        ''' same shapes as Model.evaluate: (K,) for one datum, (K, N) for a batch '''
+        X = np.asarray(datum, dtype=np.float64)
+        if X.ndim == 1:
+            return self.likelihoods(X[None, :])[:, 0]
+        return self.likelihoods(X)
+
+    def posterior(self, datum):
+        p_vec = self.evaluate(datum)
+        p_vec /= p_vec.sum(axis=0, keepdims=True)
+        return p_vec
+
+    def argmax(self, datum):
+        return self.evaluate(datum).argmax(axis=0)
@@ -0,0 +1,195 @@
+"""
+Estimate Lux parameters from the XKCD corpus.
+
+Every color label is fit on its own, one dimension at a time, so the ~830
+labels are independent jobs.  fit() sends them to a process pool and writes
+one checkpoint file per finished label; a restarted run skips the labels that
+already have one fit on the same data.  The result has the same layout as assets/lux.json.
+
+Each dimension is modelled as a normalized density: a flat plateau on
+[mulower, muupper] with gamma survival tails on both sides,
+
+    f(x) = phi(x) / Z,   Z = (muupper - mulower) + shapelower*scalelower + shapeupper*scaleupper
+
+(the area under a gamma survival function is the mean of the gamma), and the
+six parameters are found by maximum likelihood over all of the label's rows
+with one vectorized dual_survival call per evaluation.  With these densities,
+P(label | x) is proportional to P(label) * phi_h * phi_s * phi_v / (Z_h Z_s Z_v),
+so the availability written out is P(label) / (Z_h Z_s Z_v).
+
+The loader reads the hue tails differently from saturation and value:
+CircularBoundaries.from_parameters takes the hue 'scalelower'/'scaleupper'
+entries as gamma rates (that is how the shipped files are read), while
+DualBoundaries.from_parameters takes scales.  The fitter works in scales
+throughout and writes the hue tails as rates (to_written), so a fitted
+file loads back through Lux as the densities that were fit.
+"""
+import os
+import json
+import hashlib
+import multiprocessing
+
+import numpy as np
+from scipy.optimize import minimize
+from tqdm import tqdm
+
+from .. import dual_survival
+
+## keep log-likelihoods finite for rows far out in a tail
+_FLOOR = 1e-300
+
+## checkpoints of another format are refit (1 wrote the hue tails as scales)
+CHECKPOINT_FORMAT = 2
+
+
+def _unpack(theta):
+    ''' unconstrained vector -> (mulower, muupper, scalelower, shapelower, scaleupper, shapeupper) '''
+    mulower, log_width, log_scale_l, log_shape_l, log_scale_u, log_shape_u = theta
+    return (mulower, mulower + np.exp(log_width), np.exp(log_scale_l), np.exp(log_shape_l),
+            np.exp(log_scale_u), np.exp(log_shape_u))
+
+
+def negative_log_likelihood(theta, x):
+    mulower, muupper, scale_l, shape_l, scale_u, shape_u = _unpack(theta)
+    phi = dual_survival(x, 1.0/scale_l, shape_l, mulower, 1.0/scale_u, shape_u, muupper)
+    Z = (muupper - mulower) + shape_l*scale_l + shape_u*scale_u
+    return -(np.log(np.maximum(phi, _FLOOR)).sum() - len(x) * np.log(Z))
+
+
+def fit_dimension(x):
+    ''' maximum likelihood plateau-and-tails parameters for one dimension '''
+    x = np.asarray(x, dtype=np.float64)
+    q1, q3 = np.percentile(x, [25, 75])
+    spread = max(q3 - q1, 1.0)
+    start = np.array([q1, np.log(spread), np.log(spread/4), 0.0, np.log(spread/4), 0.0])
+    bounds = [(None, None), (-10, np.log(400)), 
+              (np.log(1e-3), np.log(1e3)), (np.log(0.1), np.log(50)),
+              (np.log(1e-3), np.log(1e3)), (np.log(0.1), np.log(50))]
+    result = minimize(negative_log_likelihood, start, args=(x,), method='L-BFGS-B', bounds=bounds)
+    mulower, muupper, scale_l, shape_l, scale_u, shape_u = _unpack(result.x)
+    return {'mulower': float(mulower), 'muupper': float(muupper),
+            'scalelower': float(scale_l), 'shapelower': float(shape_l),
+            'scaleupper': float(scale_u), 'shapeupper': float(shape_u)}
+
+
+def normalizer(parameters):
+    ''' Z of one fitted dimension '''
+    return ((parameters['muupper'] - parameters['mulower']) +
+            parameters['shapelower'] * parameters['scalelower'] +
+            parameters['shapeupper'] * parameters['scaleupper'])
+
+
+def to_written(parameters, hue=False):
+    ''' one fitted dimension in the form the Lux loader reads it (hue tails as rates) '''
+    if not hue:
+        return dict(parameters)
+    written = dict(parameters)
+    written['scalelower'] = 1.0 / parameters['scalelower']
+    written['scaleupper'] = 1.0 / parameters['scaleupper']
+    return written
+
+
+def fit_component(job):
+    '''
+    job is (name, rows, prior): the label's (n, 3) scaled hsv rows and its
+    share of the data. returns (name, parameters) in the lux.json layout.
+    '''
+    name, X, prior = job
+    X = np.asarray(X, dtype=np.float64)
+    ## the corpus moves a label's hues onto (-180, 180] exactly when that wraps around red
+    hue_adjust = bool((X[:, 0] < 0).any())
+    dims = [fit_dimension(X[:, i]) for i in range(3)]
+    Z = np.prod([normalizer(dim) for dim in dims])
+    dims = [to_written(dim, hue=(i == 0)) for i, dim in enumerate(dims)]
+    return name, {'availability': float(prior / Z), 'hue_adjust': hue_adjust, 'parameters': dims}
+
+
+def _checkpoint_file(checkpoint_dir, name):
+    return os.path.join(checkpoint_dir, hashlib.sha1(name.encode('utf8')).hexdigest() + '.json')
+
+
+def data_fingerprint(split, rows):
+    '''
+    hash of the split and of every label's rows. a label's availability 
+    depends on the whole split, so any change to the data refits every label
+    '''
+    digest = hashlib.sha1('{}:{}'.format(split, CHECKPOINT_FORMAT).encode('utf8'))
+    for label in sorted(rows):
+        digest.update(label.encode('utf8'))
+        digest.update(np.ascontiguousarray(rows[label], dtype=np.float64).view(np.uint8))
+    return digest.hexdigest()
+
+
+def _save_checkpoint(checkpoint_dir, name, parameters, fingerprint):
+    target = _checkpoint_file(checkpoint_dir, name)
+    with open(target + '.tmp', 'w') as fp:
+        json.dump({'name': name, 'parameters': parameters, 'format': CHECKPOINT_FORMAT,
+                   'data': fingerprint}, fp)
+    os.rename(target + '.tmp', target)
+
+
+def _load_checkpoint(checkpoint_dir, name, fingerprint):
+    try:
+        with open(_checkpoint_file(checkpoint_dir, name)) as fp:
+            checkpoint = json.load(fp)
+        if checkpoint.get('format') != CHECKPOINT_FORMAT or checkpoint.get('data') != fingerprint:
+            return None
+        return checkpoint['parameters']
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def fit(dataset, split='train', workers=1, checkpoint_dir=None, output=None, model_name='Lux'):
+    '''
+    fit every color in a loaded xkcd Dataset and return the lux.json dict.
+
+    workers:        processes to fit with (None for one per core)
+    checkpoint_dir: per-color results go here as they finish; labels that
+                    already have a checkpoint from the same data (data_fingerprint)
+                    are not refit
+    output:         if given, the model is also written there as json
+    '''
+    previous_form = dataset.current_form
+    dataset.make_datasets('scaled')
+    try:
+        names = list(dataset.names)
+        rows = dict((label, dataset.rows(label, split)) for label in names)
+        total = float(sum(len(X) for X in rows.values()))
+        fingerprint = data_fingerprint(split, rows) if checkpoint_dir else None
+        jobs, fitted = [], {}
+        for label in names:
+            parameters = _load_checkpoint(checkpoint_dir, label, fingerprint) if checkpoint_dir else None
+            if parameters is not None:
+                fitted[label] = parameters
+                continue
+            if len(rows[label]):
+                jobs.append((label, np.asarray(rows[label], dtype=np.float64), len(rows[label]) / total))
+    finally:
+        if previous_form is not None:
+            dataset.make_datasets(previous_form)
+
+    if checkpoint_dir and not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+
+    if workers == 1:
+        results = map(fit_component, jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(fit_component, jobs)
+    try:
+        for label, parameters in tqdm(results, total=len(jobs), desc='fitting colors'):
+            fitted[label] = parameters
+            if checkpoint_dir:
+                _save_checkpoint(checkpoint_dir, label, parameters, fingerprint)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    info = {'name': model_name,
+            'components': [{'name': label, 'parameters': fitted[label]} 
+                           for label in names if label in fitted]}
+    if output:
+        with open(output, 'w') as fp:
+            json.dump(info, fp, indent=2, sort_keys=True)
+    return info
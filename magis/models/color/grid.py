@@ -0,0 +1,166 @@
+"""
+Precomputed posterior tables for Lux over the quantized HSV grid.
+
+Inputs that come from pixels are quantized: integer hues and saturation / value
+on the integer 0-100 scale.  PosteriorGrid.build evaluates the model once
+over every grid point and stores, per point, the argmax and the top-k
+(index, probability) pairs as .npy files in a directory.  PosteriorGrid.load
+memory-maps them read-only, so any number of worker processes share one copy
+through the page cache and a query is an array read.
+
+Layout of a grid directory:
+    meta.json       model name, component names, k and the grid shape
+    argmax.npy      (541, 101, 101) int16
+    topk_index.npy  (541, 101, 101, k) int16, sorted by descending probability
+    topk_prob.npy   (541, 101, 101, k) float32
+
+The hue axis covers every integer hue from -180 to 360, the whole range Lux
+takes its inputs in.  Components that are not hue-adjusted read -20 and 340 as
+different hues, so both halves are stored and a lookup agrees with
+Lux.posterior at the same hue.  Hues outside [-180, 360] are first taken
+modulo 360 (onto [0, 360)); there the grid answers for that hue, not for
+what the model would make of the raw value.
+"""
+import os
+import json
+
+import numpy as np
+from tqdm import tqdm
+
+
+class PosteriorGrid(object):
+    shape = (541, 101, 101)
+    ## hue of the first slice; slice i holds hue HUE_MIN + i
+    HUE_MIN = -180
+
+    def __init__(self, names, argmax, topk_index, topk_prob, model_name=None):
+        self.names = list(names)
+        self.argmax = argmax
+        self.topk_index = topk_index
+        self.topk_prob = topk_prob
+        self.model_name = model_name
+
+    @property
+    def k(self):
+        return self.topk_index.shape[-1]
+
+    @classmethod
+    def build(cls, model, path, k=5):
+        '''
+        evaluate the posterior of model over the full grid and write it to path
+
+        one hue slice (101*101 points) is evaluated at a time and written
+        straight into the memory-mapped outputs.
+        '''
+        if not os.path.exists(path):
+            os.makedirs(path)
+        n_components = len(model)
+        k = min(k, n_components)
+        H, S, V = cls.shape
+
+        argmax = np.lib.format.open_memmap(os.path.join(path, 'argmax.npy'), mode='w+',
+                                           dtype=np.int16, shape=(H, S, V))
+        topk_index = np.lib.format.open_memmap(os.path.join(path, 'topk_index.npy'), mode='w+',
+                                               dtype=np.int16, shape=(H, S, V, k))
+        topk_prob = np.lib.format.open_memmap(os.path.join(path, 'topk_prob.npy'), mode='w+',
+                                              dtype=np.float32, shape=(H, S, V, k))
+
+        sat, val = np.meshgrid(np.arange(S, dtype=np.float64),
+                               np.arange(V, dtype=np.float64), indexing='ij')
+        X = np.empty((S * V, 3))
+        X[:, 1] = sat.ravel()
+        X[:, 2] = val.ravel()
+        columns = np.arange(S * V)[None, :]
+
+        for h in tqdm(range(H), desc='building posterior grid'):
+            X[:, 0] = cls.HUE_MIN + h
+            p_vec = model.evaluate(X)
+            p_vec /= p_vec.sum(axis=0, keepdims=True)
+            top = np.argpartition(-p_vec, k - 1, axis=0)[:k]
+            top_p = p_vec[top, columns]
+            order = np.argsort(-top_p, axis=0)
+            top = top[order, columns]
+            top_p = top_p[order, columns]
+
+            argmax[h] = p_vec.argmax(axis=0).reshape(S, V)
+            topk_index[h] = top.T.reshape(S, V, k)
+            topk_prob[h] = top_p.T.reshape(S, V, k)
+
+        for out in (argmax, topk_index, topk_prob):
+            out.flush()
+        with open(os.path.join(path, 'meta.json'), 'w') as fp:
+            json.dump({'name': model.name, 'names': [c.name for c in model.components],
+                       'k': k, 'shape': list(cls.shape)}, fp)
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path):
+        ''' memory-map a built grid read-only '''
+        with open(os.path.join(path, 'meta.json')) as fp:
+            meta = json.load(fp)
+        if tuple(meta['shape']) != cls.shape:
+            raise ValueError("grid at {} has shape {}, expected {}".format(path, meta['shape'],
+                                                                            cls.shape))
+        arrays = [np.load(os.path.join(path, fname), mmap_mode='r')
+                  for fname in ('argmax.npy', 'topk_index.npy', 'topk_prob.npy')]
+        return cls(meta['names'], *arrays, model_name=meta['name'])
+
+    ############ queries
+
+    def _hues(self, X):
+        ''' X with its hues as positions on the hue axis (see the module docstring) '''
+        X = np.array(X, dtype=np.float64)
+        hue_max = self.HUE_MIN + self.shape[0] - 1
+        outside = (X[:, 0] < self.HUE_MIN) | (X[:, 0] > hue_max)
+        X[outside, 0] = np.mod(X[outside, 0], 360.)
+        X[:, 0] -= self.HUE_MIN
+        return X
+
+    def _cell(self, X):
+        ''' nearest grid indices for an (N, 3) matrix '''
+        X = np.rint(self._hues(X)).astype(np.intp)
+        return (np.clip(X[:, 0], 0, self.shape[0] - 1),
+                np.clip(X[:, 1], 0, self.shape[1] - 1),
+                np.clip(X[:, 2], 0, self.shape[2] - 1))
+
+    def _corners(self, X):
+        ''' the 8 surrounding grid points and their trilinear weights '''
+        X = self._hues(X)
+        lower = np.floor(X)
+        frac = X - lower
+        lower = lower.astype(np.intp)
+        for dh in (0, 1):
+            for ds in (0, 1):
+                for dv in (0, 1):
+                    weight = ((frac[:, 0] if dh else 1 - frac[:, 0]) *
+                              (frac[:, 1] if ds else 1 - frac[:, 1]) *
+                              (frac[:, 2] if dv else 1 - frac[:, 2]))
+                    cell = (np.clip(lower[:, 0] + dh, 0, self.shape[0] - 1),
+                            np.clip(lower[:, 1] + ds, 0, self.shape[1] - 1),
+                            np.clip(lower[:, 2] + dv, 0, self.shape[2] - 1))
+                    yield cell, weight
+
+    def posterior(self, X, interpolate=False):
+        '''
+        (K, N) matrix holding the stored top-k probabilities, zero elsewhere.
+        Mass outside of the top-k is dropped, so columns sum to at most 1.
+        '''
+        X = np.asarray(X, dtype=np.float64)
+        n = len(X)
+        out = np.zeros((len(self.names), n))
+        columns = np.repeat(np.arange(n), self.k)
+        if not interpolate:
+            cell = self._cell(X)
+            out[self.topk_index[cell].ravel(), columns] = self.topk_prob[cell].ravel()
+            return out
+        for cell, weight in self._corners(X):
+            np.add.at(out, (self.topk_index[cell].ravel(), columns),
+                      (self.topk_prob[cell] * weight[:, None]).ravel())
+        return out
+
+    def predict(self, X, interpolate=False):
+        ''' (N,) component indices '''
+        X = np.asarray(X, dtype=np.float64)
+        if not interpolate:
+            return self.argmax[self._cell(X)].astype(np.intp)
+        return self.posterior(X, interpolate=True).argmax(axis=0)
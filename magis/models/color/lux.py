@@ -1,4 +1,17 @@
+import os
+import threading
+
+import numpy as np
+
 from .. import Model, Component, DualBoundaries, CircularBoundaries
+from .engine import LuxEngine
+from .grid import PosteriorGrid
+from .candidates import CandidateIndex, DEFAULT_EPSILON
+from . import storage
+from ...utils import instrumented
+
+_pretrained = {}
+_pretrained_lock = threading.Lock()
 
 
 class Lux(Model):
@@ -12,23 +25,183 @@ class Lux(Model):
                                 v scaled to (0, 100)
         lux.likelihood(datum, color_name)
         lux.posterior(datum)            
+
+        lux.use_grid(path) answers predict and posterior from a precomputed 
+        PosteriorGrid instead of evaluating the model.
+
+        lux.use_index(epsilon) evaluates only the labels that can matter at 
+        each input (see candidates.CandidateIndex); lux.dropped_mass(datum) 
+        bounds what that leaves out.
     '''
     def __init__(self, name, *args, **kwargs):
             
         super(Lux, self).__init__(name, *args, **kwargs)
 
-        self.__dict__.update({c.name.replace(" ", "_").replace("-","_"):c 
-                              for c in self.components})
+        self._engine = None
+        self._grid = None
+        self._grid_interpolate = False
+        self._index = None
+        self._index_epsilon = None
 
     @classmethod
     def from_json(cls, filename, *args, **kwargs):
         return super(Lux, cls).from_json(filename, ColorLabel)
 
     @classmethod
-    def pretrained(cls):
-        import os
-        HERE = os.path.dirname(os.path.abspath(__file__))
-        return cls.from_json(os.path.join(HERE, 'assets', 'lux.json'))
+    def from_table(cls, name, table):
+        ''' build from the structured array written by storage.compile_model '''
+        names = table['name'].tolist()
+        parameters, hue_adjust = table['parameters'], table['hue_adjust']
+        components = [ColorLabel.deferred(*row) for row in 
+                      zip(names, parameters, hue_adjust.tolist(), table['availability'].tolist())]
+        for i, c in enumerate(components):
+            c.index = i
+        model = cls(name, components)
+        ## the engine comes straight from the mapped columns
+        model._engine = LuxEngine.from_parameters(names, parameters, hue_adjust, 
+                                                  table['availability'])
+        return model
+
+    @classmethod
+    def load(cls, filename):
+        ''' 
+        load a json model file through its compiled binary table, compiling
+        it on first use; falls back to parsing the json if that fails
+        '''
+        loaded = storage.load_table(filename)
+        if loaded is None:
+            try:
+                storage.compile_model(filename)
+                loaded = storage.load_table(filename)
+            except (IOError, OSError):
+                loaded = None
+        if loaded is None:
+            return cls.from_json(filename)
+        return cls.from_table(*loaded)
+
+    @classmethod
+    @instrumented('lux.pretrained')
+    def pretrained(cls, version='lux'):
+        '''
+        the shipped model, 'lux' or 'lux_v0'. 
+
+        the parsed components and the compiled engine are memoized for the 
+        whole process (and inherited by forked workers); every call wraps
+        them in a new model, so modes set on one (use_grid, use_cache, 
+        use_index, use_log_space, ...) never reach another caller.
+        '''
+        key = (cls, version)
+        with _pretrained_lock:
+            if key not in _pretrained:
+                HERE = os.path.dirname(os.path.abspath(__file__))
+                model = cls.load(os.path.join(HERE, 'assets', version + '.json'))
+                _pretrained[key] = (model.name, tuple(model.components), model.engine)
+            name, components, engine = _pretrained[key]
+        model = cls(name, list(components))
+        model._engine = engine
+        return model
+
+    def invalidate(self):
+        super(Lux, self).invalidate()
+        ## lux.light_blue etc. follow the current components
+        for attribute in self.__dict__.pop('_color_attributes', ()):
+            self.__dict__.pop(attribute, None)
+        attributes = {c.name.replace(" ", "_").replace("-","_"):c for c in self.components}
+        self.__dict__.update(attributes)
+        self._color_attributes = list(attributes)
+        self._engine = None
+        self._index = None
+        if getattr(self, '_grid', None) is not None and self._grid.names != self._names:
+            self._grid = None
+
+    @property
+    def engine(self):
+        ''' the compiled, struct-of-arrays evaluator; built on first use '''
+        if self._engine is None:
+            if self._parent is not None:
+                self._engine = self._parent.engine.subset(self.parent_indices)
+            else:
+                self._engine = LuxEngine.from_model(self)
+        return self._engine
+
+    @property
+    def candidate_index(self):
+        ''' the CandidateIndex in use, built on first use; None without use_index '''
+        if self._index is None and self._index_epsilon is not None:
+            self._index = CandidateIndex(self.engine, self._index_epsilon)
+        return self._index
+
+    def use_index(self, epsilon=DEFAULT_EPSILON):
+        '''
+        skip the labels whose density at an input is below epsilon relative
+        to the labels that are certainly present there. use_index(None) goes
+        back to evaluating every label.
+        '''
+        self._index_epsilon = epsilon
+        self._index = None
+        if self._cache is not None:
+            self._cache.clear()
+
+    def dropped_mass(self, *datum):
+        ''' upper bound on the posterior mass use_index leaves out, per datum '''
+        X = np.asarray(self._datum(datum), dtype=np.float64)
+        if self.candidate_index is None:
+            return np.zeros(len(X)) if X.ndim == 2 else 0.
+        bound = self.candidate_index.dropped_mass(np.atleast_2d(X))
+        return bound if X.ndim == 2 else float(bound[0])
+
+    def evaluate_pairs(self, X, indices):
+        return self.engine.pair_likelihoods(X, indices)
+
+    def log_evaluate(self, datum, dtype=np.float64):
+        X = np.asarray(datum, dtype=np.float64)
+        index = self.candidate_index
+        X2 = np.atleast_2d(X)
+        if index is None:
+            out = self.engine.log_likelihoods(X2, dtype=dtype)
+        else:
+            out = index.log_likelihoods(X2, dtype)
+        return out[:, 0] if X.ndim == 1 else out
+
+    def evaluate(self, datum):
+        index = self.candidate_index
+        if index is None:
+            return self.engine.evaluate(datum)
+        X = np.asarray(datum, dtype=np.float64)
+        if X.ndim == 1:
+            return index.likelihoods(X[None, :])[:, 0]
+        return index.likelihoods(X)
+
+    def use_grid(self, grid, interpolate=False):
+        '''
+        answer predict and posterior from a PosteriorGrid, or a path to one.
+        with interpolate, off-grid inputs are trilinearly interpolated. 
+        use_grid(None) goes back to evaluating the model.
+        '''
+        if grid is not None and not isinstance(grid, PosteriorGrid):
+            grid = PosteriorGrid.load(grid)
+        if grid is not None and grid.names != [c.name for c in self.components]:
+            raise ValueError("grid was built for a different set of components")
+        self._grid = grid
+        self._grid_interpolate = interpolate
+
+    def predict(self, *datum):
+        if self._grid is None:
+            return super(Lux, self).predict(*datum)
+        X = np.asarray(self._datum(datum), dtype=np.float64)
+        indices = self._grid.predict(np.atleast_2d(X), self._grid_interpolate)
+        if X.ndim == 1:
+            return self.components[indices[0]]
+        return [self.components[i] for i in indices]
+
+    def posterior(self, *datum):
+        if self._grid is None:
+            return super(Lux, self).posterior(*datum)
+        X = np.asarray(self._datum(datum), dtype=np.float64)
+        p_vec = self._grid.posterior(np.atleast_2d(X), self._grid_interpolate)
+        if X.ndim == 1:
+            p_vec = p_vec[:, 0]
+        return self._distribution(p_vec)
 
 class ColorLabel(Component):
     def __init__(self, name, dim_models, availability, *args, **kwargs):
@@ -38,17 +211,31 @@ class ColorLabel(Component):
 
     @classmethod
     def from_dict(cls, info):
-        p_order = ['scalelower', 'shapelower', 'mulower', 'scaleupper', 'shapeupper', 'muupper']
-        
         prminfo = info['parameters'] 
-        avail = prminfo['availability']
-        h_prm, s_prm, v_prm = prminfo['parameters']
-        h_adjust = prminfo['hue_adjust']
-        hue_model = CircularBoundaries.from_parameters(*tuple([h_prm[p] for p in p_order] + [h_adjust]))
-        sat_model = DualBoundaries.from_parameters(*tuple([s_prm[p] for p in p_order]))
-        val_model = DualBoundaries.from_parameters(*tuple([v_prm[p] for p in p_order]))
-    
-        return cls(info['name'], (hue_model, sat_model, val_model), avail)
+        parameters = [[dim[p] for p in storage.PARAMETER_ORDER] for dim in prminfo['parameters']]
+        return cls.from_parameters(info['name'], parameters, 
+                                   prminfo['hue_adjust'], prminfo['availability'])
+
+    @classmethod
+    def from_parameters(cls, name, parameters, hue_adjust, availability):
+        ''' parameters holds one row per dimension, in storage.PARAMETER_ORDER '''
+        return cls(str(name), _dim_models(parameters, hue_adjust), float(availability))
+
+    @classmethod
+    def deferred(cls, name, parameters, hue_adjust, availability):
+        ''' like from_parameters, but the boundaries are built the first time they are used '''
+        label = cls.__new__(cls)
+        Component.__init__(label, str(name))
+        label.availability = float(availability)
+        label._parameters = (parameters, hue_adjust)
+        return label
+
+    def __getattr__(self, attribute):
+        if attribute in ('hue_model', 'sat_model', 'val_model') and '_parameters' in self.__dict__:
+            self.hue_model, self.sat_model, self.val_model = _dim_models(
+                *self.__dict__.pop('_parameters'))
+            return getattr(self, attribute)
+        raise AttributeError(attribute)
 
     def pdf(self, x):
         try: 
@@ -61,4 +248,9 @@ class ColorLabel(Component):
         return self.availability
 
 
-
+def _dim_models(parameters, hue_adjust):
+    h_prm, s_prm, v_prm = parameters
+    hue_model = CircularBoundaries.from_parameters(*(tuple(h_prm) + (bool(hue_adjust),)))
+    sat_model = DualBoundaries.from_parameters(*tuple(s_prm))
+    val_model = DualBoundaries.from_parameters(*tuple(v_prm))
+    return hue_model, sat_model, val_model
@@ -0,0 +1,106 @@
+"""
+Binary form of the Lux parameter files.
+
+lux.json is ~800KB of JSON that has to be parsed on every load.  compile_model
+writes the same numbers as one flat structured array (.npy, one record per
+component) plus a small .json header with the model name, the sha256 of the
+table and the size and mtime the table was written with.  The compiled file is
+named after the size and mtime of its source json, so an edited source never
+picks up a stale table.  load_table memory-maps the table and checks it against
+the header without reading it (the digest is only computed when compiling); it
+returns None when anything does not match, or the cache can not be reached, so
+the caller can fall back to the json.
+"""
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from ...utils import cache_path
+
+
+PARAMETER_ORDER = ['scalelower', 'shapelower', 'mulower', 'scaleupper', 'shapeupper', 'muupper']
+
+DTYPE = np.dtype([('name', 'U64'),
+                  ('availability', 'f8'),
+                  ('hue_adjust', '?'),
+                  ('parameters', 'f8', (3, len(PARAMETER_ORDER)))])
+
+FORMAT_VERSION = 2
+
+
+def table_digest(table):
+    return hashlib.sha256(np.ascontiguousarray(table).view(np.uint8)).hexdigest()
+
+
+def source_fingerprint(source):
+    ''' hash of the source file's location, size and mtime; stat only, nothing is read '''
+    info = os.stat(source)
+    key = '{}:{}:{}:{}'.format(os.path.abspath(source), info.st_size, info.st_mtime_ns, FORMAT_VERSION)
+    return hashlib.sha256(key.encode('utf8')).hexdigest()
+
+
+def compiled_path(source):
+    ''' where the compiled table for this exact source file lives '''
+    stem = os.path.splitext(os.path.basename(source))[0]
+    return cache_path('models', '{}.{}.npy'.format(stem, source_fingerprint(source)[:16]))
+
+
+def read_json(source):
+    ''' (model name, component dicts) for both the current and the v0 layout '''
+    with open(source) as fp:
+        info = json.load(fp)
+    if 'components' in info:
+        return info['name'], info['components']
+    name = os.path.splitext(os.path.basename(source))[0]
+    return name, [{'name': k, 'parameters': v} for k, v in info.items()]
+
+
+def to_table(components):
+    table = np.zeros(len(components), dtype=DTYPE)
+    for row, component in zip(table, components):
+        info = component['parameters']
+        row['name'] = component['name']
+        row['availability'] = info['availability']
+        row['hue_adjust'] = info['hue_adjust']
+        row['parameters'] = [[dim[p] for p in PARAMETER_ORDER] for dim in info['parameters']]
+    return table
+
+
+def compile_model(source, target=None):
+    ''' convert a json model file into the binary table; returns the table path '''
+    target = target or compiled_path(source)
+    name, components = read_json(source)
+    table = to_table(components)
+
+    ## write under temporary names and rename, so readers never see half a file
+    tmp = '{}.{}.tmp'.format(target, os.getpid())
+    with open(tmp, 'wb') as fp:
+        np.save(fp, table)
+    ## renaming keeps the size and mtime, so they identify the finished table
+    info = os.stat(tmp)
+    with open(tmp + '.json', 'w') as fp:
+        json.dump({'name': name, 'sha256': table_digest(table), 'format': FORMAT_VERSION,
+                   'size': info.st_size, 'mtime_ns': info.st_mtime_ns}, fp)
+    os.rename(tmp + '.json', target + '.json')
+    os.rename(tmp, target)
+    return target
+
+
+def load_table(source, target=None):
+    ''' (model name, mapped table) or None if there is no valid compiled table '''
+    try:
+        target = target or compiled_path(source)
+        with open(target + '.json') as fp:
+            header = json.load(fp)
+        info = os.stat(target)
+        if (header.get('format') != FORMAT_VERSION or header.get('size') != info.st_size or
+                header.get('mtime_ns') != info.st_mtime_ns):
+            return None
+        table = np.load(target, mmap_mode='r')
+    except (IOError, OSError, ValueError):
+        return None
+    if table.dtype != DTYPE:
+        return None
+    return header['name'], table
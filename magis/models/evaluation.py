@@ -0,0 +1,169 @@
+"""
+Streaming evaluation of models on a Dataset split.
+
+The split is read in fixed-size chunks and every model scores each chunk
+before the next one is read, so several models are compared in one pass over
+the data.  Per model only running sums are kept (rows, hits at each k, summed
+log probability of the true label), never the N x K posterior.
+
+    result = evaluate({'lux': Lux.pretrained(), 'lux_v0': Lux.pretrained('lux_v0')},
+                      dataset, split='test')
+    scores = result['models']['lux']
+    scores['accuracy'], scores['top5'], scores['perplexity'], result['throughput']
+
+Models in log space (use_log_space) are scored through log_evaluate and a
+log-sum-exp, so far-off rows do not turn into 0/0.
+
+With workers > 1 (None for one per core) the chunks are scored in a process
+pool with a bounded number in flight; each worker receives the models once,
+when it starts.
+"""
+import time
+import collections
+import multiprocessing
+
+import numpy as np
+from tqdm import tqdm
+
+## log(0) guard for rows where a model puts no mass on the true label
+_FLOOR = 1e-300
+
+
+class RunningScores(object):
+    ''' sufficient statistics for accuracy, top-k accuracy and perplexity '''
+    def __init__(self, topk=(1, 5)):
+        self.topk = tuple(sorted(set(topk) | {1}))
+        self.n = 0
+        self.oov = 0
+        self.hits = dict((k, 0) for k in self.topk)
+        self.log_prob = 0.0
+
+    def update(self, p_vec, targets):
+        '''
+        p_vec is a (K, N) posterior and targets the (N,) component index of
+        the true label, or -1 where the label is not in the model
+        '''
+        known = targets >= 0
+        self.oov += int((~known).sum())
+        if not known.any():
+            return
+        p_vec = p_vec[:, known]
+        targets = targets[known]
+        p_true = p_vec[targets, np.arange(len(targets))]
+        ## rank of the true label; nan columns (no mass anywhere) rank last
+        rank = (p_vec > p_true[None, :]).sum(axis=0)
+        rank[np.isnan(p_true)] = p_vec.shape[0]
+        for k in self.topk:
+            self.hits[k] += int((rank < k).sum())
+        self.log_prob += float(np.log(np.maximum(np.nan_to_num(p_true), _FLOOR)).sum())
+        self.n += len(targets)
+
+    def merge(self, other):
+        self.n += other.n
+        self.oov += other.oov
+        self.log_prob += other.log_prob
+        for k in self.topk:
+            self.hits[k] += other.hits[k]
+        return self
+
+    def summary(self):
+        n = max(self.n, 1)
+        out = {'n': self.n, 'oov': self.oov,
+               'accuracy': self.hits[1] / float(n),
+               'log_likelihood': self.log_prob,
+               'perplexity': float(np.exp(-self.log_prob / n))}
+        for k in self.topk:
+            out['top{}'.format(k)] = self.hits[k] / float(n)
+        return out
+
+
+def label_map(model, dataset):
+    ''' dataset label index -> model component index (-1 when out of vocabulary) '''
+    index = dict((c.name, i) for i, c in enumerate(model.components))
+    return np.array([index.get(dataset.index2name(i), -1)
+                     for i in range(dataset.number_words)], dtype=np.intp)
+
+
+def score_chunk(models, maps, X, y, topk):
+    ''' one RunningScores per model for one chunk of rows '''
+    out = {}
+    X = np.asarray(X, dtype=np.float64)
+    for name, model in models.items():
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if getattr(model, 'log_space', False):
+                ## rows where every label is -inf stay nan and rank last, as below
+                p_vec = np.asarray(model.log_evaluate(X), dtype=np.float64)
+                p_vec = np.exp(p_vec - p_vec.max(axis=0, keepdims=True))
+            else:
+                p_vec = np.asarray(model.evaluate(X))
+            p_vec = p_vec / p_vec.sum(axis=0, keepdims=True)
+        scores = RunningScores(topk)
+        scores.update(p_vec, maps[name][y])
+        out[name] = scores
+    return out
+
+
+_worker_state = {}
+
+def _init_worker(models, maps, topk):
+    _worker_state.update(models=models, maps=maps, topk=topk)
+
+def _score_in_worker(chunk):
+    X, y = chunk
+    return score_chunk(_worker_state['models'], _worker_state['maps'], X, y, _worker_state['topk'])
+
+def _in_pool(pool, chunks, depth):
+    ''' score chunks in the pool with at most depth of them in flight '''
+    pending = collections.deque()
+    for X, y in chunks:
+        pending.append(pool.apply_async(_score_in_worker, ((np.array(X), np.array(y)),)))
+        if len(pending) >= depth:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def evaluate(models, dataset, split='test', form='scaled', chunk_size=4096,
+             topk=(1, 5), workers=1, progress=True):
+    '''
+    score each model on a loaded Dataset split in one streaming pass.
+
+    models:     {name: Model}, or a single Model
+    form:       the dataset form the models expect (Lux uses 'scaled')
+    returns {'models': {name: summary}, 'throughput': {rows, seconds, rows_per_second}}
+    where each summary has n, oov, accuracy, topk, log_likelihood and perplexity
+    '''
+    if not isinstance(models, dict):
+        models = {models.name: models}
+    maps = dict((name, label_map(model, dataset)) for name, model in models.items())
+    totals = dict((name, RunningScores(topk)) for name in models)
+
+    previous_form = dataset.current_form
+    dataset.make_datasets(form)
+    chunks = dataset.generate_batches(split, chunk_size, shuffle=False)
+    n_chunks = -(-dataset.size(split) // chunk_size)
+
+    start = time.time()
+    pool = None
+    if workers == 1:
+        results = (score_chunk(models, maps, X, y, topk) for X, y in chunks)
+    else:
+        processes = workers or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                    initargs=(models, maps, topk))
+        results = _in_pool(pool, chunks, 2 * processes)
+    try:
+        for result in tqdm(results, total=n_chunks, desc='evaluating', disable=not progress):
+            for name, scores in result.items():
+                totals[name].merge(scores)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if previous_form is not None:
+            dataset.make_datasets(previous_form)
+    elapsed = time.time() - start
+
+    rows = max([s.n + s.oov for s in totals.values()] + [0])
+    return {'models': dict((name, scores.summary()) for name, scores in totals.items()),
+            'throughput': {'rows': rows, 'seconds': elapsed,
+                           'rows_per_second': rows / elapsed if elapsed > 0 else float('inf')}}
@@ -0,0 +1,193 @@
+"""
+Micro-batching inference for any Model.
+
+Requests for single colors are queued and the batcher coalesces whatever
+arrives within max_wait seconds (up to max_batch_size of them) into one
+batched posterior call.  That call runs in a worker thread, off the event
+loop.  Each request then gets its own slice of the batch result.
+
+    service = BatchingService(Lux.pretrained(), max_batch_size=512, max_wait=0.002)
+    async with service:
+        component = await service.predict((210., 60., 70.))
+        best = await service.top((210., 60., 70.), 5)    # OrderedDict name -> p
+        dist = await service.posterior((210., 60., 70.))
+    service.stats()
+"""
+import time
+import asyncio
+import concurrent.futures
+
+import numpy as np
+
+from ..utils import instruments
+
+
+class BatchingService(object):
+    '''
+    model:          any Model; it receives (N, 3) batches through model.posterior
+    max_batch_size: most requests evaluated in one call
+    max_wait:       seconds the first request of a batch waits for company
+    workers:        batches evaluated concurrently (each in its own thread)
+    '''
+    def __init__(self, model, max_batch_size=256, max_wait=0.002, workers=1):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.workers = workers
+        self._queue = None
+        self._executor = None
+        self._batcher = None
+        self._slots = None
+        self._in_flight = set()
+        self._stopping = False
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._n_requests = 0
+        self._n_batches = 0
+        self._max_depth = 0
+        self._batch_sizes = {}
+        self._busy = 0.
+
+    async def start(self):
+        if self._batcher is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.workers)
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+        self._batcher = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        '''
+        answer everything already queued, then shut down. requests submitted
+        while stopping raise RuntimeError; afterwards the next request 
+        starts the service again
+        '''
+        if self._batcher is None:
+            return
+        self._stopping = True
+        try:
+            await self._queue.join()
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+            ## nothing can be queued after the flag is set; fail anything that was anyway
+            while not self._queue.empty():
+                _, _, future = self._queue.get_nowait()
+                if not future.done():
+                    future.set_exception(RuntimeError("the service was stopped"))
+            if self._in_flight:
+                await asyncio.gather(*self._in_flight)
+            self._executor.shutdown(wait=True)
+            self._batcher = None
+        finally:
+            self._stopping = False
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+        return False
+
+    ############ requests
+
+    async def posterior(self, datum):
+        ''' the Distribution of one (h, s, v) '''
+        return await self._submit(datum, None)
+
+    async def predict(self, datum):
+        ''' the most probable component for one (h, s, v) '''
+        dist = await self._submit(datum, None)
+        return self.model.components[int(np.argmax(dist.numbers))]
+
+    async def top(self, datum, n=5):
+        ''' the n most probable names with their probabilities '''
+        return await self._submit(datum, n)
+
+    async def _submit(self, datum, topk):
+        ## a malformed datum fails its own request here, never the batch it would join
+        datum = np.asarray(datum, dtype=np.float64)
+        if datum.shape != (3,):
+            raise ValueError("expected one (h, s, v) datum, got shape {}".format(datum.shape))
+        if self._stopping:
+            raise RuntimeError("the service is stopping")
+        if self._batcher is None:
+            await self.start()
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((datum, topk, future))
+        self._max_depth = max(self._max_depth, self._queue.qsize())
+        return await future
+
+    ############ batching
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if self._queue.empty():
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self._queue.get_nowait())
+            await self._slots.acquire()
+            task = asyncio.ensure_future(self._evaluate(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    def _posterior(self, X):
+        start = time.perf_counter()
+        with instruments.timer('serving.batch'):
+            dist = self.model.posterior(X)
+        return dist, time.perf_counter() - start
+
+    async def _evaluate(self, batch):
+        loop = asyncio.get_event_loop()
+        try:
+            X = np.stack([datum for datum, _, _ in batch])
+            dist, busy = await loop.run_in_executor(self._executor, self._posterior, X)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            self._n_batches += 1
+            self._n_requests += len(batch)
+            self._batch_sizes[len(batch)] = self._batch_sizes.get(len(batch), 0) + 1
+            self._busy += busy
+            instruments.count('serving.requests', len(batch))
+            for i, (_, topk, future) in enumerate(batch):
+                if future.done():
+                    continue
+                try:
+                    future.set_result(dist[i] if topk is None else dist[i].top(topk))
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+            self._slots.release()
+
+    ############ reporting
+
+    def stats(self):
+        ''' queue depth and batch-size statistics since the service was made '''
+        sizes = self._batch_sizes
+        return {'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+                'max_queue_depth': self._max_depth,
+                'requests': self._n_requests,
+                'batches': self._n_batches,
+                'mean_batch_size': self._n_requests / float(self._n_batches) if self._n_batches else 0.,
+                'max_batch_size': max(sizes) if sizes else 0,
+                'batch_sizes': dict(sorted(sizes.items())),
+                'busy_seconds': self._busy}
@@ -1,7 +1,10 @@
 from libc.stdlib cimport malloc, free, realloc
+cimport cython
+import numpy as np
 
 
-__all__ = ['BoundingBox', 'ngrams', 'unigrams', 'bigrams', 'trigrams']
+__all__ = ['BoundingBox', 'BoundingBoxSet', 'ngrams', 'unigrams', 'bigrams', 'trigrams',
+           'iter_ngrams', 'ngram_hash', 'NgramCounter']
 
 cdef list _ngram(list words, int n=2):
     cdef int i;
@@ -20,6 +23,246 @@ cpdef list bigrams(list words):
 cpdef list trigrams(list words):
     return ngrams(words, start=3, stop=4)
 
+def iter_ngrams(words, int start=1, int stop=10):
+    ''' the n-grams of ngrams(words, start, stop) one tuple at a time, without the lists '''
+    cdef int n
+    cdef Py_ssize_t i
+    for n in range(start, stop):
+        for i in range(len(words) - n + 1):
+            yield tuple(words[i:i+n])
+
+
+############ hashed counting
+
+## 64-bit FNV-1a; python's own hash of a str changes between processes
+cdef unsigned long long FNV_OFFSET = 14695981039346656037ULL
+cdef unsigned long long FNV_PRIME = 1099511628211ULL
+
+cdef unsigned long long _token_hash(token) except? 0:
+    if not isinstance(token, str):
+        token = str(token)
+    cdef bytes data = token.encode('utf8')
+    cdef const unsigned char *c = data
+    cdef unsigned long long h = FNV_OFFSET
+    cdef Py_ssize_t i
+    for i in range(len(data)):
+        h = (h ^ c[i]) * FNV_PRIME
+    return h
+
+cdef inline unsigned long long _combine(const unsigned long long *tokens, int n) nogil:
+    ''' hash of the n tokens from tokens[0]; never 0, which marks an empty slot '''
+    cdef unsigned long long h = (FNV_OFFSET ^ <unsigned long long>n) * FNV_PRIME
+    cdef int k
+    for k in range(n):
+        h = (h ^ tokens[k]) * FNV_PRIME
+        h ^= h >> 29
+    return h if h != 0 else 1
+
+def ngram_hash(ngram):
+    ''' the id NgramCounter gives a tuple of tokens; the same in every process '''
+    cdef unsigned long long[::1] tokens = np.array([_token_hash(t) for t in ngram] or [0], dtype=np.uint64)
+    return int(_combine(&tokens[0], len(ngram)))
+
+
+cdef class NgramCounter:
+    '''
+    counts of the n-grams of orders start..stop-1 over a stream of token lists.
+
+    Every n-gram is hashed to a 64-bit id (ngram_hash) and counted in an
+    open-addressing table of two arrays, keys and counts, which doubles when
+    half full. Memory therefore follows the number of distinct n-grams, and
+    the token lists are never kept. With remember=True the text of each
+    distinct n-gram is also kept, for most_common.
+
+    Two n-grams whose ids collide are counted as one, silently; with 64-bit
+    ids that takes billions of distinct n-grams to become likely.  Tokens
+    are hashed as str(token), so 1 and '1' are the same token.
+
+    Counters are picklable and merge by id, so workers can count their own
+    share of a corpus and the parent adds them up:
+
+        counter = NgramCounter(1, 4)
+        for part in pool.map(count_part, parts):    # each returns a counter
+            counter.merge(part)
+    '''
+    cdef public int start, stop
+    cdef public dict names
+    cdef object _key_array, _count_array
+    cdef unsigned long long[::1] _keys
+    cdef long long[::1] _counts
+    cdef Py_ssize_t size
+    cdef dict _token_cache
+    cdef unsigned long long *_tokens
+    cdef Py_ssize_t _tokens_capacity
+
+    def __cinit__(self):
+        self._tokens = NULL
+        self._tokens_capacity = 0
+
+    def __dealloc__(self):
+        free(self._tokens)
+
+    def __init__(self, int start=1, int stop=10, Py_ssize_t capacity=1024, bint remember=False):
+        self.start = start
+        self.stop = stop
+        cdef Py_ssize_t slots = 16
+        while slots < 2 * capacity:
+            slots *= 2
+        self._set_table(np.zeros(slots, dtype=np.uint64), np.zeros(slots, dtype=np.int64), 0)
+        self.names = {} if remember else None
+        self._token_cache = {}
+
+    cdef _set_table(self, keys, counts, Py_ssize_t size):
+        self._key_array, self._count_array = keys, counts
+        self._keys, self._counts = keys, counts
+        self.size = size
+
+    def __reduce__(self):
+        return (NgramCounter, (self.start, self.stop, 1, self.names is not None),
+                (self._key_array, self._count_array, self.size, self.names))
+
+    def __setstate__(self, state):
+        keys, counts, size, self.names = state
+        self._set_table(keys, counts, size)
+
+    @property
+    def keys(self):
+        ''' the table\'s ids, 0 for an empty slot '''
+        return self._key_array
+
+    @property
+    def counts(self):
+        return self._count_array
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def total(self):
+        return int(self._count_array.sum())
+
+    ############ counting
+
+    def update(self, sentences):
+        ''' count the n-grams of every token list in an iterable '''
+        for words in sentences:
+            self._add(words)
+        return self
+
+    def add(self, words):
+        ''' count the n-grams of one token list '''
+        self._add(words)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef int _add(self, words) except -1:
+        cdef dict cache = self._token_cache
+        cdef Py_ssize_t L = len(words), i, slot
+        cdef int n
+        cdef unsigned long long *grown
+        if L == 0:
+            return 0
+        if L > self._tokens_capacity:
+            grown = <unsigned long long *>realloc(self._tokens, 2 * L * sizeof(unsigned long long))
+            if grown == NULL:
+                raise MemoryError()
+            self._tokens = grown
+            self._tokens_capacity = 2 * L
+        for i in range(L):
+            token = words[i]
+            h = cache.get(token)
+            if h is None:
+                h = cache[token] = _token_hash(token)
+            self._tokens[i] = h
+        for n in range(self.start, self.stop):
+            for i in range(L - n + 1):
+                ## grow on the load factor, so repeats never make room they don't use
+                if 2 * (self.size + 1) > self._keys.shape[0]:
+                    self._reserve(self.size + 1)
+                slot = self._insert(_combine(self._tokens + i, n))
+                if self._counts[slot] == 0 and self.names is not None:
+                    self.names[self._keys[slot]] = tuple(words[i:i+n])
+                self._counts[slot] += 1
+        return 0
+
+    def merge(self, NgramCounter other):
+        ''' add another counter\'s counts into this one '''
+        if (other.start, other.stop) != (self.start, self.stop):
+            raise ValueError("counters of different orders")
+        cdef Py_ssize_t i, slot
+        for i in range(other._keys.shape[0]):
+            if other._keys[i] != 0:
+                if 2 * (self.size + 1) > self._keys.shape[0]:
+                    self._reserve(self.size + 1)
+                slot = self._insert(other._keys[i])
+                self._counts[slot] += other._counts[i]
+        if self.names is not None and other.names is not None:
+            for key, ngram in other.names.items():
+                self.names.setdefault(key, ngram)
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef Py_ssize_t _insert(self, unsigned long long key):
+        ''' the slot of key, claiming an empty one (and counting it) if it is new '''
+        cdef unsigned long long[::1] keys = self._keys
+        cdef Py_ssize_t mask = keys.shape[0] - 1
+        cdef Py_ssize_t slot = <Py_ssize_t>(key & mask)
+        while keys[slot] != 0 and keys[slot] != key:
+            slot = (slot + 1) & mask
+        if keys[slot] == 0:
+            keys[slot] = key
+            self.size += 1
+        return slot
+
+    cdef int _reserve(self, Py_ssize_t needed) except -1:
+        ''' at most half full with needed keys '''
+        cdef Py_ssize_t slots = self._keys.shape[0]
+        if 2 * needed <= slots:
+            return 0
+        while 2 * needed > slots:
+            slots *= 2
+        cdef unsigned long long[::1] old_keys = self._keys
+        cdef long long[::1] old_counts = self._counts
+        self._set_table(np.zeros(slots, dtype=np.uint64), np.zeros(slots, dtype=np.int64), 0)
+        cdef Py_ssize_t i
+        for i in range(old_keys.shape[0]):
+            if old_keys[i] != 0:
+                self._counts[self._insert(old_keys[i])] = old_counts[i]
+        return 0
+
+    ############ reading
+
+    def count(self, ngram):
+        ''' the count of one tuple of tokens '''
+        cdef unsigned long long key = ngram_hash(ngram)
+        cdef Py_ssize_t mask = self._keys.shape[0] - 1
+        cdef Py_ssize_t slot = <Py_ssize_t>(key & mask)
+        while self._keys[slot] != 0:
+            if self._keys[slot] == key:
+                return int(self._counts[slot])
+            slot = (slot + 1) & mask
+        return 0
+
+    def __getitem__(self, ngram):
+        return self.count(ngram)
+
+    def items(self):
+        ''' (ids, counts) of every distinct n-gram, as arrays '''
+        used = self._key_array != 0
+        return self._key_array[used], self._count_array[used]
+
+    def most_common(self, n=None):
+        ''' [(ngram, count)] by decreasing count; the ngram is its id unless remembered '''
+        ids, counts = self.items()
+        order = np.argsort(-counts, kind='stable')[:n]
+        names = self.names
+        return [(names.get(int(ids[i]), int(ids[i])) if names is not None else int(ids[i]), int(counts[i]))
+                for i in order]
+
 
 cdef class BoundingBox:
     cdef float x0, x1, y0, y1
@@ -42,3 +285,208 @@ cdef class BoundingBox:
                 ((other.y0 <= self.y0 <= other.y1) | 
                  (other.y0 <= self.y1 <= other.y1)))
 
+
+
+############ collections of boxes
+
+
+cdef struct _PairBuffer:
+    long long *data
+    Py_ssize_t size
+    Py_ssize_t capacity
+
+cdef int _push(_PairBuffer *buf, long long i, long long j) except -1:
+    cdef long long *grown
+    if buf.size + 2 > buf.capacity:
+        grown = <long long *>realloc(buf.data, 2 * buf.capacity * sizeof(long long))
+        if grown == NULL:
+            raise MemoryError()
+        buf.data = grown
+        buf.capacity *= 2
+    buf.data[buf.size] = i
+    buf.data[buf.size + 1] = j
+    buf.size += 2
+    return 0
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _sweep(double[:, ::1] a, double[:, ::1] b, long long[::1] b_order,
+                long long[::1] lo, long long[::1] hi, bint swap, _PairBuffer *out) except -1:
+    '''
+    pair a[i] with b[b_order[q]] for lo[i] <= q < hi[i] when their y ranges meet;
+    the x ranges are known to meet for every such q
+    '''
+    cdef Py_ssize_t i, q
+    cdef long long j
+    for i in range(a.shape[0]):
+        for q in range(lo[i], hi[i]):
+            j = b_order[q]
+            if a[i, 1] <= b[j, 3] and b[j, 1] <= a[i, 3]:
+                if swap:
+                    _push(out, j, i)
+                else:
+                    _push(out, i, j)
+    return 0
+
+
+cdef class BoundingBoxSet:
+    '''
+    N boxes as one contiguous (N, 4) float64 buffer of (x0, y0, x1, y1) rows,
+    with x0 <= x1 and y0 <= y1. Boxes are closed, so touching edges intersect.
+
+    The all-pairs methods (intersects, iou, contains) take another set, an
+    (M, 4) array, a BoundingBox or one (x0, y0, x1, y1) and return (N, M), or 
+    (N,) for a single box. The *_pairs methods return (P, 2) index pairs and
+    are found by sort and sweep on x0, so they cost O((N + M) log(N + M) + P)
+    plus the x-overlapping candidates, instead of N * M.
+    '''
+    cdef public object coords
+
+    def __init__(self, coords):
+        coords = np.ascontiguousarray(coords, dtype=np.float64)
+        if coords.size == 0:
+            coords = coords.reshape(0, 4)
+        if coords.ndim != 2 or coords.shape[1] != 4:
+            raise ValueError("coords must be (N, 4), got {}".format(coords.shape))
+        self.coords = coords
+
+    @classmethod
+    def from_xywh(cls, xywh):
+        xywh = np.asarray(xywh, dtype=np.float64).reshape(-1, 4)
+        return cls(np.concatenate([xywh[:, :2], xywh[:, :2] + xywh[:, 2:]], axis=1))
+
+    @classmethod
+    def from_boxes(cls, boxes):
+        return cls([box.coords for box in boxes])
+
+    def __len__(self):
+        return self.coords.shape[0]
+
+    def __getitem__(self, i):
+        return BoundingBox(*self.coords[i])
+
+    def areas(self):
+        c = self.coords
+        return (c[:, 2] - c[:, 0]) * (c[:, 3] - c[:, 1])
+
+    ############ all pairs
+
+    def intersects(self, other):
+        a, b, single = self._broadcast(other)
+        out = ((a[..., 0] <= b[..., 2]) & (b[..., 0] <= a[..., 2]) &
+               (a[..., 1] <= b[..., 3]) & (b[..., 1] <= a[..., 3]))
+        return out[:, 0] if single else out
+
+    def intersection(self, other):
+        ''' area of the overlap '''
+        a, b, single = self._broadcast(other)
+        out = _intersection(a, b)
+        return out[:, 0] if single else out
+
+    def iou(self, other):
+        ''' intersection over union; 0 where both boxes have no area '''
+        a, b, single = self._broadcast(other)
+        out = _iou(a, b)
+        return out[:, 0] if single else out
+
+    def contains(self, other):
+        ''' whether box i of this set holds all of box j of other '''
+        a, b, single = self._broadcast(other)
+        out = ((a[..., 0] <= b[..., 0]) & (b[..., 2] <= a[..., 2]) &
+               (a[..., 1] <= b[..., 1]) & (b[..., 3] <= a[..., 3]))
+        return out[:, 0] if single else out
+
+    def _broadcast(self, other):
+        b = _coords(other)
+        single = b.ndim == 1
+        b = b.reshape(-1, 4)
+        return self.coords[:, None, :], b[None, :, :], single
+
+    ############ sparse pairs
+
+    def intersection_pairs(self, other=None):
+        '''
+        (P, 2) int64 pairs (i, j) where box i of this set meets box j of 
+        other, sorted; with other None, the pairs i < j within this set
+        '''
+        cdef _PairBuffer buf
+        a = self.coords
+        buf.capacity = 2 * max(16, len(a))
+        buf.size = 0
+        buf.data = <long long *>malloc(buf.capacity * sizeof(long long))
+        if buf.data == NULL:
+            raise MemoryError()
+        try:
+            if other is None:
+                order = np.argsort(a[:, 0], kind='stable').astype(np.int64)
+                x0 = a[order, 0]
+                ## a box is paired with the later boxes (in x0 order) that start inside it
+                lo = np.empty(len(a), dtype=np.int64)
+                lo[order] = np.arange(1, len(a) + 1)
+                hi = np.searchsorted(x0, a[:, 2], side='right').astype(np.int64)
+                _sweep(a, a, order, lo, np.maximum(lo, hi), False, &buf)
+            else:
+                b = _coords(other).reshape(-1, 4)
+                ## b starts inside a, or a starts strictly inside b: every x-overlap is exactly one of these
+                self._sweep_into(a, b, False, True, &buf)
+                self._sweep_into(b, a, True, False, &buf)
+            pairs = np.array(<long long[:buf.size]>buf.data if buf.size else [],
+                             dtype=np.int64).reshape(-1, 2)
+        finally:
+            free(buf.data)
+        if other is None:
+            pairs.sort(axis=1)
+        return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+    cdef int _sweep_into(self, a, b, bint swap, bint inclusive, _PairBuffer *buf) except -1:
+        order = np.argsort(b[:, 0], kind='stable').astype(np.int64)
+        x0 = b[order, 0]
+        lo = np.searchsorted(x0, a[:, 0], side='left' if inclusive else 'right').astype(np.int64)
+        hi = np.searchsorted(x0, a[:, 2], side='right').astype(np.int64)
+        _sweep(a, np.ascontiguousarray(b), order, lo, np.maximum(lo, hi), swap, buf)
+        return 0
+
+    def iou_pairs(self, other=None, double threshold=0.):
+        ''' intersecting pairs with iou above threshold, and their iou values '''
+        pairs = self.intersection_pairs(other)
+        a = self.coords[pairs[:, 0]]
+        b = (self.coords if other is None else _coords(other).reshape(-1, 4))[pairs[:, 1]]
+        values = _iou(a, b)
+        keep = values > threshold
+        return pairs[keep], values[keep]
+
+    def containment_pairs(self, other=None):
+        ''' pairs (i, j) where box i holds all of box j (both directions within one set) '''
+        pairs = self.intersection_pairs(other)
+        if other is None:
+            pairs = np.concatenate([pairs, pairs[:, ::-1]])
+            b = self.coords
+        else:
+            b = _coords(other).reshape(-1, 4)
+        a, b = self.coords[pairs[:, 0]], b[pairs[:, 1]]
+        keep = ((a[:, 0] <= b[:, 0]) & (b[:, 2] <= a[:, 2]) &
+                (a[:, 1] <= b[:, 1]) & (b[:, 3] <= a[:, 3]))
+        pairs = pairs[keep]
+        return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+
+def _coords(other):
+    if isinstance(other, BoundingBoxSet):
+        return other.coords
+    if isinstance(other, BoundingBox):
+        return np.asarray(other.coords, dtype=np.float64)
+    return np.ascontiguousarray(other, dtype=np.float64)
+
+def _areas(c):
+    return (c[..., 2] - c[..., 0]) * (c[..., 3] - c[..., 1])
+
+def _intersection(a, b):
+    w = np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0])
+    h = np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1])
+    return np.clip(w, 0, None) * np.clip(h, 0, None)
+
+def _iou(a, b):
+    inter = _intersection(a, b)
+    union = _areas(a) + _areas(b) - inter
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(union > 0, inter / union, 0.)
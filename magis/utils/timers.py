@@ -1,4 +1,11 @@
+import os
 import time
+import bisect
+import functools
+import threading
+
+__all__ = ['Timer', 'EncodeTimer', 'EggTimer', 'Stopwatch', 'stopwatch',
+           'LatencyHistogram', 'Instruments', 'instruments', 'instrumented']
 
 class Timer(object):
     """A simple timer.
@@ -64,4 +71,143 @@ class Stopwatch(Timer):
     def toc(self):
         return super(Stopwatch, self).toc(False)
         
-stopwatch = Stopwatch()
\ No newline at end of file
+stopwatch = Stopwatch()
+
+################ instrumentation
+##
+## an opt-in registry of named latency histograms and counters.
+##
+##     from magis.utils import instruments
+##     instruments.enable()          # or MAGIS_INSTRUMENT=1 in the environment
+##     lux.posterior(X)
+##     instruments.snapshot()['timers']['model.posterior']['p99']
+##
+## the library's hot paths are wrapped with @instrumented(name), and it counts
+## rows evaluated ('model.rows'), posterior cache hits and misses ('cache.hits',
+## 'cache.misses') and served requests ('serving.requests'). while the
+## registry is disabled that costs one attribute check per call.
+
+## histogram bucket upper edges in seconds: 1us, 2us, 4us, ... ~1100s
+BUCKETS = tuple(1e-6 * 2**i for i in range(31))
+
+
+class LatencyHistogram(object):
+    ''' per-call latencies in power-of-two buckets, plus exact count/total/min/max '''
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.n = 0
+        self.total = 0.
+        self.min = float('inf')
+        self.max = 0.
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.n += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        ''' upper edge of the bucket holding the q-th quantile (never above max) '''
+        if self.n == 0:
+            return 0.
+        rank = q * self.n
+        seen = 0
+        for edge, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(edge, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'n': self.n, 'total': self.total,
+                'mean': self.total / self.n if self.n else 0.,
+                'min': self.min if self.n else 0., 'max': self.max,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99),
+                'buckets': dict((edge, count) for edge, count in zip(BUCKETS + ('inf',), self.counts)
+                                if count)}
+
+
+class _Timing(object):
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NoTiming(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_no_timing = _NoTiming()
+
+
+class Instruments(object):
+    ''' named timers and counters; everything is a no-op until enable() '''
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.timers = {}
+            self.counters = {}
+
+    def observe(self, name, seconds):
+        with self._lock:
+            if name not in self.timers:
+                self.timers[name] = LatencyHistogram()
+            self.timers[name].observe(seconds)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def timer(self, name):
+        ''' with instruments.timer('name'): ... '''
+        if not self.enabled:
+            return _no_timing
+        return _Timing(self, name)
+
+    def snapshot(self):
+        with self._lock:
+            return {'enabled': self.enabled,
+                    'timers': dict((name, h.snapshot()) for name, h in self.timers.items()),
+                    'counters': dict(self.counters)}
+
+instruments = Instruments(enabled=os.environ.get('MAGIS_INSTRUMENT', '') not in ('', '0'))
+
+
+def instrumented(name, registry=instruments):
+    ''' decorator: time every call of the function under name while the registry is enabled '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                registry.observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
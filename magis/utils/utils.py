@@ -7,9 +7,68 @@ from scipy.stats import norm, beta
 import os
 import scipy.special as scispec
 import time
+import queue
+import threading
 import magis
 
 
+def cache_path(*parts):
+    """
+    Location for files magis derives from its shipped assets (compiled models, 
+    corpus stores). Defaults to ~/.cache/magis; set MAGIS_CACHE to move it.
+    Creates the parent directory of the returned path.
+    """
+    root = os.environ.get('MAGIS_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'magis'))
+    path = os.path.join(root, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def prefetched(iterable, depth=2):
+    """
+    Iterate over iterable while a background thread runs up to depth items ahead.
+    Exceptions in the producer are re-raised in the consumer; closing the 
+    generator early stops the thread.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(entry):
+        ''' False once the consumer has gone away '''
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((done, e))
+            return
+        put((done, None))
+
+    thread = threading.Thread(target=produce, name='prefetched')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
 ## TODO: profile this against the itertools.tee version
 def unzip(xys):
     return [[x[i] for x in xys] for i in range(len(xys[0]))]
@@ -19,6 +78,9 @@ def make_kth_slice(data,k,k_size):
     """
     Input: data matrix, the current slice index and the size of each slice,
     Outpt: Data minus kth slice, kth slice of data
+
+    Copies both parts; kept as the reference for magis.data.folds.KFold,
+    which does the same without copying.
     """
     indices = np.ones(len(data),dtype=bool)
     indices[k*k_size:(k+1)*k_size]=np.zeros(k_size,dtype=bool)
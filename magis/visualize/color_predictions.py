@@ -3,43 +3,87 @@ import matplotlib as mpl
 import seaborn as sns
 
 import colorsys
+import functools
+
+import numpy as np
+
+def hsv_to_rgb(hsv):
+    '''
+    colorsys.hsv_to_rgb over the rows of an (N, 3) array, with the same
+    arithmetic (including for hues outside [0, 1])
+    '''
+    h, s, v = hsv[:, 0], hsv[:, 1], hsv[:, 2]
+    i = np.trunc(h * 6.0)
+    f = h * 6.0 - i
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    i = i.astype(np.int64) % 6
+    return np.stack([np.choose(i, [v, q, p, p, t, v]),
+                     np.choose(i, [t, v, v, q, p, p]),
+                     np.choose(i, [p, p, t, v, v, q])], axis=1)
 
 def enforce_arguments(out_func):
-    def func(*args):
-        if isinstance(args[0], (list, tuple)) and len(args) == 1:
+    '''
+    converters take h, s, v or (h, s, v) and return an (r, g, b) tuple, or
+    take an (N, 3) array (or a list of colors) and return an (N, 3) array
+    '''
+    @functools.wraps(out_func)
+    def func(self, *args):
+        if len(args) == 1 and np.ndim(args[0]) == 2:
+            return out_func(self, np.array(args[0], dtype=np.float64))
+        if len(args) == 1 and isinstance(args[0], (list, tuple, np.ndarray)):
             args = args[0]
         elif isinstance(args[0], (list,tuple)):
             raise Exception("Use map to apply to multiple colors")
-        args = tuple(args)
-        return out_func(*args)
+        rgb = out_func(self, np.array([args], dtype=np.float64))
+        return tuple(float(c) for c in rgb[0])
     return func
 
 
 class Convert(object):
     @enforce_arguments
-    def normalized_adjusted_hsv(self, *hsv):
-        h,s,v = hsv
-        if h < 0:
-            h += 1.0
-        return colorsys.hsv_to_rgb(h,s,v)
+    def normalized_adjusted_hsv(self, hsv):
+        hsv[:, 0] = np.where(hsv[:, 0] < 0, hsv[:, 0] + 1.0, hsv[:, 0])
+        return hsv_to_rgb(hsv)
 
     @enforce_arguments
-    def normalized_hsv(self, *hsv):
-        return colorsys.hsv_to_rgb(*hsv)
+    def normalized_hsv(self, hsv):
+        return hsv_to_rgb(hsv)
 
     @enforce_arguments
-    def scaled_hsv(self, *hsv):
-        h,s,v = hsv
-        h /= 360.
-        s /= 100.
-        v /= 100.
-        return self.normalized_hsv(h,s,v)
+    def scaled_hsv(self, hsv):
+        return self.normalized_hsv(hsv / np.array([360., 100., 100.]))
 
 Convert = Convert()
 
+CONVERTERS = ('normalized_hsv', 'scaled_hsv', 'normalized_adjusted_hsv')
+
+_glyphs = []
+
+def _glyph_table():
+    '''
+    (128, h, w) uint8 ink of PIL's built-in fixed-width bitmap font, one 
+    entry per ascii code; rendered once
+    '''
+    if not _glyphs:
+        from PIL import Image, ImageDraw, ImageFont
+        font = getattr(ImageFont, 'load_default_imagefont', ImageFont.load_default)()
+        if hasattr(font, 'getbbox'):
+            _, _, w, h = font.getbbox('W')
+        else:
+            w, h = font.getsize('W')
+        table = np.zeros((128, h, w), dtype=np.uint8)
+        for code in range(32, 127):
+            glyph = Image.new('L', (w, h), 0)
+            ImageDraw.Draw(glyph).text((0, 0), chr(code), fill=255, font=font)
+            table[code] = np.asarray(glyph)
+        _glyphs.append(table)
+    return _glyphs[0]
+
 class Plot(object):
     def __init__(self):
-        self._converters = dict(filter(lambda _: _[0]!="_", Convert.__dict__.keys()))
+        self._converters = CONVERTERS
         self._current_converter = "normalized_hsv"
 
     @property
@@ -48,10 +92,10 @@ class Plot(object):
 
     @converter.setter
     def converter(self, new_converter):
-        if new_converter not in self._converters.keys():
-            raise ValueError("{} not a valid converter;" +
-                             " Use one of: {}".format(new_converter, 
-                                                      ", ".join(self._converters.keys()))) 
+        if new_converter not in self._converters:
+            raise ValueError("{} not a valid converter; Use one of: {}".format(
+                             new_converter, ", ".join(self._converters)))
+        self._current_converter = new_converter
 
     def plot(self, colors, predictions, show=False, prediction_kwargs=None):
         
@@ -122,5 +166,136 @@ class Plot(object):
 
             ax.text(left_x, starting-i*word_spacing, p, fontsize=word_font, family='monospace')
 
+    @staticmethod
+    def _prediction_lines(predictions, topk, word_colsize=20, number_colsize=5):
+        ''' the text lines _predictions would draw, at most topk of them '''
+        format_str = "{:<%d}{:>%d.2f}" % (word_colsize, number_colsize)
+        if isinstance(predictions, dict):
+            predictions = predictions.items()
+        lines = []
+        for p in list(predictions)[:topk]:
+            if isinstance(p, (list, tuple)) and len(p) == 2:
+                p = format_str.format(p[0], float(p[1]))
+            lines.append(str(p))
+        return lines
+
+    def atlas(self, colors, predictions=None, columns=4, topk=5, swatch=48, 
+              text_width=180, converter=None):
+        '''
+        render many colors and their predictions into one RGB image.
+
+        Args:
+            colors:         (N, 3) array or list of colors, in the converter's space
+            predictions:    one entry per color in any form _predictions takes,
+                            or a BatchDistribution (its top-k per color is used)
+            columns:        cells per row; each cell is a swatch and a text panel
+            topk:           prediction lines per cell
+            converter:      name of a Convert method; defaults to self.converter
+        Returns:
+            (H, W, 3) uint8 array. swatches and text are written with a few
+            array operations (the text from a cached glyph table), so nothing
+            is drawn per color and there are no matplotlib artists.
+        '''
+        converter = getattr(Convert, converter) if converter else self.converter
+        rgb = converter(np.atleast_2d(np.asarray(colors, dtype=np.float64)))
+        n = len(rgb)
+        if predictions is not None and hasattr(predictions, 'top_indices'):
+            predictions = predictions.top(topk)
+
+        glyphs = _glyph_table()
+        _, glyph_h, glyph_w = glyphs.shape
+        rows = -(-n // columns)
+        cell_h = max(swatch, glyph_h * topk + 4)
+        cell_w = swatch + text_width
+        image = np.full((rows * cell_h, columns * cell_w, 3), 255, dtype=np.uint8)
+
+        ## one write for all swatches: paint a (rows, columns) grid of colors up to cell size
+        grid = np.full((rows * columns, 3), 255, dtype=np.uint8)
+        grid[:n] = np.clip(np.round(rgb * 255), 0, 255).astype(np.uint8)
+        cells = image.reshape(rows, cell_h, columns, cell_w, 3)
+        cells[:, :swatch, :, :swatch] = grid.reshape(rows, 1, columns, 1, 3)
+
+        if predictions is not None:
+            ## every cell's text as a (cells, topk, chars) array of glyph codes
+            width = (text_width - 4) // glyph_w
+            codes = np.full((rows * columns, topk, width), ord(' '), dtype=np.uint8)
+            for i, prediction in zip(range(n), predictions):
+                for j, line in enumerate(self._prediction_lines(prediction, topk)):
+                    line = line[:width].encode('ascii', 'replace')
+                    codes[i, j, :len(line)] = np.frombuffer(line, dtype=np.uint8)
+            ## (cells, topk, chars, glyph_h, glyph_w) -> (cells, topk*glyph_h, chars*glyph_w)
+            ink = glyphs[np.minimum(codes, len(glyphs) - 1)]
+            ink = ink.transpose(0, 1, 3, 2, 4).reshape(rows, columns, topk * glyph_h, width * glyph_w)
+            panel = cells[:, 2:2 + topk * glyph_h, :, swatch + 4:swatch + 4 + width * glyph_w]
+            panel[...] = (255 - ink.transpose(0, 2, 1, 3))[..., None]
+        return image
+
+    def decision_map(self, maps, hue=None, saturation=None, value=None):
+        '''
+        draw one plane of a DecisionMaps: the winning term's region (each
+        filled with the mean color of the points it wins), the winning
+        probability and the posterior entropy. fix all but two axes, e.g.
+        decision_map(maps, value=50.). returns the figure
+
+        the maps are in the model's units (hue in degrees, saturation and
+        value in 0-100), so they are always converted with scaled_hsv, 
+        whatever self.converter is
+        '''
+        plane = maps.slice(hue, saturation, value)
+        if len(plane['dims']) != 2:
+            raise ValueError("fix all but two of hue, saturation and value")
+        converter = Convert.scaled_hsv
+        fixed = [maps.axes[i][np.abs(maps.axes[i] - f).argmin()]
+                 for i, f in enumerate((hue, saturation, value)) if f is not None]
+
+        ## the color of every point of the plane, then the mean color per winner
+        grids = np.meshgrid(*plane['axes'], indexing='ij')
+        points = np.empty(grids[0].shape + (3,))
+        names = ('hue', 'saturation', 'value')
+        for i, name in enumerate(names):
+            points[..., i] = grids[plane['dims'].index(name)] if name in plane['dims'] else fixed.pop(0)
+        rgb = converter(points.reshape(-1, 3))
+        winners = plane['argmax'].ravel()
+        counts = np.bincount(winners, minlength=len(maps.names)).astype(np.float64)
+        mean_rgb = np.stack([np.bincount(winners, rgb[:, c], len(maps.names)) for c in range(3)], axis=1)
+        mean_rgb /= np.maximum(counts, 1)[:, None]
+        regions = np.clip(mean_rgb[plane['argmax']], 0, 1)
+
+        (x_axis, y_axis), (x_name, y_name) = plane['axes'], plane['dims']
+        extent = (y_axis[0], y_axis[-1], x_axis[-1], x_axis[0])
+        fig, axes = plt.subplots(1, 3, figsize=(15, 5))
+        panels = ((regions, 'winning term', None), (plane['max_prob'], 'max probability', 'viridis'),
+                  (plane['entropy'], 'entropy (nats)', 'magma'))
+        for ax, (image, title, cmap) in zip(axes, panels):
+            shown = ax.imshow(image, cmap=cmap, extent=extent, aspect='auto', interpolation='nearest')
+            ax.set_title(title)
+            ax.set_xlabel(y_name)
+            ax.set_ylabel(x_name)
+            if cmap is not None:
+                fig.colorbar(shown, ax=ax)
+        return fig
+
+    def save_atlas(self, path, colors, predictions=None, per_page=None, **atlas_kwargs):
+        '''
+        write atlas() images. with per_page, the colors are split into pages
+        and path is formatted with the page number (e.g. 'report_{:03d}.png');
+        more than one page needs that placeholder in path. 
+        returns the paths written.
+        '''
+        n = len(colors)
+        per_page = per_page or n
+        if per_page < n and path.format(0) == path.format(1):
+            raise ValueError("{} pages need a page number placeholder in path, "
+                             "e.g. 'report_{{:03d}}.png'; got {}".format(-(-n // per_page), path))
+        if predictions is not None and hasattr(predictions, 'top_indices'):
+            predictions = predictions.top(atlas_kwargs.get('topk', 5))
+        written = []
+        for page, start in enumerate(range(0, n, per_page)):
+            target = path.format(page) if per_page < n else path
+            chunk = None if predictions is None else predictions[start:start+per_page]
+            plt.imsave(target, self.atlas(colors[start:start+per_page], chunk, **atlas_kwargs))
+            written.append(target)
+        return written
+
 
 Plot = Plot()
\ No newline at end of file
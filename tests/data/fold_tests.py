@@ -0,0 +1,62 @@
+from nose.tools import assert_equal
+
+import numpy as np
+
+from magis.data.folds import KFold
+from magis.utils.utils import make_kth_slice
+
+
+class _Split(object):
+    ''' the parts of an active dataset form that KFold reads '''
+    def __init__(self, counts):
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        n = int(offsets[-1])
+        self.mats = {'train': np.arange(3 * n, dtype=np.float64).reshape(n, 3)}
+        self.labels = {'train': np.repeat(np.arange(len(counts)), counts)}
+        self.offsets = {'train': offsets}
+
+
+class _Dataset(object):
+    def __init__(self, counts):
+        self._active_df = _Split(counts)
+
+
+def _fold_size(fold):
+    return fold.size('test')
+
+
+def test_kfold():
+    dataset = _Dataset([7, 1, 12, 30, 5])
+    X = dataset._active_df.mats['train']
+    y = dataset._active_df.labels['train']
+    n = len(y)
+
+    ## unshuffled folds of equal size match the copying reference and are views
+    folds = KFold(dataset, k=5)
+    for fold in folds:
+        train, test = make_kth_slice(X, fold.number, n // 5)
+        assert np.array_equal(fold.data('test')[0], test)
+        assert np.array_equal(fold.data('train')[0], train)
+        assert np.shares_memory(fold.data('test')[0], X)
+        batched = np.concatenate([x for x, _ in fold.batches('train', batch_size=4)])
+        assert np.array_equal(batched, train)
+
+    for kwargs in ({'shuffle': True}, {'stratify': True}, {'stratify': True, 'shuffle': True}):
+        folds = KFold(dataset, k=4, seed=0, **kwargs)
+        tests = [fold.indices('test') for fold in folds]
+        ## every row is tested exactly once, and never trained on in its fold
+        assert np.array_equal(np.sort(np.concatenate(tests)), np.arange(n))
+        for fold, test in zip(folds, tests):
+            assert_equal(fold.size('test') + fold.size('train'), n)
+            assert not np.intersect1d(test, fold.indices('train')).size
+            x, labels = fold.data('test')
+            assert np.array_equal(x, X[test])
+            assert np.array_equal(labels, y[test])
+        if kwargs.get('stratify'):
+            ## each color's rows are spread over the folds within one row
+            per_fold = np.array([np.bincount(y[test], minlength=5) for test in tests])
+            assert (per_fold.max(axis=0) - per_fold.min(axis=0) <= 1).all()
+
+    folds = KFold(dataset, k=3, stratify=True, shuffle=True, seed=1)
+    assert_equal(folds.map(_fold_size, workers=2), folds.map(_fold_size))
@@ -0,0 +1,219 @@
+from nose.tools import assert_equal, assert_raises
+
+import os
+import time
+import tempfile
+import threading
+
+import numpy as np
+
+from magis.data.interface.xkcdcolor import xkcdcolor
+from magis.data.interface.xkcdcolor.store import CorpusStore
+from magis.utils import prefetched
+
+NAMES = ['teal', 'light green', 'red', 'greyish pink', 'mauve']
+
+
+def _dataset(names=NAMES):
+    ''' a Dataset over a few colors, so tests parse a handful of files '''
+    dataset = xkcdcolor.Dataset()
+    dataset.index = {name: dataset.index[name] for name in dataset.index if name in names}
+    return dataset
+
+
+def _assert_same_items(left, right):
+    assert_equal(sorted(left), sorted(right))
+    for name in left:
+        assert_equal(sorted(left[name]), sorted(right[name]))
+        for key in left[name]:
+            assert np.allclose(left[name][key], right[name][key])
+
+
+def test_pool_ingestion():
+    serial = _dataset()
+    serial.load_all()
+    serial.convert_all()
+    pooled = _dataset()
+    pooled.load_all(workers=2, convert=True)
+    _assert_same_items(serial.loaded, pooled.loaded)
+    ## the conversion moves some hues below 0, so it did run
+    assert min(item['raw', 'train'][:, 0].min() for item in pooled.loaded.values()) < 0
+
+
+def test_corpus_store():
+    previous = os.environ.get('MAGIS_CACHE')
+    os.environ['MAGIS_CACHE'] = tempfile.mkdtemp()
+    try:
+        parsed = _dataset()
+        assert_equal(CorpusStore.open(parsed.index, xkcdcolor.HERE), None)
+        parsed.load_all(convert=True)
+        expected = parsed.loaded
+
+        ## the first full load parses the json and writes the store
+        first = _dataset()
+        first.load()
+        store = CorpusStore.open(first.index, xkcdcolor.HERE)
+        assert store is not None
+        assert_equal(store.names, [name for name in first.index])
+        assert_equal(store.forms, ['raw', 'scaled'])
+        assert_equal(store.splits, ['dev', 'test', 'train'])
+
+        ## later loads are served from it, row for row
+        second = _dataset()
+        second.load()
+        assert isinstance(second.loaded, xkcdcolor.LazyCorpus)
+        assert second.loaded.store is not None
+        _assert_same_items(expected, {name: second.loaded[name] for name in second.loaded})
+        for split in ('train', 'dev', 'test'):
+            assert_equal(second.loaded[NAMES[0]]['raw', split].dtype, np.float32)
+            for i, name in enumerate(store.names):
+                rows = store.rows(i, 'raw', split)
+                assert isinstance(rows, np.memmap)
+                assert (store.labels[split][store.offsets[split][i]:store.offsets[split][i+1]] == i).all()
+                assert np.allclose(second.rows(name, split), expected[name]['raw', split])
+
+        ## a different corpus index never opens this store
+        fewer = _dataset(NAMES[:2])
+        assert_equal(CorpusStore.open(fewer.index, xkcdcolor.HERE), None)
+    finally:
+        if previous is None:
+            del os.environ['MAGIS_CACHE']
+        else:
+            os.environ['MAGIS_CACHE'] = previous
+
+
+def test_split_assembly():
+    dataset = _dataset()
+    dataset.load(use_store=False)
+    for form in ('raw', 'scaled'):
+        dataset.make_datasets(form)
+        df = dataset._active_df
+        names = [name for name in dataset.index]
+        assert_equal(df.names, names)
+        assert_equal(dataset.names, names)
+        for split in ('train', 'dev', 'test'):
+            ## the one-buffer assembly against plain concatenation
+            parts = [dataset.loaded[name][form, split] for name in names]
+            assert np.array_equal(df.mats[split], np.concatenate(parts))
+            assert np.array_equal(df.labels[split], np.concatenate(
+                [np.full(len(D), dataset.name2index(name)) for name, D in zip(names, parts)]))
+            assert_equal(df.n[split], sum(len(D) for D in parts))
+            for name, D in zip(names, parts):
+                rows = dataset.rows(name, split)
+                assert np.array_equal(rows, D)
+                assert np.shares_memory(rows, df.mats[split])
+    assert_equal(dataset.training_size, sum(len(dataset.loaded[name]['scaled', 'train']) 
+                                            for name in NAMES))
+    ## switching back to a form reuses its matrices
+    raw = dataset._datasets['raw']
+    dataset.make_datasets('raw')
+    assert dataset._active_df is raw
+
+
+def _sorted_rows(batches):
+    X = np.concatenate([x for x, _ in batches])
+    y = np.concatenate([y for _, y in batches])
+    order = np.lexsort((X[:, 2], X[:, 1], X[:, 0], y))
+    return X[order], y[order]
+
+def _producers():
+    return [t for t in threading.enumerate() if t.name == 'prefetched']
+
+def test_generate_batches():
+    dataset = _dataset(NAMES[2:])
+    dataset.load(use_store=False)
+    matrix, labels = dataset._active_df.mats['train'], dataset._active_df.labels['train']
+    n = dataset.training_size
+
+    ordered = list(dataset.generate_batches(batch_size=500, shuffle=False))
+    assert_equal([len(x) for x, _ in ordered[:-1]], [500] * (len(ordered) - 1))
+    assert np.array_equal(np.concatenate([x for x, _ in ordered]), matrix)
+    assert np.array_equal(np.concatenate([y for _, y in ordered]), labels)
+
+    ## a shuffled epoch visits every row exactly once
+    expected = _sorted_rows([(matrix, labels)])
+    for prefetch in (0, 2):
+        shuffled = list(dataset.generate_batches(batch_size=500, prefetch=prefetch))
+        assert_equal(sum(len(y) for _, y in shuffled), n)
+        for got, want in zip(_sorted_rows(shuffled), expected):
+            assert np.array_equal(got, want)
+    prefetched_batches = list(dataset.generate_batches(batch_size=500, shuffle=False, prefetch=3))
+    for (x1, y1), (x2, y2) in zip(ordered, prefetched_batches):
+        assert np.array_equal(x1, x2) and np.array_equal(y1, y2)
+
+    forever = dataset.generate_batches(batch_size=n // 2 + 1, forever=True, prefetch=2)
+    assert_equal(sum(len(y) for _, y in (next(forever) for _ in range(5))), n * 2 + n // 2 + 1)
+    forever.close()
+
+def test_prefetch_shutdown():
+    ## closed early, with the queue full and the producer waiting on it
+    for total in (3, 100):
+        batches = prefetched(iter(range(total)), depth=2)
+        assert_equal(next(batches), 0)
+        time.sleep(0.3)
+        batches.close()
+    ## closed from a forever generator
+    dataset = _dataset(NAMES[3:])
+    dataset.load(use_store=False)
+    batches = dataset.generate_batches(batch_size=64, forever=True, prefetch=4)
+    next(batches)
+    batches.close()
+    deadline = time.time() + 5
+    while _producers() and time.time() < deadline:
+        time.sleep(0.05)
+    assert_equal(_producers(), [])
+
+    ## errors in the producer surface in the consumer
+    def failing():
+        yield 1
+        raise RuntimeError('producer failed')
+    batches = prefetched(failing())
+    assert_equal(next(batches), 1)
+    assert_raises(RuntimeError, next, batches)
+
+
+def test_selective_loading():
+    parsed = _dataset()
+    parsed.load_all(convert=True)
+
+    dataset = _dataset()
+    dataset.load(use_store=False, splits=('train',), forms=('raw',), names=NAMES[1:3])
+    ## nothing is read until the data is used
+    assert isinstance(dataset.loaded, xkcdcolor.LazyCorpus)
+    assert_equal(dataset.loaded._items, {})
+    assert_equal(list(dataset.loaded), [name for name in dataset.index if name in NAMES[1:3]])
+    assert 'teal' not in dataset.loaded
+
+    assert_equal(dataset.training_size, sum(len(parsed.loaded[name]['raw', 'train']) 
+                                            for name in NAMES[1:3]))
+    assert_equal(dataset.development_size, 0)
+    for name in NAMES[1:3]:
+        ## only the selected split and form are kept, converted as in a full load
+        assert_equal(list(dataset.loaded._items[name]), [('raw', 'train')])
+        assert np.array_equal(dataset.rows(name), parsed.loaded[name]['raw', 'train'])
+
+def test_release():
+    parsed = _dataset()
+    parsed.load_all(convert=True)
+
+    dataset = _dataset()
+    dataset.load(form='scaled', use_store=False, splits=('train', 'dev'))
+    dataset.loaded.materialize()
+    assert_equal(sorted(dataset.loaded._items), sorted(NAMES))
+    dataset.training_size
+
+    ## dropping one form of one color keeps everything else
+    dataset.release(names=['red'], forms=('raw',))
+    assert_equal(sorted(dataset.loaded._items['red']), [('scaled', 'dev'), ('scaled', 'train')])
+    assert_equal(len(dataset.loaded._items['mauve']), 4)
+    assert 'scaled' in dataset._datasets
+
+    ## a full release frees everything; the next use reads it all again
+    dataset.release()
+    assert_equal(dataset.loaded._items, {})
+    assert_equal(dataset._datasets, {})
+    assert_equal(dataset.training_size, sum(len(parsed.loaded[name]['scaled', 'train']) 
+                                            for name in NAMES))
+    _assert_same_items({name: dataset.loaded[name] for name in dataset.loaded},
+                       {name: {key: D for key, D in item.items() if key[1] != 'test'}
+                        for name, item in parsed.loaded.items()})
@@ -23,3 +23,54 @@ def test():
         assert_equal(mod.predict(0), mod.components[0])
         assert_equal(mod.likelihood(0, 'TestComponent'), 1.0)
         assert_equal(mod.posterior(0), np.array([1.0]))
+
+def test_distribution():
+    names = ['a', 'b', 'c']
+    numbers = np.array([0.2, 0.5, 0.3])
+    dist = magis.models.abstract.Distribution(names, numbers)
+    assert_equal(dist['b'], 0.5)
+    assert_equal(dist.b, 0.5)
+    assert_equal(list(dist.top2.keys()), ['b', 'c'])
+    assert_equal(dist.sortd[0], ('b', 0.5))
+
+    batch = magis.models.abstract.BatchDistribution(names, np.stack([numbers, [0.1, 0.2, 0.7]], axis=1))
+    assert_equal(len(batch), 2)
+    assert_equal(list(batch['a']), [0.2, 0.1])
+    assert_equal(list(batch[1].top1.keys()), ['c'])
+    assert_equal([list(t.keys()) for t in batch.top1], [['b'], ['c']])
+
+def test_instruments():
+    from magis.utils import instruments
+    mod = TestModel.from_json(os.path.join(HERE,'abstract_model.json'), TestComponent)
+    instruments.reset()
+    mod.posterior(0)
+    assert_equal(instruments.snapshot()['timers'], {})
+    instruments.enable()
+    try:
+        mod.posterior(0)
+        mod.posterior(0)
+        with instruments.timer('caller'):
+            mod.predict(0)
+        instruments.count('requests', 3)
+    finally:
+        instruments.disable()
+    snapshot = instruments.snapshot()
+    assert_equal(snapshot['timers']['model.posterior']['n'], 2)
+    assert_equal(snapshot['timers']['model.predict']['n'], 1)
+    assert snapshot['timers']['caller']['max'] >= snapshot['timers']['model.predict']['max']
+    assert_equal(snapshot['counters'], {'requests': 3, 'model.rows': 3})
+    instruments.reset()
+
+    mod.use_cache()
+    instruments.enable()
+    try:
+        mod.posterior(0)
+        mod.posterior(0)
+        mod.posterior(1)
+    finally:
+        instruments.disable()
+    counters = instruments.snapshot()['counters']
+    assert_equal((counters['cache.hits'], counters['cache.misses']), (1, 2))
+    assert_equal(counters['cache.hits'] + counters['cache.misses'], 
+                 mod.cache_stats()['hits'] + mod.cache_stats()['misses'])
+    instruments.reset()
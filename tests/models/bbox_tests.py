@@ -0,0 +1,48 @@
+from nose.tools import assert_equal
+
+import numpy as np
+
+from magis.utils.cyutils import BoundingBox, BoundingBoxSet
+
+
+def _random_boxes(rng, n):
+    xy = rng.uniform(0, 100, size=(n, 2))
+    wh = rng.uniform(0, 8, size=(n, 2))
+    return BoundingBoxSet(np.concatenate([xy, xy + wh], axis=1))
+
+
+def _brute_pairs(mask, upper=False):
+    if upper:
+        mask = np.triu(mask, 1)
+    return np.argwhere(mask)
+
+
+def test_bounding_box_set():
+    rng = np.random.RandomState(0)
+    boxes = _random_boxes(rng, 300)
+    others = _random_boxes(rng, 200)
+    ## an exact duplicate, a shared edge and a nested box
+    boxes.coords[1] = boxes.coords[0]
+    boxes.coords[2] = [boxes.coords[0, 2], 0., boxes.coords[0, 2] + 1., 100.]
+    others.coords[0] = boxes.coords[3] + [1e-3, 1e-3, -1e-3, -1e-3]
+
+    assert np.array_equal(boxes.intersection_pairs(others), _brute_pairs(boxes.intersects(others)))
+    assert np.array_equal(boxes.intersection_pairs(), _brute_pairs(boxes.intersects(boxes), upper=True))
+    assert np.array_equal(boxes.containment_pairs(others), _brute_pairs(boxes.contains(others)))
+    contains = boxes.contains(boxes)
+    np.fill_diagonal(contains, False)
+    assert np.array_equal(boxes.containment_pairs(), _brute_pairs(contains))
+
+    iou = boxes.iou(others)
+    pairs, values = boxes.iou_pairs(others, threshold=0.1)
+    assert np.array_equal(pairs, _brute_pairs(iou > 0.1))
+    assert np.allclose(values, iou[iou > 0.1])
+    assert np.isclose(boxes.iou(boxes)[0, 1], 1.)
+
+    ## one against many agrees with the scalar BoundingBox where it checks corners
+    box = BoundingBox(10., 10., 30., 30.)
+    assert np.array_equal(boxes.intersects(box), boxes.intersects(np.array([box.coords]))[:, 0])
+    corners = [boxes[i].intersects(box) for i in range(len(boxes))]
+    assert (boxes.intersects(box)[np.array(corners)]).all()
+    assert_equal(BoundingBoxSet.from_xywh([[1, 2, 3, 4]]).coords.tolist(), [[1, 2, 4, 6]])
+    assert_equal(len(BoundingBoxSet(np.zeros((0, 4))).intersection_pairs()), 0)
@@ -39,3 +39,29 @@ def test():
     assert_equal(np.allclose(cb(349), db(4.0)), True)
 
 
+def test_array_matches_scalar():
+    db = DualBoundaries.from_parameters(3.0, 2.0, 20.0, 5.0, 1.5, 40.0)
+    cb = CircularBoundaries.from_parameters(3.0, 2.0, -20, 5.0, 1.5, 10.0, True)
+    x = np.linspace(-400, 400, 801)
+    for b in (db, cb):
+        ref = np.array([b(float(x_i)) for x_i in x])
+        assert_equal(np.allclose(b(x), ref), True)
+        # strided and single precision inputs take the same path
+        assert_equal(np.allclose(b(x[::3]), ref[::3]), True)
+        assert_equal(np.allclose(b(x.astype(np.float32)), ref), True)
+        # scalars and arrays can alternate freely
+        assert_equal(b(x[0]), ref[0])
+        assert_equal(np.allclose(b(x[:2]), ref[:2]), True)
+
+def test_log_dual_survival():
+    from magis.models.abstract import dual_survival, log_dual_survival
+    x = np.linspace(-2000, 2000, 4001)
+    params = (0.5, 3.0, -10.0, 1.5, 0.4, 25.0)
+    linear = dual_survival(x, *params)
+    logged = log_dual_survival(x, *params)
+    finite = linear > 0
+    assert np.allclose(logged[finite], np.log(linear[finite]), rtol=1e-12, atol=1e-12)
+    # past the underflow the log keeps decreasing instead of hitting -inf
+    assert np.isfinite(logged).all()
+    assert (np.diff(logged[x > 25.0]) < 0).all()
+    assert (np.diff(logged[x < -10.0]) > 0).all()
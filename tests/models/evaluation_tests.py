@@ -0,0 +1,98 @@
+from nose.tools import assert_equal, assert_not_equal, assert_raises, raises
+
+import numpy as np
+
+from magis.models import Lux
+from magis.models.evaluation import evaluate, RunningScores
+from magis.data.interface.xkcdcolor import xkcdcolor
+
+NAMES = ['teal', 'light green', 'red', 'greyish pink', 'mauve']
+
+
+def _dataset():
+    dataset = xkcdcolor.Dataset()
+    dataset.index = {name: dataset.index[name] for name in NAMES}
+    dataset.load(form='raw', use_store=False, splits=('dev',))
+    return dataset
+
+def _models():
+    lux = Lux.pretrained()
+    ## 'greyish pink' is left out of the first model, so its rows are oov
+    known = ['teal', 'light green', 'red', 'mauve', 'cherry', 'rose red', 'deep teal']
+    return {'known': lux.subset(known), 'all': lux.subset(NAMES + ['cherry'])}
+
+def _direct(model, dataset, split):
+    ''' the scores from the full posterior of every row at once '''
+    dataset.make_datasets('scaled')
+    X, y = dataset._active_df.mats[split], dataset._active_df.labels[split]
+    names = [c.name for c in model.components]
+    targets = np.array([names.index(dataset.index2name(i)) if dataset.index2name(i) in names else -1
+                        for i in y])
+    known = targets >= 0
+    p_vec = model.posterior(X[known]).numbers
+    p_true = p_vec[targets[known], np.arange(known.sum())]
+    rank = (p_vec > p_true).sum(axis=0)
+    ## rows with no mass on the true label count as 1e-300
+    log_true = np.log(np.maximum(p_true, 1e-300))
+    n = known.sum()
+    return {'n': n, 'oov': len(y) - n,
+            'accuracy': (p_vec.argmax(axis=0) == targets[known]).mean(),
+            'top5': (rank < 5).mean(),
+            'log_likelihood': log_true.sum(),
+            'perplexity': np.exp(-log_true.mean())}
+
+def _assert_scores(scores, expected):
+    for key, value in expected.items():
+        assert_equal(np.isclose(scores[key], value, rtol=1e-9), True)
+
+def test_evaluate():
+    dataset = _dataset()
+    models = _models()
+    result = evaluate(models, dataset, split='dev', chunk_size=1000, progress=False)
+    scores = result['models']
+    assert_equal(sorted(scores), ['all', 'known'])
+    ## the dataset is left on the form it was on
+    assert_equal(dataset.current_form, 'raw')
+    for name, model in models.items():
+        _assert_scores(scores[name], _direct(model, dataset, 'dev'))
+    assert_equal(scores['known']['oov'], dataset.development_size - scores['known']['n'])
+    assert_not_equal(scores['known']['oov'], 0)
+    assert_equal(scores['all']['oov'], 0)
+    assert_equal(result['throughput']['rows'], dataset.development_size)
+    assert_equal(dataset.size('dev'), dataset.development_size)
+
+    ## chunking and the process pool do not change the result
+    single = evaluate(models['all'], dataset, split='dev', chunk_size=333, progress=False)
+    pooled = evaluate(models, dataset, split='dev', chunk_size=700, workers=2, progress=False)
+    ## a single model is keyed by its name
+    _assert_scores(single['models'][models['all'].name], scores['all'])
+    _assert_scores(pooled['models']['all'], scores['all'])
+    _assert_scores(pooled['models']['known'], scores['known'])
+
+def test_evaluate_log_space():
+    dataset = _dataset()
+    model = _models()['all']
+    linear = evaluate({'all': model}, dataset, split='dev', progress=False)['models']['all']
+    model.use_log_space()
+    logged = evaluate({'all': model}, dataset, split='dev', progress=False)['models']['all']
+    ## scored like the model's own log-space posterior, which keeps the rows
+    ## that underflow in linear space
+    _assert_scores(logged, _direct(model, dataset, 'dev'))
+    assert logged['log_likelihood'] > linear['log_likelihood']
+    assert logged['accuracy'] >= linear['accuracy']
+
+def test_running_scores():
+    p_vec = np.array([[.6, .1, .0],
+                      [.3, .2, .0],
+                      [.1, .7, .0]])
+    p_vec[:, 2] = np.nan
+    scores = RunningScores(topk=(2,))
+    scores.update(p_vec[:, :2], np.array([1, 2]))
+    ## a column without mass (nan once normalized) and an oov row
+    scores.update(p_vec[:, 2:], np.array([0]))
+    scores.update(p_vec[:, :1], np.array([-1]))
+    summary = scores.summary()
+    assert_equal((summary['n'], summary['oov']), (3, 1))
+    assert_equal(summary['accuracy'], 1 / 3.)
+    assert_equal(summary['top2'], 2 / 3.)
+    assert_equal(np.isclose(summary['log_likelihood'], np.log(.3) + np.log(.7) + np.log(1e-300)), True)
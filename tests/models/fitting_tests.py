@@ -0,0 +1,79 @@
+from nose.tools import assert_equal, assert_not_equal, assert_raises, raises
+
+import numpy as np
+
+from magis.models.color import fitting
+
+def test():
+    rng = np.random.RandomState(0)
+    x = rng.uniform(40, 60, 2000)
+    prm = fitting.fit_dimension(x)
+    phi = fitting.dual_survival(np.array([30., 41., 50., 59., 70.]), 
+                                1/prm['scalelower'], prm['shapelower'], prm['mulower'],
+                                1/prm['scaleupper'], prm['shapeupper'], prm['muupper'])
+    # mass where the data is, (almost) none outside of it
+    assert_equal(bool((phi[1:4] > 0.5).all()), True)
+    assert_equal(bool((phi[[0, 4]] < 0.05).all()), True)
+    assert_equal(abs(fitting.normalizer(prm) - 20) < 2, True)
+
+    X = np.stack([rng.uniform(-20, 10, 500), rng.uniform(40, 60, 500), rng.uniform(70, 90, 500)], axis=1)
+    name, info = fitting.fit_component(('red', X, 0.5))
+    assert_equal(name, 'red')
+    assert_equal(info['hue_adjust'], True)
+    assert_equal(len(info['parameters']), 3)
+
+def test_round_trip():
+    import os, json, tempfile
+    from magis.models import Lux
+    from magis.data.interface.xkcdcolor import xkcdcolor
+    names = ['rose red', 'deep teal', 'pale lime', 'cherry']
+    dataset = xkcdcolor.Dataset()
+    dataset.index = {name: dataset.index[name] for name in names}
+    dataset.load(form='scaled', use_store=False)
+    path = tempfile.mkdtemp()
+    info = fitting.fit(dataset, checkpoint_dir=os.path.join(path, 'checkpoints'), 
+                       output=os.path.join(path, 'fitted.json'))
+    lux = Lux.from_json(os.path.join(path, 'fitted.json'))
+    assert_equal(sorted(c.name for c in lux.components), sorted(names))
+
+    # the reloaded posterior is P(label) * the product of the fitted normalized 
+    # densities; the written hue tails are rates, saturation and value tails scales
+    X = np.random.RandomState(1).uniform([-180, 0, 0], [360, 100, 100], size=(200, 3))
+    X = np.concatenate([X, dataset.rows('rose red')[:50]])
+    total = float(sum(len(dataset.rows(name)) for name in names))
+    fitted = dict((c['name'], c['parameters']) for c in info['components'])
+    joint = []
+    for c in lux.components:
+        density = len(dataset.rows(c.name)) / total
+        for d, prm in enumerate(fitted[c.name]['parameters']):
+            prm = dict(prm)
+            if d == 0:
+                prm['scalelower'], prm['scaleupper'] = 1/prm['scalelower'], 1/prm['scaleupper']
+            x = X[:, d]
+            if d == 0 and c.hue_model.adjust_coords:
+                x = (x + 180) % 360 - 180
+            phi = fitting.dual_survival(x, 1/prm['scalelower'], prm['shapelower'], prm['mulower'],
+                                           1/prm['scaleupper'], prm['shapeupper'], prm['muupper'])
+            density = density * phi / fitting.normalizer(prm)
+        joint.append(density)
+    joint = np.array(joint)
+    with np.errstate(invalid='ignore'):
+        posterior = np.asarray(lux.posterior(X))
+    finite = joint.sum(axis=0) > 1e-250
+    assert finite.sum() > 100
+    assert np.allclose(posterior[:, finite], (joint / joint.sum(axis=0))[:, finite], rtol=1e-6, atol=1e-9)
+    assert_equal(np.mean(posterior[:, -50:].argmax(axis=0) == lux.indices('rose red')) > 0.5, True)
+
+    # a rerun takes every label from its checkpoint
+    again = fitting.fit(dataset, checkpoint_dir=os.path.join(path, 'checkpoints'))
+    assert_equal(again, dict(info, name='Lux'))
+
+    # refreshed data or another split does not reuse the old fits
+    for split in ('train', 'dev'):
+        fewer = xkcdcolor.Dataset()
+        fewer.index = {name: fewer.index[name] for name in names[:3]}
+        fewer.load(form='scaled', use_store=False)
+        refit = fitting.fit(fewer, split=split, checkpoint_dir=os.path.join(path, 'checkpoints'))
+        assert_equal(refit, fitting.fit(fewer, split=split))
+        refit = dict((c['name'], c['parameters']) for c in refit['components'])
+        assert_not_equal(refit[names[0]], fitted[names[0]])
@@ -0,0 +1,93 @@
+import tempfile
+
+from magis.models import Lux
+from magis.models.color.grid import PosteriorGrid
+
+import numpy as np
+
+from nose.tools import assert_equal, assert_raises
+
+
+class SmallGrid(PosteriorGrid):
+    ## every hue, but only the low corner of saturation and value, so that a
+    ## build over a handful of components stays quick
+    shape = (541, 11, 11)
+
+
+def _model():
+    lux = Lux.pretrained()
+    return lux.subset([c.name for c in lux.components[:12]])
+
+def _points(n, seed=0):
+    rng = np.random.RandomState(seed)
+    X = np.empty((n, 3))
+    X[:, 0] = rng.uniform(-180, 360, n)
+    X[:, 1:] = rng.uniform(0, 10, (n, 2))
+    return X
+
+def test_grid_matches_posterior():
+    model = _model()
+    grid = SmallGrid.build(model, tempfile.mkdtemp(), k=len(model))
+    assert_equal(grid.names, [c.name for c in model.components])
+
+    ## on grid points the stored tables are the model's own posterior
+    X = np.rint(_points(200))
+    expected = model.posterior(X).numbers
+    assert_equal(np.allclose(grid.posterior(X), expected, atol=1e-6), True)
+    assert_equal(np.array_equal(grid.predict(X), expected.argmax(axis=0)), True)
+    ## negative hues are their own grid points: for labels that are not 
+    ## hue-adjusted, -133 and 227 are different colors, on the grid as in the model
+    assert_equal(all(c.hue_model.adjust_coords for c in model.components), False)
+    pair = np.array([[-133., 3., 2.], [227., 3., 2.]])
+    at_pair = model.posterior(pair).numbers
+    assert_equal(np.allclose(at_pair[:, 0], at_pair[:, 1]), False)
+    assert_equal(np.allclose(grid.posterior(pair), at_pair, atol=1e-6), True)
+    ## outside [-180, 360] hues are taken modulo 360
+    assert_equal(np.array_equal(grid.posterior(pair + [720, 0, 0]), grid.posterior(pair[1:].repeat(2, 0))), True)
+
+    ## between grid points, the interpolated posterior is the trilinear mix
+    ## of the posteriors at the 8 surrounding grid points
+    X = _points(50, seed=1)
+    lower = np.floor(X)
+    frac = X - lower
+    mixed = np.zeros_like(expected[:, :len(X)])
+    for offset in np.ndindex(2, 2, 2):
+        weight = np.prod(np.where(offset, frac, 1 - frac), axis=1)
+        mixed += model.posterior(lower + offset).numbers * weight
+    assert_equal(np.allclose(grid.posterior(X, interpolate=True), mixed, atol=1e-5), True)
+    assert_equal(np.array_equal(grid.predict(X, interpolate=True), mixed.argmax(axis=0)), True)
+
+def test_grid_top_k():
+    model = _model()
+    path = tempfile.mkdtemp()
+    SmallGrid.build(model, path, k=3)
+    grid = SmallGrid.load(path)
+    assert_equal(grid.k, 3)
+
+    X = np.rint(_points(100, seed=2))
+    expected = model.posterior(X).numbers
+    stored = grid.posterior(X)
+    top = np.argsort(-expected, axis=0)[:3]
+    columns = np.arange(len(X))
+    ## the three most probable labels keep their probability, the rest is dropped
+    assert_equal(np.allclose(stored[top, columns], expected[top, columns], atol=1e-6), True)
+    assert_equal(np.count_nonzero(stored, axis=0).max() <= 3, True)
+    assert_equal(np.all(stored.sum(axis=0) <= 1 + 1e-6), True)
+
+    ## a grid of another shape is refused
+    assert_raises(ValueError, PosteriorGrid.load, path)
+
+def test_use_grid():
+    model = _model()
+    grid = SmallGrid.build(model, tempfile.mkdtemp(), k=len(model))
+    X = np.rint(_points(100, seed=3))
+    expected = model.posterior(X).numbers
+    model.use_grid(grid)
+    assert_equal(np.allclose(model.posterior(X).numbers, expected, atol=1e-6), True)
+    assert_equal(model.predict(X), [model.components[i] for i in expected.argmax(axis=0)])
+    model.use_grid(None)
+    assert_equal(np.array_equal(model.posterior(X).numbers, expected), True)
+
+    ## a grid only answers for the components it was built over
+    other = Lux.pretrained()
+    assert_raises(ValueError, other.use_grid, grid)
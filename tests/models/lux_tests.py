@@ -1,4 +1,5 @@
-from magis.models import Lux
+import magis
+from magis.models import Lux, Model
 
 import numpy as np
 
@@ -20,4 +21,318 @@ def test():
     lux.likelihood(d2, 'blue')
     lux.posterior(d2)
 
-test()
\ No newline at end of file
+
+def test_engine():
+    lux = Lux.pretrained()
+    d = np.empty((50,3))
+    d[:,0] = np.linspace(-180, 360, 50)
+    d[:,1] = np.linspace(0, 100, 50)
+    d[:,2] = 70
+    # the compiled path must agree with the per-component path
+    assert_equal(np.allclose(lux.evaluate(d), Model.evaluate(lux, d)), True)
+    assert_equal(np.allclose(lux.evaluate(d[3]), Model.evaluate(lux, tuple(d[3]))), True)
+    assert_equal(lux.evaluate(d).shape, (len(lux), 50))
+
+def test_binary_format():
+    import os, tempfile
+    from magis.models.color import storage
+    source = os.path.join(os.path.dirname(magis.models.color.lux.__file__), 'assets', 'lux.json')
+    target = os.path.join(tempfile.mkdtemp(), 'lux.npy')
+    storage.compile_model(source, target)
+    name, table = storage.load_table(source, target)
+    from_json = Lux.from_json(source)
+    from_table = Lux.from_table(name, table)
+    assert_equal(from_table.name, from_json.name)
+    assert_equal([c.name for c in from_table.components], [c.name for c in from_json.components])
+    d = np.array([[200., 70., 70.], [-20., 10., 90.]])
+    assert_equal(np.array_equal(from_table.evaluate(d), from_json.evaluate(d)), True)
+
+def test_compiled_load():
+    import os, pickle, tempfile
+    from magis.models.color import storage
+    source = os.path.join(os.path.dirname(magis.models.color.lux.__file__), 'assets', 'lux.json')
+    from_json = Lux.from_json(source)
+    d = np.array([[200., 70., 70.], [-20., 10., 90.], [350., 40., 20.]])
+    previous = os.environ.get('MAGIS_CACHE')
+    try:
+        ## a cache that can not be created falls back to the json
+        os.environ['MAGIS_CACHE'] = '/proc/version/magis'
+        assert_equal(storage.load_table(source), None)
+        lux = Lux.load(source)
+        assert_equal(np.array_equal(lux.evaluate(d), from_json.evaluate(d)), True)
+
+        os.environ['MAGIS_CACHE'] = tempfile.mkdtemp()
+        Lux.load(source)
+        target = storage.compiled_path(source)
+        assert storage.load_table(source) is not None
+        lux = Lux.load(source)
+        ## the engine and the lazily built components agree with the json
+        assert_equal(np.array_equal(lux.evaluate(d), from_json.evaluate(d)), True)
+        assert_equal(np.allclose(Model.evaluate(lux, d), from_json.evaluate(d)), True)
+        copy = pickle.loads(pickle.dumps(Lux.load(source)))
+        assert_equal(np.allclose(Model.evaluate(copy, d), from_json.evaluate(d)), True)
+
+        ## a table that changed after it was compiled is not used
+        os.utime(target, ns=(0, 0))
+        assert_equal(storage.load_table(source), None)
+        assert_equal(np.array_equal(Lux.load(source).evaluate(d), from_json.evaluate(d)), True)
+    finally:
+        if previous is None:
+            del os.environ['MAGIS_CACHE']
+        else:
+            os.environ['MAGIS_CACHE'] = previous
+
+def test_pretrained():
+    first, second = Lux.pretrained(), Lux.pretrained()
+    assert_equal(first is second, False)
+    assert_equal(first.components[0] is second.components[0], True)
+    assert_equal(first.engine is second.engine, True)
+    # modes stay with the instance they were set on
+    first.use_cache(maxsize=10)
+    first.use_log_space()
+    first.use_index()
+    assert_equal(Lux.pretrained().cache_stats(), None)
+    assert_equal(Lux.pretrained()._log_space, False)
+    assert_equal(Lux.pretrained().candidate_index, None)
+    first.components = first.components[:10]
+    assert_equal(len(Lux.pretrained()), len(second))
+
+def test_cache():
+    import os
+    source = os.path.join(os.path.dirname(magis.models.color.lux.__file__), 'assets', 'lux.json')
+    lux = Lux.load(source)
+    X = np.round(np.random.RandomState(0).uniform([0, 0, 0], [360, 100, 100], size=(20, 3)), 1)
+    X = np.concatenate([X, X[:5]])
+    expected = np.asarray(lux.posterior(X))
+
+    lux.use_cache(maxsize=100, resolution=0.1)
+    assert np.allclose(np.asarray(lux.posterior(X)), expected)
+    assert_equal(lux.cache_stats()['misses'], 20)
+    assert_equal(lux.cache_stats()['hits'], 5)
+    assert np.allclose(np.asarray(lux.posterior(tuple(X[3]))), expected[:, 3])
+    assert_equal(lux.predict(X[7]), lux.components[expected[:, 7].argmax()])
+    assert_equal(lux.cache_stats()['hits'], 7)
+
+    lux.use_cache(maxsize=10)
+    lux.posterior(X)
+    assert_equal(lux.cache_stats()['size'], 10)
+    assert_equal(lux.cache_stats()['evictions'], 10)
+
+    lux.components = lux.components[:50]
+    assert_equal(lux.cache_stats()['size'], 0)
+    assert_equal(np.asarray(lux.posterior(X)).shape, (50, len(X)))
+
+def test_cache_threads():
+    import threading
+    lux = Lux.pretrained()
+    lux.use_cache()
+    assert_equal(lux.cache_stats()['maxsize'] * len(lux) * 8 < 32 << 20, True)
+    X = np.round(np.random.RandomState(6).uniform([0, 0, 0], [360, 100, 100], size=(40, 3)))
+
+    def work(seed):
+        rng = np.random.RandomState(seed)
+        for _ in range(50):
+            lux.posterior(tuple(X[rng.randint(len(X))]))
+        lux.posterior(X[rng.randint(len(X), size=10)])
+
+    threads = [threading.Thread(target=work, args=(seed,)) for seed in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = lux.cache_stats()
+    assert_equal(stats['hits'] + stats['misses'], 8 * 60)
+    assert_equal(stats['size'], len(X))
+    assert_equal(stats['nbytes'], len(X) * len(lux) * 8)
+
+def test_candidate_index():
+    import os
+    source = os.path.join(os.path.dirname(magis.models.color.lux.__file__), 'assets', 'lux.json')
+    lux = Lux.load(source)
+    X = np.random.RandomState(1).uniform([-180, 0, 0], [360, 100, 100], size=(300, 3))
+    X[:3] = [[180, 50, 50], [-180, 100, 0], [400, 50, 50]]
+    exact = np.asarray(lux.posterior(X))
+
+    lux.use_index(1e-6)
+    assert lux.candidate_index.mean_candidates < len(lux) / 4.
+    pruned = np.asarray(lux.posterior(X))
+    lost = (exact * (pruned == 0)).sum(axis=0)
+    bound = lux.dropped_mass(X)
+    assert (lost <= bound + 1e-12).all()
+    assert bound.max() < 1e-4
+    assert_equal(bound[2], 0.)
+    assert np.allclose(pruned, exact, atol=2 * bound.max())
+    assert_equal(lux.predict(tuple(X[5])), lux.components[exact[:, 5].argmax()])
+
+    lux.use_index(None)
+    assert np.allclose(np.asarray(lux.posterior(X)), exact)
+
+def test_candidate_bounds():
+    from magis.models.color.candidates import CandidateIndex, _extremes
+    lux = Lux.pretrained()
+    engine = lux.engine.subset(np.arange(0, len(lux), 4))
+    index = CandidateIndex(engine, epsilon=1e-2, hue_step=30., sv_step=25.)
+    ## every box's bound from its label extremes: U / (L_kept + U)
+    hue_upper, hue_lower = index._hue_extremes()
+    sat_upper, sat_lower = _extremes(engine.sat, index.edges[1][:-1], index.edges[1][1:])
+    val_upper, val_lower = _extremes(engine.val, index.edges[2][:-1], index.edges[2][1:])
+    upper = (hue_upper[:, None, None] * sat_upper[None, :, None] * val_upper[None, None, :] *
+             engine.availability).reshape(-1, len(engine))
+    lower = (hue_lower[:, None, None] * sat_lower[None, :, None] * val_lower[None, None, :] *
+             engine.availability).reshape(-1, len(engine))
+    kept = np.zeros(upper.shape, dtype=bool)
+    for cell in range(len(kept)):
+        kept[cell, index.candidates(cell)] = True
+    dropped = np.where(kept, 0., upper).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        expected = np.where(dropped > 0, dropped / (np.where(kept, lower, 0.).sum(axis=1) + dropped), 0.)
+    expected = np.nan_to_num(expected, nan=1.0)
+    assert np.allclose(index.bounds, expected)
+    ## counting the dropped labels' lower bounds in L would understate some boxes
+    assert (expected > dropped / (lower.sum(axis=1) + dropped) + 1e-12).any()
+
+def test_log_space():
+    import os
+    source = os.path.join(os.path.dirname(magis.models.color.lux.__file__), 'assets', 'lux.json')
+    lux = Lux.load(source)
+    X = np.random.RandomState(2).uniform([0, 0, 0], [360, 100, 100], size=(200, 3))
+    far = np.array([[200., 1e5, 50.]])
+    reference = np.asarray(lux.posterior(X))
+    with np.errstate(invalid='ignore'):
+        assert np.isnan(np.asarray(lux.posterior(far))).all()
+
+    lux.use_log_space()
+    assert np.allclose(np.asarray(lux.posterior(X)), reference, rtol=1e-10, atol=1e-14)
+    assert np.allclose(np.asarray(lux.posterior(tuple(X[0]))), reference[:, 0], rtol=1e-10, atol=1e-14)
+    p_far = np.asarray(lux.posterior(far))
+    assert np.isfinite(p_far).all()
+    assert np.isclose(p_far.sum(), 1.0)
+
+    lux.use_log_space(dtype=np.float32)
+    p32 = np.asarray(lux.posterior(X))
+    assert_equal(p32.dtype, np.float32)
+    assert np.abs(p32 - reference).max() < 1e-6
+    assert_equal(list(lux.predict(X)), list(lux.components[i] for i in reference.argmax(axis=0)))
+
+def test_likelihoods():
+    lux = Lux.pretrained()
+    X = np.random.RandomState(3).uniform([0, 0, 0], [360, 100, 100], size=(30, 3))
+    X = np.concatenate([X, X[:10]])
+    names = [lux.components[i].name for i in np.random.RandomState(4).randint(0, len(lux), len(X))]
+    posterior = np.asarray(lux.posterior(X))
+    indices = lux.indices(names)
+    expected = posterior[indices, np.arange(len(X))]
+    assert np.allclose(lux.likelihoods(X, names), expected)
+    assert np.allclose(lux.likelihoods(X, indices), expected)
+    # one datum against many names, and many data against one name
+    assert np.allclose(lux.likelihoods(X[0], names[:5]), posterior[indices[:5], 0])
+    assert np.allclose(lux.likelihoods(X, 'blue'), lux.likelihood(X, 'blue'))
+    assert np.allclose(lux.likelihood(X, 'blue'), posterior[lux.indices('blue')])
+    assert_equal(np.ndim(lux.likelihood(tuple(X[1]), 'blue')), 0)
+    assert np.isclose(lux.likelihood(tuple(X[1]), 'blue'), posterior[lux.indices('blue'), 1])
+    evaluated = lux.evaluate(X)
+    assert np.allclose(lux.joint(X, names), evaluated[indices, np.arange(len(X))])
+    assert np.allclose(Model.evaluate_pairs(lux, X[:5], indices[:5]), lux.joint(X[:5], names[:5]))
+    assert_raises(Exception, lux.likelihoods, X[0], 'not a color')
+
+def test_subset():
+    lux = Lux.pretrained()
+    basic = ['red', 'orange', 'yellow', 'green', 'blue', 'purple', 'pink', 'brown', 'grey', 'black', 'white']
+    view = lux.subset(basic)
+    assert_equal(len(view), 11)
+    assert_equal(view.components[4] is lux['blue'], True)
+    assert_equal(len(view.engine), 11)
+    X = np.random.RandomState(5).uniform([0, 0, 0], [360, 100, 100], size=(40, 3))
+    full = lux.evaluate(X)[view.parent_indices]
+    expected = full / full.sum(axis=0)
+    assert np.allclose(np.asarray(view.posterior(X)), expected)
+    assert np.allclose(Model.evaluate(view, X), full)
+    assert_equal(view.predict(tuple(X[0])).name, basic[expected[:, 0].argmax()])
+    assert np.allclose(view.likelihoods(X, 'blue'), expected[4])
+
+    by_index = lux.subset(view.parent_indices[:3])
+    assert_equal([c.name for c in by_index.components], basic[:3])
+    nested = view.subset(['green', 'blue'])
+    assert_equal(list(nested.parent_indices), [3, 4])
+    assert np.allclose(nested.evaluate(X), full[3:5])
+    assert_equal(len(lux), len(Lux.pretrained().components))
+
+    # per-color attributes follow the view's vocabulary
+    assert_equal(view.blue is lux.blue, True)
+    assert_equal(hasattr(view, 'light_blue'), False)
+    assert_equal(hasattr(nested, 'red'), False)
+    assert_equal(hasattr(lux, 'light_blue'), True)
+    lux.components = lux.components[:3]
+    assert_equal(hasattr(lux, 'light_blue'), False)
+
+def test_decision_maps():
+    import tempfile
+    from magis.models.color.decision import DecisionMaps
+    lux = Lux.pretrained().subset(['red', 'green', 'blue', 'yellow', 'grey'])
+    path = tempfile.mkdtemp()
+    # a tiny memory budget forces many chunks
+    maps = DecisionMaps.build(lux, hue=(0, 350, 36), saturation=[20., 80.], value=60., 
+                              path=path, max_memory=8 * 5 * 7, progress=False)
+    assert_equal(maps.shape, (36, 2, 1))
+    maps = DecisionMaps.load(path)
+    X = np.stack(np.meshgrid(np.linspace(0, 350, 36), [20., 80.], [60.], indexing='ij'), -1).reshape(-1, 3)
+    p_vec = np.asarray(lux.posterior(X))
+    assert_equal(list(np.asarray(maps.argmax).ravel()), list(p_vec.argmax(axis=0)))
+    assert np.allclose(np.asarray(maps.max_prob).ravel(), p_vec.max(axis=0), rtol=1e-6)
+    entropy = -(p_vec * np.log(np.where(p_vec > 0, p_vec, 1))).sum(axis=0)
+    assert np.allclose(np.asarray(maps.entropy).ravel(), entropy, rtol=1e-5, atol=1e-6)
+    plane = maps.slice(value=55.)
+    assert_equal(plane['argmax'].shape, (36, 2))
+    assert_equal(plane['dims'], ['hue', 'saturation'])
+
+def test_decision_maps_memory():
+    import tracemalloc
+    from magis.models.color.decision import DecisionMaps
+    lux = Lux.pretrained().subset(list(range(50)))
+    lux.engine
+    for budget in (1 << 20, 4 << 20):
+        tracemalloc.start()
+        try:
+            DecisionMaps.build(lux, hue=(0, 360, 36), saturation=(0, 100, 21), value=(0, 100, 5),
+                               max_memory=budget, progress=False)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        # the in-memory outputs are 10 bytes per grid point and not part of the budget
+        assert peak - 36 * 21 * 5 * 10 < budget
+
+def test_decision_map_colors():
+    import colorsys
+    import matplotlib
+    matplotlib.use('Agg')
+    from magis.visualize.color_predictions import Plot
+    from magis.models.color.decision import DecisionMaps
+    lux = Lux.pretrained().subset(['red', 'green', 'blue', 'yellow', 'grey', 'purple'])
+    maps = DecisionMaps.build(lux, hue=(0, 350, 36), saturation=(0, 100, 11), value=[30., 50.], 
+                              progress=False)
+    ## the converter is shared by every caller of Plot; put it back afterwards
+    previous = Plot._current_converter
+    Plot.converter = 'normalized_hsv'
+    try:
+        fig = Plot.decision_map(maps, value=50.)
+    finally:
+        Plot.converter = previous
+    regions = np.asarray(fig.axes[0].images[0].get_array())
+
+    # every region is the mean colorsys color of the (degrees, 0-100) points it wins
+    plane = maps.slice(value=50.)
+    sums, counts = {}, {}
+    for i, h in enumerate(plane['axes'][0]):
+        for j, s in enumerate(plane['axes'][1]):
+            winner = plane['argmax'][i, j]
+            rgb = np.array(colorsys.hsv_to_rgb(h / 360., s / 100., 50. / 100.))
+            sums[winner] = sums.get(winner, 0) + rgb
+            counts[winner] = counts.get(winner, 0) + 1
+    for i in range(regions.shape[0]):
+        for j in range(regions.shape[1]):
+            winner = plane['argmax'][i, j]
+            assert np.allclose(regions[i, j], sums[winner] / counts[winner])
+
+
+if __name__ == '__main__':
+    test()
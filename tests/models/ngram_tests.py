@@ -0,0 +1,57 @@
+from nose.tools import assert_equal
+
+import pickle
+from collections import Counter
+
+import numpy as np
+
+from magis.utils.cyutils import ngrams, iter_ngrams, NgramCounter
+
+
+def test_iter_ngrams():
+    words = 'light greyish blue green'.split()
+    assert_equal(list(iter_ngrams(words, 1, 4)), [g for order in ngrams(words, 1, 4) for g in order])
+    assert_equal(list(iter_ngrams(words, 5, 7)), [])
+
+
+def test_ngram_counter():
+    rng = np.random.RandomState(0)
+    vocab = ['light', 'dark', 'blue', 'green', 'ish', 'pale', 'greyish', u'écru']
+    sentences = [list(rng.choice(vocab, size=rng.randint(0, 6))) for _ in range(400)]
+    expected = Counter(g for words in sentences for g in iter_ngrams(words, 1, 4))
+
+    counter = NgramCounter(1, 4, capacity=4, remember=True).update(iter(sentences))
+    assert_equal(len(counter), len(expected))
+    assert_equal(counter.total, sum(expected.values()))
+    for ngram, count in expected.items():
+        assert_equal(counter[ngram], count)
+    assert_equal(counter[('not', 'there')], 0)
+    assert_equal(counter.most_common(1)[0][1], expected.most_common(1)[0][1])
+    assert_equal(set(name for name, _ in counter.most_common()), set(expected))
+
+    ## counters of separate shares merge into the counts of the whole, also through pickling
+    parts = [NgramCounter(1, 4).update(sentences[i::3]) for i in range(3)]
+    merged = NgramCounter(1, 4)
+    for part in parts:
+        merged += pickle.loads(pickle.dumps(part))
+    ids, counts = merged.items()
+    order = np.argsort(ids)
+    ref_ids, ref_counts = counter.items()
+    ref_order = np.argsort(ref_ids)
+    assert np.array_equal(ids[order], ref_ids[ref_order])
+    assert np.array_equal(counts[order], ref_counts[ref_order])
+
+def test_ngram_counter_defaults_and_growth():
+    words = 'light greyish blue green blue'.split()
+    counter = NgramCounter().update([words])
+    assert_equal(len(counter), len(set(iter_ngrams(words))))
+
+    # a long document of repeats only grows the table for its distinct n-grams
+    counter = NgramCounter(1, 4, capacity=16)
+    slots = len(counter.keys)
+    counter.add(['blue', 'green'] * 5000)
+    assert_equal(len(counter), 6)
+    assert_equal(len(counter.keys), slots)
+    assert_equal(counter[('blue', 'green', 'blue')], 4999)
+    # tokens are hashed as str(token)
+    assert_equal(NgramCounter(1, 2).update([[1, '1']])[('1',)], 2)
@@ -0,0 +1,78 @@
+from nose.tools import assert_equal
+
+import asyncio
+import numpy as np
+
+import magis
+from magis.models.serving import BatchingService
+
+
+def test_batching():
+    lux = magis.models.Lux.pretrained()
+    X = np.random.RandomState(0).uniform([0, 0, 0], [360, 100, 100], size=(50, 3))
+
+    async def run(service):
+        async with service:
+            posteriors = await asyncio.gather(*[service.posterior(x) for x in X])
+            predictions = await asyncio.gather(*[service.predict(tuple(x)) for x in X[:5]])
+            tops = await asyncio.gather(*[service.top(x, 3) for x in X[:5]])
+        return posteriors, predictions, tops
+
+    service = BatchingService(lux, max_batch_size=16, max_wait=0.05)
+    posteriors, predictions, tops = asyncio.run(run(service))
+    expected = np.asarray(lux.posterior(X))
+    for i, dist in enumerate(posteriors):
+        assert np.allclose(np.asarray(dist), expected[:, i])
+    for i in range(5):
+        assert_equal(predictions[i], lux.predict(tuple(X[i])))
+        assert_equal(list(tops[i]), list(lux.posterior(tuple(X[i])).top(3)))
+
+    stats = service.stats()
+    assert_equal(stats['requests'], 60)
+    assert_equal(stats['queue_depth'], 0)
+    assert stats['max_batch_size'] <= 16
+    assert stats['batches'] < 60
+
+def test_malformed_datum():
+    lux = magis.models.Lux.pretrained()
+    X = np.random.RandomState(1).uniform([0, 0, 0], [360, 100, 100], size=(6, 3))
+    bad = [(1., 2.), (1., 2., 3., 4.), [[1., 2., 3.]], 'blue']
+
+    async def run(service):
+        async with service:
+            return await asyncio.gather(*([service.posterior(x) for x in X] + 
+                                          [service.posterior(b) for b in bad]),
+                                        return_exceptions=True)
+
+    service = BatchingService(lux, max_batch_size=16, max_wait=0.05)
+    results = asyncio.run(run(service))
+    expected = np.asarray(lux.posterior(X))
+    # only the malformed requests fail, the rest of their batch is answered
+    for i in range(len(X)):
+        assert np.allclose(np.asarray(results[i]), expected[:, i])
+    for result in results[len(X):]:
+        assert isinstance(result, ValueError)
+    assert_equal(service.stats()['requests'], len(X))
+
+def test_submit_while_stopping():
+    lux = magis.models.Lux.pretrained()
+    x = (210., 60., 70.)
+
+    async def run(service):
+        await service.start()
+        queued = asyncio.ensure_future(service.posterior(x))
+        await asyncio.sleep(0)
+        stopping = asyncio.ensure_future(service.stop())
+        await asyncio.sleep(0)
+        ## arrives after stop() started waiting for the queue to drain
+        late = asyncio.ensure_future(service.posterior(x))
+        done = await asyncio.wait_for(asyncio.gather(queued, late, stopping, return_exceptions=True), 5)
+        ## the next request starts the service again
+        again = await service.posterior(x)
+        await service.stop()
+        return done, again
+
+    results, again = asyncio.run(run(BatchingService(lux, max_wait=0.05)))
+    assert np.allclose(np.asarray(results[0]), np.asarray(lux.posterior(x)))
+    assert isinstance(results[1], RuntimeError)
+    assert np.allclose(np.asarray(again), np.asarray(lux.posterior(x)))
@@ -0,0 +1,98 @@
+import matplotlib
+matplotlib.use('Agg')
+
+import colorsys
+
+import numpy as np
+
+from nose.tools import assert_equal, assert_raises
+
+from magis.visualize.color_predictions import Convert, Plot, _glyph_table
+
+
+def _colors(n=500, seed=0):
+    rng = np.random.RandomState(seed)
+    return np.stack([rng.uniform(-180, 360, n), rng.uniform(0, 100, n), rng.uniform(0, 100, n)], axis=1)
+
+def test_convert():
+    hsv = _colors()
+    normalized = hsv / [360., 100., 100.]
+    expected = np.array([colorsys.hsv_to_rgb(*c) for c in normalized])
+    ## the vectorized converters against colorsys, one color at a time
+    assert_equal(np.allclose(Convert.scaled_hsv(hsv), expected), True)
+    assert_equal(np.allclose(Convert.normalized_hsv(normalized), expected), True)
+    adjusted = [colorsys.hsv_to_rgb(h + 1 if h < 0 else h, s, v) for h, s, v in normalized]
+    assert_equal(np.allclose(Convert.normalized_adjusted_hsv(normalized), adjusted), True)
+    assert_equal((normalized[:, 0] < 0).any(), True)
+
+    ## single colors come back as tuples, in any of the call forms
+    h, s, v = hsv[0]
+    for rgb in (Convert.scaled_hsv(h, s, v), Convert.scaled_hsv((h, s, v)), Convert.scaled_hsv(hsv[0])):
+        assert_equal(type(rgb), tuple)
+        assert_equal(np.allclose(rgb, expected[0]), True)
+    assert_equal(np.allclose(Convert.scaled_hsv([tuple(c) for c in hsv[:3]]), expected[:3]), True)
+    assert_raises(Exception, Convert.scaled_hsv, (h, s, v), (h, s, v))
+
+    ## the caller's array is left alone
+    copy = normalized.copy()
+    Convert.normalized_adjusted_hsv(normalized)
+    assert_equal(np.array_equal(copy, normalized), True)
+
+def test_atlas_swatches():
+    hsv = _colors(7)
+    image = Plot.atlas(hsv, columns=3, swatch=10, text_width=20, converter='scaled_hsv')
+    glyph_h = _glyph_table().shape[1]
+    cell_h, cell_w = max(10, glyph_h * 5 + 4), 30
+    assert_equal(image.shape, (3 * cell_h, 3 * cell_w, 3))
+    assert_equal(image.dtype, np.uint8)
+    for i, c in enumerate(hsv / [360., 100., 100.]):
+        row, column = divmod(i, 3)
+        swatch = image[row * cell_h:row * cell_h + 10, column * cell_w:column * cell_w + 10]
+        expected = np.round(np.array(colorsys.hsv_to_rgb(*c)) * 255)
+        assert_equal(np.array_equal(swatch.reshape(-1, 3), np.tile(expected, (100, 1))), True)
+    ## the two cells after the last color, and every text panel, stay white
+    assert_equal((image[2 * cell_h:, cell_w:] == 255).all(), True)
+    assert_equal((image[:, 10:cell_w] == 255).all(), True)
+
+def test_atlas_text():
+    glyphs = _glyph_table()
+    _, glyph_h, glyph_w = glyphs.shape
+    assert_equal(glyphs[ord('b')].any() and not glyphs[ord(' ')].any(), True)
+    predictions = [[('blue', .5), ('teal', .25)], ['red'], {'mauve': 1.}]
+    image = Plot.atlas(_colors(3), predictions, columns=2, topk=2, swatch=20,
+                       text_width=200, converter='scaled_hsv')
+    cell_h, cell_w = max(20, glyph_h * 2 + 4), 220
+    width = (200 - 4) // glyph_w
+    for i, prediction in enumerate(predictions):
+        row, column = divmod(i, 2)
+        lines = Plot._prediction_lines(prediction, 2)
+        for j in range(2):
+            line = (lines[j] if j < len(lines) else '').ljust(width)
+            top = row * cell_h + 2 + j * glyph_h
+            left = column * cell_w + 24
+            for k, char in enumerate(line):
+                ink = image[top:top + glyph_h, left + k * glyph_w:left + (k + 1) * glyph_w]
+                assert_equal(np.array_equal(ink[..., 0], 255 - glyphs[ord(char)]), True)
+                assert_equal(np.array_equal(ink[..., 0], ink[..., 2]), True)
+
+    ## a BatchDistribution is drawn from its top-k
+    from magis.models import Lux
+    lux = Lux.pretrained()
+    colors = _colors(4)
+    batch = lux.posterior(colors)
+    assert_equal(np.array_equal(Plot.atlas(colors, batch, topk=3, converter='scaled_hsv'),
+                                Plot.atlas(colors, batch.top(3), topk=3, converter='scaled_hsv')), True)
+
+def test_save_atlas():
+    import os, tempfile
+    path = tempfile.mkdtemp()
+    colors = _colors(10)
+    written = Plot.save_atlas(os.path.join(path, 'page_{:02d}.png'), colors, per_page=4,
+                              converter='scaled_hsv')
+    assert_equal([os.path.basename(p) for p in written], ['page_00.png', 'page_01.png', 'page_02.png'])
+    assert_equal(all(os.path.exists(p) for p in written), True)
+    ## a single page needs no placeholder; several would all land on one file
+    assert_equal(Plot.save_atlas(os.path.join(path, 'one.png'), colors, converter='scaled_hsv'),
+                 [os.path.join(path, 'one.png')])
+    assert_raises(ValueError, Plot.save_atlas, os.path.join(path, 'many.png'), colors, per_page=4)
+    assert_equal(os.path.exists(os.path.join(path, 'many.png')), False)